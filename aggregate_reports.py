@@ -0,0 +1,39 @@
+from argparse import ArgumentParser
+import json
+
+from utils.logger import get_logger
+from utils.report_store import Aggregator
+
+LOGGER = get_logger(__name__)
+BASE_PATH = "reports/store"
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "-store_path", required=False, default=BASE_PATH, type=str, help="Path to the Parquet report store"
+)
+parser.add_argument(
+    "-output_path", required=False, type=str, help="Path to a JSON file to save the summary to"
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    aggregator = Aggregator(args.store_path)
+    aggregator.update()
+    summary = aggregator.summary()
+
+    for record in summary:
+        success_rate = record["success"]["mean"] if "success" in record else 0.0
+        bit_error_rate = record["bit_error_rate"]["mean"] if "bit_error_rate" in record else None
+        encoding_time = record["encoding_time"]["mean"] if "encoding_time" in record else None
+        LOGGER.info(
+            f"run={record['run']} message_length={record['message_length']} bits_per_word={record['bits_per_word']} "
+            f"additional_bits={record['additional_bits']} model={record['model']}: {record['n_reports']} reports, "
+            f"{success_rate:.1%} success, bit error rate {bit_error_rate}, encoding time {encoding_time}s"
+        )
+
+    if args.output_path:
+        with open(args.output_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        LOGGER.info(f"Saved summary to {args.output_path}")
@@ -1,18 +1,26 @@
-import os
 import json
 from io import StringIO, BytesIO
 from uuid import uuid4
+import time
 import zipfile
 
 import streamlit as st
 
-from utils.app import check_password
+from utils.app import (
+    check_password,
+    get_binary_message,
+    get_config,
+    get_job_manager,
+    get_llm_engine,
+    get_report_writer,
+)
 from steganography import helper, core
 from steganography.secret_key import is_secret_key_valid
-from utils.constants import Procedures
+from steganography.key_format import dumps_secret_key, loads_secret_key, is_compact_secret_key
+from utils.constants import JOB_POLL_INTERVAL, JobStatus, Procedures
 from models.config import Config
 from models.report import ReportModel
-from utils.database import MongoDB
+from utils.database import BulkWriter
 
 st.title("Synonyms Steganography")
 
@@ -20,15 +28,56 @@ if not check_password():
     st.stop()  # Do not continue if check_password is not True.
 
 
-_config = Config.from_json("config.json")
-os.environ["OPENAI_API_KEY"] = _config.openai_api_key
-database = MongoDB(**_config.mongodb)
+_config = get_config()
+bulk_writer = get_report_writer()
+job_manager = get_job_manager()
+get_llm_engine()
+
+
+def run_encoding(message: str, binary_message: str, config: Config, writer: BulkWriter) -> dict:
+    """Encode a message, queue its report and return what the session needs to show the result."""
+    request_uuid = str(uuid4())
+    container, encoded_message, secret_key, time_report, usage_report = core.encode_message(
+        binary_message,
+        bits_per_word=config.bits_per_word,
+        additional_bits=config.additional_bits,
+        binarize=False,
+    )
+
+    report = ReportModel(
+        uuid=request_uuid,
+        message=message,
+        encoded_message=encoded_message,
+        encoding_time_report=time_report,
+        encoding_usage_report=usage_report,
+        secret_key=secret_key,
+        container=container,
+        bits_per_word=config.bits_per_word,
+        additional_bits=config.additional_bits,
+    )
+    writer.submit(report.save())
+
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "x") as zip_file:
+        zip_file.writestr(f"{request_uuid}_encoded_message.txt", encoded_message)
+        zip_file.writestr(f"{request_uuid}_secret_key.ssk", dumps_secret_key(secret_key))
+    return {"uuid": request_uuid, "time_report": time_report, "archive": buf.getvalue()}
+
+
+def run_decoding(container: str, secret_key: list, request_uuid: str, writer: BulkWriter) -> dict:
+    """Decode a message and queue the update of its report."""
+    decoded_message, spent_time = core.decode_message(container, secret_key)
+    writer.submit(ReportModel.update_fields(
+        request_uuid, {"decoded_message": decoded_message, "decoding_time": spent_time}
+    ))
+    return {"decoded_message": decoded_message, "spent_time": spent_time}
+
 
 choice = st.selectbox("Select your procedure", Procedures.values)
 with st.form(key="main_form"):
     if choice == Procedures.ENCODING:
         message = st.text_input("Please, enter your message...")
-        binary_message = helper.binarize_message(message)
+        binary_message = get_binary_message(message)
         st.write(
             f"The binary length of your message: {len(binary_message)}."
         )
@@ -49,9 +98,19 @@ with st.form(key="main_form"):
         if uploaded_file is not None:
             secret_key_request_uuid = uploaded_file.name.split("_")[0]
 
-            stringio = StringIO(uploaded_file.getvalue().decode("utf-8"))
-            secret_key = json.loads(stringio.read())
-            if not secret_key or not is_secret_key_valid(secret_key):
+            secret_key_data = uploaded_file.getvalue()
+            if is_compact_secret_key(secret_key_data):
+                try:
+                    secret_key = loads_secret_key(secret_key_data)
+                except ValueError:
+                    secret_key = None
+            else:
+                stringio = StringIO(secret_key_data.decode("utf-8"))
+                secret_key = json.loads(stringio.read())
+                if not is_secret_key_valid(secret_key):
+                    secret_key = None
+
+            if not secret_key:
                 st.write("The secret_key is empty or invalid!")
                 st.stop()
             elif message_request_uuid != secret_key_request_uuid:
@@ -62,55 +121,45 @@ with st.form(key="main_form"):
 
     encoding_submit = st.form_submit_button(label="Run")
 
-if encoding_submit and choice == Procedures.ENCODING:
-    st.write("Encoding, please wait...")
-    request_uuid = str(uuid4())
+if encoding_submit:
+    try:
+        if choice == Procedures.ENCODING:
+            job = job_manager.submit(choice, run_encoding, message, binary_message, _config, bulk_writer)
+        else:
+            job = job_manager.submit(choice, run_decoding, container, secret_key, message_request_uuid, bulk_writer)
+        st.session_state["job_id"] = job.id
+    except RuntimeError as e:
+        st.write(f"The service is busy, please try again later. {e}")
+
+job = job_manager.get(st.session_state.get("job_id", ""))
+if job is not None and not job.done:
+    position = job_manager.get_position(job)
+    if position:
+        st.write(f"{job.kind} is waiting for {position} other requests, please wait...")
+    else:
+        st.write(f"{job.kind} for {job.elapsed:.1f} seconds, please wait...")
+    time.sleep(JOB_POLL_INTERVAL)
+    st.rerun()
 
-    container, encoded_message, secret_key, time_report, usage_report = core.encode_message(
-        binary_message,
-        bits_per_word=_config.bits_per_word,
-        additional_bits=_config.additional_bits,
-        binarize=False,
-    )
+elif job is not None and job.status == JobStatus.FAILED:
+    st.write(f"{job.kind} failed: {job.error}")
 
+elif job is not None and job.kind == Procedures.ENCODING:
     text = "Here is your container message and secret key. Please download them.\n"
     text += "Time spent:\n"
-    text += "\n".join([f"{helper.to_plain_text(k)}: {v}" for k, v in time_report.items()])
+    text += "\n".join([f"{helper.to_plain_text(k)}: {v}" for k, v in job.result["time_report"].items()])
     st.write(text)
 
-    report = ReportModel(
-        uuid=request_uuid,
-        message=message,
-        encoded_message=encoded_message,
-        encoding_time_report=time_report,
-        encoding_usage_report=usage_report,
-        secret_key=secret_key,
-        container=container
-    )
-    # database.execute(**report.save())
-
-    buf = BytesIO()
-    with zipfile.ZipFile(buf, "x") as zip_file:
-        zip_file.writestr(f"{request_uuid}_encoded_message.txt", encoded_message)
-        zip_file.writestr(f"{request_uuid}_secret_key.json", json.dumps(secret_key))
-
     st.download_button(
         label="Download encoded message and secret key",
-        data=buf.getvalue(),
-        file_name=f"{request_uuid}.zip",
+        data=job.result["archive"],
+        file_name=f"{job.result['uuid']}.zip",
         mime="application/zip",
     )
 
-elif encoding_submit and choice == Procedures.DECODING:
-    st.write("Decoding, please wait...")
-    decoded_message, spent_time = core.decode_message(container, secret_key)
-    if decoded_message:
-        st.write(f"Here is your decoded message: {decoded_message}")
-        st.write(f"Spent time on decoding: {spent_time} seconds")
-
-    # report = ReportModel(**database.fetch_one(**ReportModel.get(message_request_uuid)))
-    # report.decoded_message = decoded_message
-    # report.decoding_time = spent_time
-    # database.execute(**report.update())
+elif job is not None:
+    if job.result["decoded_message"]:
+        st.write(f"Here is your decoded message: {job.result['decoded_message']}")
+        st.write(f"Spent time on decoding: {job.result['spent_time']} seconds")
 
 st.write("Reload the page to repeat the procedure")
@@ -0,0 +1,187 @@
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from steganography import core, helper
+from steganography.gpt import set_provider, get_openai_output
+from steganography.providers import OfflineProvider
+from steganography.secret_key import (
+    align_container_and_secret_key,
+    binarize_synonyms_partially,
+    build_secret_key,
+    clean_secret_key,
+    generate_synonyms_chunks,
+    is_secret_key_valid,
+)
+from models.pool_arguments import SecretKeyGenerationBody
+from utils import constants, prompts
+from utils.logger import get_logger
+
+LOGGER = get_logger(__name__)
+
+MESSAGE_LENGTHS = [128, 256, 512, 4096]
+BITS_SETTINGS = [(2, 0), (5, 0), (3, 2)]  # (bits_per_word, additional_bits)
+CONTAINER_SIZES = [100, 1000, 10000]
+CODE_WIDTHS = [5, 8, 15]
+REPEATS = 5
+THRESHOLD = 0.2
+MIN_DELTA_MS = 0.5
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "-output_path", required=False, default="benchmark_results.json", type=str, help="Path to JSON results"
+)
+parser.add_argument(
+    "-baseline_path", required=False, type=str, help="Path to baseline JSON results to compare against"
+)
+parser.add_argument(
+    "-save_baseline", required=False, action="store_true", help="Store results to baseline_path instead of comparing"
+)
+parser.add_argument(
+    "-repeats", required=False, default=REPEATS, type=int, help="Number of measured runs per case"
+)
+parser.add_argument(
+    "-threshold", required=False, default=THRESHOLD, type=float,
+    help="Allowed relative slowdown of the fastest run before a case is reported as a regression"
+)
+parser.add_argument(
+    "-filter", required=False, default="", type=str, help="Run only cases whose name contains this string"
+)
+
+
+def measure(function, repeats: int, number: int = 1) -> dict[str, float]:
+    """Run function number times per measurement and return per-call timings in milliseconds."""
+    function()  # Warm up
+    timings = []
+    for _ in range(repeats):
+        s = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - s) * 1000 / number)
+    return {
+        "median_ms": statistics.median(timings),
+        "min_ms": min(timings),
+        "mean_ms": statistics.mean(timings),
+        "stdev_ms": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        "repeats": repeats,
+        "number": number,
+    }
+
+
+def get_container(words_number: int) -> str:
+    """Returns a deterministic container with at least words_number words from the offline provider."""
+    input_message = prompts.CONTAINER_GENERATION_INPUT.format(topic="Benchmark", words_number=words_number)
+    container, _ = get_openai_output(prompts.CONTAINER_GENERATION_PROMPT, input_message)
+    return container
+
+
+def get_raw_secret_key(container: str, bits_per_word: int, additional_bits: int, binary_message: str):
+    body = SecretKeyGenerationBody.from_list(
+        helper.divide_chunks(container.split(), 5),
+        bits_per_word,
+        additional_bits,
+        core.get_binary_message_chunks(binary_message, bits_per_word, additional_bits),
+    )
+    synonyms_chunks, _ = generate_synonyms_chunks(body)
+    return build_secret_key(synonyms_chunks, body, rng=0)
+
+
+def get_cases():
+    """Yields (name, function, number of calls per measurement) for every benchmark case."""
+    for message_length in MESSAGE_LENGTHS:
+        for bits_per_word, additional_bits in BITS_SETTINGS:
+            binary_message = helper.get_random_message(message_length)
+            words_number = message_length // (bits_per_word + additional_bits) * 1.5 * constants.CONTAINER_BUFFER
+            container = get_container(int(words_number))
+            suffix = f"[bits={message_length},bpw={bits_per_word},ab={additional_bits}]"
+
+            def encode(binary_message=binary_message, container=container, b=bits_per_word, a=additional_bits):
+                return core.encode_message(binary_message, b, a, binarize=False, container=container, seed=0)
+
+            _, encoded_message, secret_key, _, _ = encode()
+            yield f"encode_message{suffix}", encode, 1
+            yield f"decode_message{suffix}", lambda e=encoded_message, k=secret_key: core.decode_message(
+                e, k, clean_output=False
+            ), 1
+
+    for container_size in CONTAINER_SIZES:
+        container = get_container(container_size)
+        binary_message = helper.get_random_message(container_size)
+        raw_secret_key = get_raw_secret_key(container, 3, 0, binary_message)
+        secret_key = align_container_and_secret_key(container, raw_secret_key)
+        suffix = f"[words={container_size}]"
+
+        yield f"align_container_and_secret_key{suffix}", lambda c=container, k=raw_secret_key: \
+            align_container_and_secret_key(c, k), 1
+        yield f"is_secret_key_valid{suffix}", lambda k=secret_key: is_secret_key_valid(k), 1
+        yield f"clean_secret_key{suffix}", lambda k=secret_key: clean_secret_key(k), 1
+
+    synonyms = [f"synonym{i}" for i in range(2**constants.MAX_BITS_PER_WORD)]
+    for width in CODE_WIDTHS:
+        include_sequence = helper.get_random_message(width)
+        rng = np.random.default_rng(0)
+        yield f"binarize_synonyms_partially[width={width}]", lambda s=include_sequence, r=rng: \
+            binarize_synonyms_partially(synonyms, s, rng=r), 100
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Returns descriptions of cases slower than the baseline by more than the threshold. The fastest run is
+    compared, as it is the least affected by noise from other processes.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        current, previous = result["min_ms"], baseline[name]["min_ms"]
+        if current > previous * (1 + threshold) and current - previous > MIN_DELTA_MS:
+            regressions.append(f"{name}: {previous:.3f}ms -> {current:.3f}ms (+{(current / previous - 1) * 100:.0f}%)")
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # Deterministic stubbed LLM responses, no network and no cache between runs
+    set_provider(OfflineProvider(seed=0))
+    constants.SYNONYM_CACHE_ENABLED = False
+    random.seed(0)
+    np.random.seed(0)
+
+    results = {}
+    for name, function, number in get_cases():
+        if args.filter not in name:
+            continue
+        results[name] = measure(function, args.repeats, number)
+        LOGGER.info(f"{name}: {results[name]['median_ms']:.3f}ms")
+
+    output = {
+        "created": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output_path, "w") as f:
+        json.dump(output, f, indent=2)
+    LOGGER.info(f"Results saved to {args.output_path}")
+
+    if args.baseline_path and args.save_baseline:
+        with open(args.baseline_path, "w") as f:
+            json.dump(output, f, indent=2)
+        LOGGER.info(f"Baseline saved to {args.baseline_path}")
+    elif args.baseline_path and os.path.exists(args.baseline_path):
+        with open(args.baseline_path) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+        if regressions:
+            LOGGER.error("Performance regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        LOGGER.info("No performance regressions")
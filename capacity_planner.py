@@ -0,0 +1,55 @@
+from argparse import ArgumentParser
+
+from steganography.planner import CapacityPlanner
+from utils.constants import PLANNER_MIN_REPORTS, PLANNER_TARGET_PROBABILITY
+from utils.logger import get_logger
+
+LOGGER = get_logger(__name__)
+BASE_PATH = "reports/gpt_omni_reports"
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "-reports_path", required=False, default=BASE_PATH, type=str, help="Path to folder with JSON reports"
+)
+parser.add_argument(
+    "-store_path", required=False, type=str, help="Path to a Parquet report store to also read reports from"
+)
+parser.add_argument(
+    "-message_length", required=True, type=int, help="Length of the secret message in bits"
+)
+parser.add_argument(
+    "-target_probability", required=False, default=PLANNER_TARGET_PROBABILITY, type=float,
+    help="Probability that the container fits the whole message"
+)
+parser.add_argument(
+    "-model", required=False, type=str, help="Provider and model of the reports, e.g. openai/gpt-4o"
+)
+parser.add_argument(
+    "-min_reports", required=False, default=PLANNER_MIN_REPORTS, type=int,
+    help="Reports of a parameter set needed before its measured yield is trusted"
+)
+parser.add_argument(
+    "-all", required=False, action="store_true", help="Also list parameter sets without enough reports"
+)
+parser.add_argument(
+    "-top", required=False, default=10, type=int, help="Number of plans to list"
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    planner = CapacityPlanner.from_directory(args.reports_path, args.min_reports)
+    if args.store_path:
+        planner.add_store(args.store_path)
+    plans = planner.plan(args.message_length, args.target_probability, args.model, measured_only=not args.all)
+    if not plans:
+        LOGGER.warning("No parameter set has enough reports, run with -all to list default estimates")
+
+    for plan in plans[:args.top]:
+        success_rate = f"{plan.success_rate:.0%}" if plan.success_rate is not None else "n/a"
+        LOGGER.info(
+            f"bits_per_word={plan.bits_per_word} additional_bits={plan.additional_bits}: "
+            f"{plan.container_length} words, {plan.expected_yield} bits/word, ~{plan.estimated_tokens} tokens, "
+            f"{plan.n_reports} reports, {success_rate} measured success"
+        )
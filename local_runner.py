@@ -1,11 +1,18 @@
 from argparse import ArgumentParser
 from uuid import uuid4
+import json
 import os
 
-from steganography import core, helper
-from models import ReportModel
+from steganography import core, helper, stream_encoder
+from models import Config, ReportModel
 from utils.logger import get_logger
-from utils.constants import MAX_BITS_PER_WORD, MAX_ADDITIONAL_BITS_MULTIPLIER, CONTAINER_BUFFER
+from utils.report_store import ReportStore
+from utils.tracing import configure_tracing, profile, trace
+from steganography.gpt import get_model_name, set_provider
+from steganography.planner import load_planner
+from steganography.providers import create_provider
+from utils.constants import MAX_BITS_PER_WORD, MAX_ADDITIONAL_BITS_MULTIPLIER, PLANNER_TARGET_PROBABILITY
+from utils.constants import LLM_PROVIDERS, LLM_PROVIDER
 
 BASE_PATH = "artifacts"
 LOGGER = get_logger(__name__)
@@ -31,15 +38,115 @@ parser.add_argument(
     "-config_path", required=False, default="config.json", type=str, help="Path to config with hparams"
 )
 parser.add_argument(
-    "-openai_key", required=True, type=str, help="OpenAI API key"
+    "-openai_key", required=False, type=str, default="", help="OpenAI API key"
 )
+parser.add_argument(
+    "-provider", required=False, choices=LLM_PROVIDERS, default=LLM_PROVIDER, type=str,
+    help="LLM backend: OpenAI, deterministic offline responses, or OpenAI responses recorded to/replayed from a cassette"
+)
+parser.add_argument(
+    "-cassette_path", required=False, type=str, help="Path to a cassette file for record and replay providers"
+)
+parser.add_argument(
+    "-offline_seed", required=False, type=int, default=0, help="Seed of the offline provider"
+)
+parser.add_argument(
+    "-offline_latency", required=False, type=float, default=0.0, help="Latency of offline responses in seconds"
+)
+parser.add_argument(
+    "-offline_jitter", required=False, type=float, default=0.0, help="Maximum random extra latency in seconds"
+)
+parser.add_argument(
+    "-reports_path", required=False, type=str, help="Path to folder with JSON reports to measure container yield from"
+)
+parser.add_argument(
+    "-target_probability", required=False, type=float, default=PLANNER_TARGET_PROBABILITY,
+    help="Probability that the container fits the whole message, used to size the container"
+)
+parser.add_argument(
+    "-store_path", required=False, type=str, help="Path to a Parquet report store to append the report to"
+)
+parser.add_argument(
+    "-trace", required=False, action="store_true", help="Record nested spans of encoding and decoding"
+)
+parser.add_argument(
+    "-profile", required=False, action="store_true", help="Capture cProfile profiles of encoding and decoding"
+)
+parser.add_argument(
+    "-trace_path", required=False, type=str, help="Path to folder for traces and profiles"
+)
+parser.add_argument(
+    "-stream", required=False, action="store_true",
+    help="Encode a memory-mapped container window by window, writing the encoded text and secret key to files"
+)
+
+
+def run_streaming(args, message: str, request_uuid: str):
+    """
+    Encode the message into the container file with the streaming encoder and decode the written files window
+    by window. The encoded text, the secret key records and a summary report are saved to the output path.
+    """
+    encoded_path = os.path.join(args.output_path, f"{request_uuid}_encoded.txt")
+    secret_key_path = os.path.join(args.output_path, f"{request_uuid}_secret_key.jsonl")
+
+    LOGGER.info("Running streaming encoding step")
+    with trace(request_uuid), profile("encode", request_uuid):
+        encoder = stream_encoder.encode_file(
+            args.container_path,
+            encoded_path,
+            secret_key_path,
+            message,
+            bits_per_word=args.bits_per_word,
+            additional_bits=args.additional_bits,
+            binarize=False,
+        )
+    LOGGER.info(f"Embedded {encoder.embedded_bits} bits into {encoder.n_words} words")
+
+    LOGGER.info("Running decoding step")
+    with trace(request_uuid), profile("decode", request_uuid):
+        decoded_message, spent_time = stream_encoder.decode_file(encoded_path, secret_key_path, clean_output=False)
+    LOGGER.info(f"Decoded message matches: {decoded_message == message}")
+
+    with open(os.path.join(args.output_path, f"{request_uuid}_stream.json"), "w") as f:
+        json.dump({
+            "uuid": request_uuid,
+            "message": message,
+            "decoded_message": decoded_message,
+            "encoded_path": encoded_path,
+            "secret_key_path": secret_key_path,
+            "container_words": encoder.n_words,
+            "embedded_bits": encoder.embedded_bits,
+            "encoding_time_report": encoder.time_report,
+            "encoding_usage_report": encoder.usage_report,
+            "decoding_time": spent_time,
+            "bits_per_word": args.bits_per_word,
+            "additional_bits": args.additional_bits,
+            "model": get_model_name(),
+        }, f)
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
     # Creating artifacts folder and loading openai api key
     os.makedirs(args.output_path, exist_ok=True)
+    assert args.openai_key or args.provider in ["offline", "replay"], f"openai_key is required for {args.provider}"
     os.environ["OPENAI_API_KEY"] = args.openai_key
+    set_provider(create_provider(
+        args.provider,
+        cassette_path=args.cassette_path,
+        seed=args.offline_seed,
+        latency=args.offline_latency,
+        jitter=args.offline_jitter,
+    ))
+
+    # Tracing settings from the config, if there is one, are overridden by flags
+    tracing = Config.from_json(args.config_path).tracing if os.path.exists(args.config_path) else {}
+    configure_tracing(
+        enabled=args.trace or tracing.get("enabled", False),
+        profile=args.profile or tracing.get("profile", False),
+        output_path=args.trace_path or tracing.get("output_path"),
+    )
 
     # Ensuring bits per word is not exceeding the limit
     assert args.bits_per_word <= MAX_BITS_PER_WORD, f"bits_per_word too big, max allowed: {MAX_BITS_PER_WORD}"
@@ -49,16 +156,25 @@ if __name__ == '__main__':
     assert args.additional_bits + args.bits_per_word <= args.bits_per_word * MAX_ADDITIONAL_BITS_MULTIPLIER, msg
     LOGGER.info(f"Working with: {args.bits_per_word} and {args.additional_bits} additional bits per word.")
 
+    if args.stream:  # The container is never loaded into memory as a whole
+        run_streaming(args, helper.get_random_message(args.message_length), str(uuid4()))
+        LOGGER.info("All processes finished!")
+        raise SystemExit(0)
+
     # Reading the container
     with open(args.container_path) as f:
         container = f.read().strip()
 
     # Checking that the container is big enough to fix full message length
     LOGGER.info(f"Processing {args.message_length} message length")
-    min_words_required = args.message_length // (args.bits_per_word + args.additional_bits) * 1.5 * CONTAINER_BUFFER
+    planner = load_planner(args.reports_path, target_probability=args.target_probability)
+    min_words_required = planner.get_container_length(
+        args.message_length, args.bits_per_word, args.additional_bits, model=get_model_name()
+    )
     additional_words_needed = min_words_required - len(container.split())
     msg = f"Container to small to fit {args.message_length} bits, add {additional_words_needed} more words."
-    assert min_words_required > 0, msg
+    if additional_words_needed > 0:
+        LOGGER.warning(msg)
 
     # Generating random secret message
     message = helper.get_random_message(args.message_length)
@@ -66,22 +182,24 @@ if __name__ == '__main__':
 
     # Running encoding and decoding procedure
     LOGGER.info("Running encoding step")
-    container, encoded_message, secret_key, time_report, usage_report = core.encode_message(
-        message,
-        bits_per_word=args.bits_per_word,
-        additional_bits=args.additional_bits,
-        binarize=False,
-        container=container,
-    )
+    with trace(request_uuid), profile("encode", request_uuid):
+        container, encoded_message, secret_key, time_report, usage_report = core.encode_message(
+            message,
+            bits_per_word=args.bits_per_word,
+            additional_bits=args.additional_bits,
+            binarize=False,
+            container=container,
+        )
 
     LOGGER.info("Running decoding step")
-    decoded_message, spent_time = core.decode_message(
-        encoded_message,
-        secret_key,
-        clean_output=False
-    )
-
-    # Saving report to artifacts folder in JSON format
+    with trace(request_uuid), profile("decode", request_uuid):
+        decoded_message, spent_time = core.decode_message(
+            encoded_message,
+            secret_key,
+            clean_output=False
+        )
+
+    # Saving report to artifacts folder in JSON format or to the report store
     report = ReportModel(
         uuid=request_uuid,
         message=message,
@@ -91,9 +209,17 @@ if __name__ == '__main__':
         secret_key=secret_key,
         container=container,
         decoding_time=spent_time,
-        decoded_message=decoded_message
+        decoded_message=decoded_message,
+        bits_per_word=args.bits_per_word,
+        additional_bits=args.additional_bits,
+        model=get_model_name(),
     )
 
-    report.to_json(BASE_PATH)
+    if args.store_path:
+        store = ReportStore(args.store_path)
+        store.add(report)
+        store.flush()
+    else:
+        report.to_json(BASE_PATH)
 
     LOGGER.info("All processes finished!")
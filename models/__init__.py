@@ -1,2 +1,3 @@
 from .config import Config
 from .report import ReportModel
+from .job import JobModel
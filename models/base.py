@@ -44,6 +44,15 @@ class BaseModel:
                 'method': 'insert'
             }
 
+    def upsert(self):
+        """Returns query to save the record, replacing the record with the same uuid if there is one"""
+        return {
+            'collection': self.collection_name,
+            'docs': self.to_dict(self.fields),
+            'method': 'upsert',
+            'query': {'uuid': self.uuid}
+        }
+
     def update(self):
         return {
             'collection': self.collection_name,
@@ -52,6 +61,17 @@ class BaseModel:
             'query': {'uuid': self.uuid}
         }
 
+    @classmethod
+    def update_fields(cls, uuid, values):
+        """Returns query to update only the given fields of a record, without loading it first"""
+        assert isinstance(values, dict), 'values should be a dictionary type'
+        return {
+            'collection': cls.collection_name,
+            'docs': {**values, 'modified': datetime.now()},
+            'method': 'update',
+            'query': {'uuid': uuid}
+        }
+
     def delete(self):
         """Returns query to delete model record from database"""
         return {
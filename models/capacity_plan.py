@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+
+
+class CapacityPlan(BaseModel):
+    model: str | None
+    bits_per_word: int
+    additional_bits: int
+    container_length: int
+    expected_yield: float
+    estimated_tokens: int
+    n_reports: int
+    success_rate: float | None = None
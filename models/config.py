@@ -13,6 +13,8 @@ class Config(BaseModel):
         "bits_per_word",
         "additional_bits",
         "mongodb",
+        "tracing",
+        "planner",
     ]
 
     collection_name = "configs"
@@ -24,6 +26,8 @@ class Config(BaseModel):
         self.additional_bits = kwargs["additional_bits"]
 
         self.mongodb = kwargs["mongodb"]
+        self.tracing = kwargs.get("tracing", {})
+        self.planner = kwargs.get("planner", {})
 
     @classmethod
     def from_json(cls, path_to_json: str):
@@ -0,0 +1,35 @@
+from models.base import BaseModel
+from utils.constants import QUEUE_MAX_ATTEMPTS, JobStatus
+
+
+class JobModel(BaseModel):
+    fields = [
+        "uuid",
+        "created",
+        "modified",
+        "kind",
+        "status",
+        "payload",
+        "attempts",
+        "max_attempts",
+        "available_at",
+        "lease_owner",
+        "lease_expires",
+        "report_uuid",
+        "error_message",
+    ]
+
+    collection_name = "jobs"
+
+    def __init__(self, **kwargs):
+        super(JobModel, self).__init__(**kwargs)
+        self.kind = kwargs["kind"]
+        self.payload = kwargs["payload"]
+        self.status = kwargs.get("status", JobStatus.PENDING)
+        self.attempts = kwargs.get("attempts", 0)
+        self.max_attempts = kwargs.get("max_attempts", QUEUE_MAX_ATTEMPTS)
+        self.available_at = kwargs.get("available_at")
+        self.lease_owner = kwargs.get("lease_owner")
+        self.lease_expires = kwargs.get("lease_expires")
+        self.report_uuid = kwargs.get("report_uuid")
+        self.error_message = kwargs.get("error_message", "")
@@ -1,6 +1,7 @@
 import json
 
 from models.base import BaseModel
+from steganography.key_format import dumps_secret_key, loads_secret_key
 
 
 class ReportModel(BaseModel):
@@ -16,7 +17,10 @@ class ReportModel(BaseModel):
         "encoding_usage_report",
         "decoding_time",
         "decoded_message",
-        "error_message"
+        "error_message",
+        "bits_per_word",
+        "additional_bits",
+        "model",
     ]
 
     collection_name = "reports"
@@ -27,11 +31,23 @@ class ReportModel(BaseModel):
         self.container = kwargs["container"]
         self.encoded_message = kwargs["encoded_message"]
         self.secret_key = kwargs["secret_key"]
+        if isinstance(self.secret_key, bytes):  # Stored in the compact binary format
+            self.secret_key = loads_secret_key(self.secret_key)
         self.encoding_time_report = kwargs["encoding_time_report"]
         self.encoding_usage_report = kwargs["encoding_usage_report"]
         self.decoding_time = kwargs.get("decoding_time", "")
         self.decoded_message = kwargs.get("decoded_message", "")
         self.error_message = kwargs.get("error_message", "")
+        self.bits_per_word = kwargs.get("bits_per_word")
+        self.additional_bits = kwargs.get("additional_bits")
+        self.model = kwargs.get("model")
+
+    def to_dict(self, fields, modified=False):
+        """Convert the report to a dictionary, storing the secret key in the compact binary format."""
+        data = super(ReportModel, self).to_dict(fields, modified)
+        if isinstance(data.get("secret_key"), list):
+            data["secret_key"] = dumps_secret_key(data["secret_key"])
+        return data
 
     def to_json(self, base_path: str):
         with open(f"{base_path}/{self.uuid}.json", "w") as f:
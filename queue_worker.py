@@ -0,0 +1,194 @@
+from argparse import ArgumentParser
+import os
+import signal
+import socket
+import threading
+
+from steganography import core
+from steganography.gpt import get_model_name, set_provider
+from steganography.planner import load_planner
+from steganography.providers import create_provider
+from models.config import Config
+from models.job import JobModel
+from models.report import ReportModel
+from utils.constants import (
+    LLM_PROVIDER,
+    LLM_PROVIDERS,
+    QUEUE_HEARTBEAT_INTERVAL,
+    QUEUE_POLL_INTERVAL,
+    Procedures,
+)
+from utils.database import MongoDB
+from utils.job_queue import Heartbeat, JobQueue
+from utils.logger import get_logger
+
+LOGGER = get_logger(__name__)
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "-config_path", required=False, default="config.json", type=str, help="Path to config with MongoDB credentials"
+)
+parser.add_argument(
+    "-worker_id", required=False, default=f"{socket.gethostname()}-{os.getpid()}", type=str,
+    help="Name of this worker in job leases"
+)
+parser.add_argument(
+    "-concurrency", required=False, default=4, type=int, help="Number of jobs running at once"
+)
+parser.add_argument(
+    "-poll_interval", required=False, default=QUEUE_POLL_INTERVAL, type=float,
+    help="Seconds to wait before polling again when the queue is empty"
+)
+parser.add_argument(
+    "-kinds", required=False, nargs="+", choices=Procedures.values, help="Kinds of jobs to run, all by default"
+)
+parser.add_argument(
+    "-exit_when_idle", required=False, action="store_true", help="Stop once the queue has no available jobs"
+)
+parser.add_argument(
+    "-provider", required=False, choices=LLM_PROVIDERS, default=LLM_PROVIDER, type=str,
+    help="LLM backend: OpenAI, deterministic offline responses, or responses recorded to/replayed from a cassette"
+)
+parser.add_argument(
+    "-cassette_path", required=False, type=str, help="Path to a cassette file for record and replay providers"
+)
+parser.add_argument(
+    "-offline_seed", required=False, type=int, default=0, help="Seed of the offline provider"
+)
+
+
+def run_encoding_job(database, job: JobModel) -> str:
+    """
+    Encode the message of an encoding job and save its report. If payload["verify"] is set, the encoded message
+    is decoded right away and the decoded message is stored in the same report. The report has the uuid of the
+    job and replaces the report of a previous attempt, so retries never leave duplicate reports.
+
+    Returns:
+        str: The uuid of the report.
+    """
+    payload = job.payload
+    container, encoded_message, secret_key, time_report, usage_report = core.encode_message(
+        payload["message"],
+        bits_per_word=payload["bits_per_word"],
+        additional_bits=payload.get("additional_bits", 0),
+        binarize=payload.get("binarize", True),
+        container=payload.get("container"),
+        stream=payload.get("stream", False),
+        seed=payload.get("seed"),
+    )
+
+    decoded_message, spent_time = "", ""
+    if payload.get("verify"):
+        decoded_message, spent_time = core.decode_message(
+            encoded_message, secret_key, clean_output=payload.get("binarize", True)
+        )
+
+    report = ReportModel(
+        uuid=job.uuid,
+        message=payload["message"],
+        encoded_message=encoded_message,
+        encoding_time_report=time_report,
+        encoding_usage_report=usage_report,
+        secret_key=secret_key,
+        container=container,
+        decoding_time=spent_time,
+        decoded_message=decoded_message,
+        bits_per_word=payload["bits_per_word"],
+        additional_bits=payload.get("additional_bits", 0),
+        model=get_model_name(),
+    )
+    database.execute(**report.upsert())
+    return report.uuid
+
+
+def run_decoding_job(database, job: JobModel) -> str:
+    """
+    Decode the encoded message of a stored report and record the decoded message in it.
+
+    Returns:
+        str: The uuid of the report.
+    """
+    payload = job.payload
+    doc = database.fetch_one(**ReportModel.get(payload["report_uuid"]))
+    assert doc is not None, f"Report {payload['report_uuid']} does not exist"
+    report = ReportModel(**doc)
+
+    decoded_message, spent_time = core.decode_message(
+        report.encoded_message, report.secret_key, clean_output=payload.get("clean_output", True)
+    )
+    database.execute(**ReportModel.update_fields(
+        report.uuid, {"decoded_message": decoded_message, "decoding_time": spent_time}
+    ))
+    return report.uuid
+
+
+JOB_RUNNERS = {Procedures.ENCODING: run_encoding_job, Procedures.DECODING: run_decoding_job}
+
+
+def process(queue: JobQueue, job: JobModel, worker_id: str, heartbeat_interval: float = QUEUE_HEARTBEAT_INTERVAL):
+    """Run a claimed job while renewing its lease, then record its report or schedule a retry."""
+    with Heartbeat(queue, job, worker_id, heartbeat_interval) as heartbeat:
+        try:
+            report_uuid = JOB_RUNNERS[job.kind](queue.database, job)
+        except Exception as e:
+            LOGGER.exception(f"Job {job.uuid} failed on attempt {job.attempts}/{job.max_attempts}: {e}")
+            queue.fail(job, worker_id, str(e))
+            return
+
+    if heartbeat.lost or not queue.complete(job, worker_id, report_uuid):
+        LOGGER.warning(f"Job {job.uuid} was taken over by another worker, which overwrites report {report_uuid}")
+
+
+def work(
+    queue: JobQueue,
+    worker_id: str,
+    stop_event: threading.Event,
+    kinds: list[str] | None = None,
+    poll_interval: float = QUEUE_POLL_INTERVAL,
+    exit_when_idle: bool = False,
+):
+    """Claim and run jobs one at a time until stop_event is set, or until the queue is idle if exit_when_idle."""
+    while not stop_event.is_set():
+        job = queue.claim(worker_id, kinds)
+        if job is None:
+            if exit_when_idle:
+                return
+            stop_event.wait(poll_interval)
+            continue
+        LOGGER.info(f"{worker_id} running {job.kind} job {job.uuid}, attempt {job.attempts}/{job.max_attempts}")
+        process(queue, job, worker_id)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    _config = Config.from_json(args.config_path)
+    os.environ["OPENAI_API_KEY"] = _config.openai_api_key
+    set_provider(create_provider(args.provider, cassette_path=args.cassette_path, seed=args.offline_seed))
+    load_planner(**_config.planner)
+
+    database = MongoDB(**_config.mongodb)
+    database.ensure_indexes()
+    job_queue = JobQueue(database)
+
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        LOGGER.warning("Stopping, waiting for running jobs to finish")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    threads = [
+        threading.Thread(target=work, args=(
+            job_queue, f"{args.worker_id}-{idx}", stop_event, args.kinds, args.poll_interval, args.exit_when_idle
+        ))
+        for idx in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    LOGGER.info("All processes finished!")
@@ -0,0 +1,292 @@
+from argparse import ArgumentParser
+from base64 import b64decode, b64encode
+from binascii import Error as BinasciiError
+import asyncio
+import json
+import os
+
+import tornado.ioloop
+import tornado.web
+
+from steganography import core
+from steganography.gpt import get_model_name, set_provider
+from steganography.key_format import dumps_secret_key, is_compact_secret_key, loads_secret_key
+from steganography.planner import load_planner
+from steganography.providers import create_provider
+from steganography.secret_key import is_secret_key_valid
+from models.config import Config
+from utils.constants import (
+    JOB_MAX_PENDING,
+    JOB_WORKERS,
+    LLM_PROVIDER,
+    LLM_PROVIDERS,
+    MAX_ADDITIONAL_BITS_MULTIPLIER,
+    MAX_BITS_PER_WORD,
+    SERVICE_MAX_BODY_SIZE,
+    SERVICE_PORT,
+    JobStatus,
+    Procedures,
+)
+from utils.jobs import Job, JobManager
+from utils.logger import get_logger
+from utils.metrics import get_registry
+
+LOGGER = get_logger(__name__)
+SECRET_KEY_FORMATS = ["compact", "json"]
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "-port", required=False, default=SERVICE_PORT, type=int, help="Port to serve the API on"
+)
+parser.add_argument(
+    "-workers", required=False, default=JOB_WORKERS, type=int, help="Number of encodes and decodes running at once"
+)
+parser.add_argument(
+    "-max_pending", required=False, default=JOB_MAX_PENDING, type=int,
+    help="Number of requests waiting for a worker before new ones are rejected with 429"
+)
+parser.add_argument(
+    "-config_path", required=False, default="config.json", type=str,
+    help="Path to config with the OpenAI API key and default hparams"
+)
+parser.add_argument(
+    "-provider", required=False, choices=LLM_PROVIDERS, default=LLM_PROVIDER, type=str,
+    help="LLM backend: OpenAI, deterministic offline responses, or responses recorded to/replayed from a cassette"
+)
+parser.add_argument(
+    "-cassette_path", required=False, type=str, help="Path to a cassette file for record and replay providers"
+)
+parser.add_argument(
+    "-offline_seed", required=False, type=int, default=0, help="Seed of the offline provider"
+)
+
+
+class RequestError(Exception):
+    """Invalid request, answered with a 400 status."""
+
+
+def is_integer(value) -> bool:
+    """Returns True for JSON integers, which excludes booleans although they are ints in Python."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_secret_key(value) -> list:
+    """Returns a secret key sent either in the JSON layout or base64 encoded in the compact binary format."""
+    if isinstance(value, str):
+        try:
+            data = b64decode(value, validate=True)
+        except BinasciiError:
+            raise RequestError("secret_key should be a JSON secret key or a base64 encoded compact secret key")
+        if not is_compact_secret_key(data):
+            raise RequestError("secret_key is not a compact secret key")
+        try:
+            return loads_secret_key(data)
+        except ValueError as e:
+            raise RequestError(f"secret_key is corrupted: {e}")
+
+    if not is_secret_key_valid(value):
+        raise RequestError("secret_key is empty or invalid")
+    return value
+
+
+def format_secret_key(secret_key: list, secret_key_format: str):
+    if secret_key_format == "compact":
+        return b64encode(dumps_secret_key(secret_key)).decode("ascii")
+    return secret_key
+
+
+def encode(
+    message: str,
+    bits_per_word: int,
+    additional_bits: int,
+    binarize: bool,
+    container: str | None,
+    seed: int | None,
+    secret_key_format: str,
+) -> dict:
+    container, encoded_message, secret_key, time_report, usage_report = core.encode_message(
+        message,
+        bits_per_word=bits_per_word,
+        additional_bits=additional_bits,
+        binarize=binarize,
+        container=container,
+        seed=seed,
+    )
+    return {
+        "container": container,
+        "encoded_message": encoded_message,
+        "secret_key": format_secret_key(secret_key, secret_key_format),
+        "secret_key_format": secret_key_format,
+        "bits_per_word": bits_per_word,
+        "additional_bits": additional_bits,
+        "model": get_model_name(),
+        "time_report": time_report,
+        "usage_report": usage_report,
+    }
+
+
+def decode(container: str, secret_key: list, clean_output: bool) -> dict:
+    decoded_message, spent_time = core.decode_message(container, secret_key, clean_output)
+    return {"decoded_message": decoded_message, "decoding_time": spent_time}
+
+
+def get_job_response(job: Job) -> dict:
+    response = {"job_id": job.id, "kind": job.kind, "status": job.status, "elapsed": round(job.elapsed, 4)}
+    if job.status == JobStatus.DONE:
+        response["result"] = job.result
+    elif job.status == JobStatus.FAILED:
+        response["error"] = job.error
+    return response
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self, job_manager: JobManager, config: Config | None = None):
+        self.job_manager = job_manager
+        self.config = config
+
+    def write_json(self, data: dict, status: int = 200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(data))
+
+    def write_error(self, status_code: int, **kwargs):
+        error = kwargs["exc_info"][1] if "exc_info" in kwargs else None
+        if isinstance(error, tornado.web.HTTPError) and error.log_message:
+            message = error.log_message
+        else:
+            message = self._reason
+        self.write_json({"error": message}, status_code)
+
+    def get_body(self) -> dict:
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except json.JSONDecodeError as e:
+            raise RequestError(f"Invalid JSON: {e}")
+        if not isinstance(body, dict):
+            raise RequestError("Request body should be a JSON object")
+        return body
+
+    async def run_job(self, kind: str, function, *args):
+        """Answer with the result, or with the job id if the request asked not to wait."""
+        wait = self.get_argument("wait", "true").lower() != "false"
+        try:
+            job = self.job_manager.submit(kind, function, *args)
+        except RuntimeError as e:
+            self.set_header("Retry-After", "1")
+            self.write_json({"error": str(e)}, 429)
+            return
+
+        if not wait:
+            self.set_header("Location", f"/jobs/{job.id}")
+            self.write_json(get_job_response(job), 202)
+            return
+
+        await asyncio.wrap_future(job.future)
+        if job.status == JobStatus.FAILED:
+            self.write_json({"job_id": job.id, "error": job.error}, 500)
+        else:
+            self.write_json(job.result)
+
+
+class EncodeHandler(BaseHandler):
+    async def post(self):
+        try:
+            body = self.get_body()
+            message = body.get("message")
+            if not isinstance(message, str) or not message:
+                raise RequestError("message should be a non-empty string")
+
+            bits_per_word = body.get("bits_per_word", self.config.bits_per_word if self.config else None)
+            additional_bits = body.get("additional_bits", self.config.additional_bits if self.config else 0)
+            if not is_integer(bits_per_word) or not 0 < bits_per_word <= MAX_BITS_PER_WORD:
+                raise RequestError(f"bits_per_word should be an integer from 1 to {MAX_BITS_PER_WORD}")
+            if not is_integer(additional_bits) or additional_bits < 0 or \
+                    additional_bits + bits_per_word > bits_per_word * MAX_ADDITIONAL_BITS_MULTIPLIER:
+                raise RequestError("Too many additional bits")
+
+            binarize = body.get("binarize", True)
+            if not isinstance(binarize, bool):
+                raise RequestError("binarize should be a boolean")
+            if binarize and not message.isascii():
+                raise RequestError("message should be ASCII text when binarize is true")
+            if not binarize and message.strip("01"):
+                raise RequestError("message should consist of '0' and '1' when binarize is false")
+            if not isinstance(body.get("container"), (str, type(None))):
+                raise RequestError("container should be a string")
+            if body.get("seed") is not None and not is_integer(body["seed"]):
+                raise RequestError("seed should be an integer")
+            secret_key_format = body.get("secret_key_format", "compact")
+            if secret_key_format not in SECRET_KEY_FORMATS:
+                raise RequestError(f"secret_key_format should be in {SECRET_KEY_FORMATS}")
+        except RequestError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        await self.run_job(
+            Procedures.ENCODING, encode, message, bits_per_word, additional_bits, binarize,
+            body.get("container"), body.get("seed"), secret_key_format
+        )
+
+
+class DecodeHandler(BaseHandler):
+    async def post(self):
+        try:
+            body = self.get_body()
+            container = body.get("container")
+            if not isinstance(container, str) or not container:
+                raise RequestError("container should be a non-empty string")
+            secret_key = parse_secret_key(body.get("secret_key"))
+            clean_output = body.get("clean_output", True)
+            if not isinstance(clean_output, bool):
+                raise RequestError("clean_output should be a boolean")
+        except RequestError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        await self.run_job(Procedures.DECODING, decode, container, secret_key, clean_output)
+
+
+class JobHandler(BaseHandler):
+    def get(self, job_id: str):
+        job = self.job_manager.get(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404, f"Unknown job {job_id}")
+        self.write_json(get_job_response(job))
+
+
+class HealthHandler(BaseHandler):
+    def get(self):
+        self.write_json({"status": "ok", "pending": self.job_manager.get_pending()})
+
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(get_registry().to_prometheus())
+
+
+def make_app(job_manager: JobManager, config: Config | None = None) -> tornado.web.Application:
+    handler_args = {"job_manager": job_manager, "config": config}
+    return tornado.web.Application([
+        (r"/encode", EncodeHandler, handler_args),
+        (r"/decode", DecodeHandler, handler_args),
+        (r"/jobs/([0-9a-f-]+)", JobHandler, handler_args),
+        (r"/health", HealthHandler, handler_args),
+        (r"/metrics", MetricsHandler, handler_args),
+    ])
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    _config = None
+    if os.path.exists(args.config_path):
+        _config = Config.from_json(args.config_path)
+        os.environ["OPENAI_API_KEY"] = _config.openai_api_key
+    assert _config is not None or args.provider in ["offline", "replay"], f"config is required for {args.provider}"
+    set_provider(create_provider(args.provider, cassette_path=args.cassette_path, seed=args.offline_seed))
+    load_planner(**(_config.planner if _config is not None else {}))
+
+    app = make_app(JobManager(max_workers=args.workers, max_pending=args.max_pending), _config)
+    app.listen(args.port, max_body_size=SERVICE_MAX_BODY_SIZE)
+    LOGGER.info(f"Serving the API on port {args.port} with {args.workers} workers")
+    tornado.ioloop.IOLoop.current().start()
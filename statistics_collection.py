@@ -1,5 +1,10 @@
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import json
 import random
+import signal
+import threading
 from uuid import uuid4
 import os
 
@@ -7,38 +12,217 @@ from tqdm import tqdm
 from glob import glob
 
 from steganography import core
+from steganography.gpt import get_model_name
+from steganography.planner import load_planner
 from models.report import ReportModel
 from models.config import Config
 from utils.logger import get_logger
-from utils.constants import MAX_BITS_PER_WORD, MAX_ADDITIONAL_BITS_MULTIPLIER
+from utils.metrics import dump_metrics, start_metrics_server
+from utils.report_store import ReportStore
+from utils.tracing import configure_tracing, trace
+from utils.constants import MAX_BITS_PER_WORD, MAX_ADDITIONAL_BITS_MULTIPLIER, Procedures
+from utils.database import MongoDB
+from utils.job_queue import JobQueue
 
 LOGGER = get_logger(__name__)
 BASE_PATH = "reports/gpt_omni_reports"
+MANIFEST_NAME = "manifest.json"
+METRICS_NAME = "metrics.json"
 MESSAGE_LENGTHS = [128, 256, 512]
 N_ITERATIONS = 100
+CONCURRENCY = 4
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "-base_path", required=False, default=BASE_PATH, type=str, help="Path to folder for JSON reports"
+)
+parser.add_argument(
+    "-config_path", required=False, default="config.json", type=str, help="Path to config with hparams"
+)
+parser.add_argument(
+    "-n_iterations", required=False, default=N_ITERATIONS, type=int, help="Number of reports per message length"
+)
+parser.add_argument(
+    "-stream", required=False, action="store_true", help="Stream containers and overlap synonym generation"
+)
+parser.add_argument(
+    "-concurrency", required=False, default=CONCURRENCY, type=int, help="Number of iterations running at once"
+)
+parser.add_argument(
+    "-store_path", required=False, type=str,
+    help="Path to a Parquet report store to append reports to instead of writing JSON files"
+)
+parser.add_argument(
+    "-run_id", required=False, type=str, help="Run partition of the report store, defaults to the start time"
+)
+parser.add_argument(
+    "-enqueue", required=False, action="store_true",
+    help="Add the iterations as jobs to the MongoDB job queue for queue_worker.py instead of running them"
+)
+parser.add_argument(
+    "-metrics_port", required=False, type=int, help="Port to serve Prometheus metrics on while collecting"
+)
 
 
 def get_random_message(n: int) -> str:
     return "".join(str(random.randint(0, 1)) for _ in range(n))
 
 
-def get_number_of_iterations_for_message_length(message_len: int):
-    iterations_left = 0
-    for item in glob(f"{BASE_PATH}/*.json"):
-        with open(item) as f:
-            report_data = json.load(f)
-            if len(report_data["message"]) == message_len:
-                iterations_left += 1
-    return iterations_left
+class Manifest:
+    """
+    Progress index of a statistics collection run.
+
+    Keeps the number of finished reports per message length in a small JSON file next to the reports,
+    so resuming a run does not need to read every report. The file is rewritten atomically after every
+    finished report. If it does not exist yet, it is built once from the reports already on disk, skipping
+    other JSON files of the folder such as metrics.json.
+    """
+
+    def __init__(self, base_path: str):
+        self.path = os.path.join(base_path, MANIFEST_NAME)
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.counts = {int(k): v for k, v in json.load(f)["counts"].items()}
+        else:
+            self.counts = {}
+            for item in glob(f"{base_path}/*.json"):
+                with open(item) as f:
+                    report = json.load(f)
+                if not isinstance(report, dict) or "message" not in report:
+                    continue
+                message_length = len(report["message"])
+                self.counts[message_length] = self.counts.get(message_length, 0) + 1
+            self._dump()
+
+    def get(self, message_length: int) -> int:
+        return self.counts.get(message_length, 0)
+
+    def record(self, message_length: int):
+        """Count a finished report and persist the manifest."""
+        with self._lock:
+            self.counts[message_length] = self.get(message_length) + 1
+            self._dump()
+
+    def _dump(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"counts": {str(k): v for k, v in sorted(self.counts.items())}}, f)
+        os.replace(tmp_path, self.path)
+
+
+def run_iteration(message_length: int, bits_per_word: int, additional_bits: int, stream: bool = False) -> ReportModel:
+    """Encode and decode one random message and return its report."""
+    message = get_random_message(message_length)
+    request_uuid = str(uuid4())
+
+    with trace(request_uuid):
+        container, encoded_message, secret_key, time_report, usage_report = core.encode_message(
+            message,
+            bits_per_word=bits_per_word,
+            additional_bits=additional_bits,
+            binarize=False,
+            stream=stream,
+        )
+
+        decoded_message, spent_time = core.decode_message(
+            encoded_message,
+            secret_key,
+            clean_output=False
+        )
+
+    return ReportModel(
+        uuid=request_uuid,
+        message=message,
+        encoded_message=encoded_message,
+        encoding_time_report=time_report,
+        encoding_usage_report=usage_report,
+        secret_key=secret_key,
+        container=container,
+        decoding_time=spent_time,
+        decoded_message=decoded_message,
+        bits_per_word=bits_per_word,
+        additional_bits=additional_bits,
+        model=get_model_name(),
+    )
+
+
+def run(
+    base_path: str,
+    message_lengths: list[int],
+    n_iterations: int,
+    bits_per_word: int,
+    additional_bits: int,
+    concurrency: int,
+    stop_event: threading.Event,
+    stream: bool = False,
+    store: ReportStore | None = None,
+):
+    """
+    Collect reports until every message length has n_iterations of them, keeping `concurrency` iterations
+    in flight. Setting stop_event stops submitting new iterations and waits for the running ones, while an
+    exception such as KeyboardInterrupt abandons them. Reports are written as JSON files to base_path, or
+    appended to the store if one is given. Stored reports are counted in the manifest once they are flushed,
+    which also happens when the run is aborted.
+    """
+    manifest = Manifest(base_path)
+    pending = deque(
+        message_length
+        for message_length in message_lengths
+        for _ in range(max(n_iterations - manifest.get(message_length), 0))
+    )
+    LOGGER.info(f"{len(pending)} iterations left: {[(m, manifest.get(m)) for m in message_lengths]}")
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        with tqdm(total=len(pending)) as progress:
+            in_flight = {}
+            while (pending and not stop_event.is_set()) or in_flight:
+                while pending and len(in_flight) < concurrency and not stop_event.is_set():
+                    message_length = pending.popleft()
+                    future = executor.submit(run_iteration, message_length, bits_per_word, additional_bits, stream)
+                    in_flight[future] = message_length
+
+                done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    message_length = in_flight.pop(future)
+                    try:
+                        report = future.result()
+                    except Exception as e:
+                        LOGGER.exception(f"Iteration for {message_length} message length failed: {e}")
+                        continue
+
+                    if store is None:
+                        report.to_json(base_path)
+                        manifest.record(message_length)
+                    else:
+                        for written_report in store.add(report):
+                            manifest.record(len(written_report.message))
+                    progress.update(1)
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    else:
+        executor.shutdown()
+    finally:
+        if store is not None:
+            for written_report in store.flush():
+                manifest.record(len(written_report.message))
 
 
 if __name__ == "__main__":
-    _config = Config.from_json("config.json")
+    args = parser.parse_args()
+
+    _config = Config.from_json(args.config_path)
     os.environ["OPENAI_API_KEY"] = _config.openai_api_key
+    # Profiles are captured by local_runner.py only, as iterations run concurrently
+    configure_tracing(enabled=_config.tracing.get("enabled", False), output_path=_config.tracing.get("output_path"))
     LOGGER.info("Config setup successfully!")
 
-    os.makedirs(BASE_PATH, exist_ok=True)
-    LOGGER.info(f"Created {BASE_PATH} local database")
+    os.makedirs(args.base_path, exist_ok=True)
+    LOGGER.info(f"Created {args.base_path} local database")
 
     bits_per_word = min(_config.bits_per_word, MAX_BITS_PER_WORD)
 
@@ -46,39 +230,55 @@ if __name__ == "__main__":
     assert _config.additional_bits + bits_per_word <= bits_per_word * MAX_ADDITIONAL_BITS_MULTIPLIER, msg
     LOGGER.info(f"Working with: {bits_per_word} and {_config.additional_bits} additional bits per word.")
 
-    for message_length in MESSAGE_LENGTHS:
-        n_iterations = get_number_of_iterations_for_message_length(message_length)
-
-        LOGGER.info(f"Processing {message_length} message length")
-        for iteration in tqdm(range(N_ITERATIONS - n_iterations)):
-            message = get_random_message(message_length)
-            request_uuid = str(uuid4())
-
-            container, encoded_message, secret_key, time_report, usage_report = core.encode_message(
-                message,
-                bits_per_word=_config.bits_per_word,
-                additional_bits=_config.additional_bits,
-                binarize=False
-            )
-            
-            decoded_message, spent_time = core.decode_message(
-                encoded_message, 
-                secret_key, 
-                clean_output=False
-            )
-
-            report = ReportModel(
-                uuid=request_uuid,
-                message=message,
-                encoded_message=encoded_message,
-                encoding_time_report=time_report,
-                encoding_usage_report=usage_report,
-                secret_key=secret_key,
-                container=container,
-                decoding_time=spent_time,
-                decoded_message=decoded_message
-            )
-
-            report.to_json(BASE_PATH)
-
-    LOGGER.info("All processes finished!")
+    # Containers are sized from the reports collected so far, unless the config points to other reports
+    load_planner(**{"reports_path": args.base_path, "store_path": args.store_path, **_config.planner})
+
+    if args.enqueue:
+        job_queue = JobQueue(MongoDB(**_config.mongodb))
+        jobs = job_queue.enqueue_many(Procedures.ENCODING, [
+            {
+                "message": get_random_message(message_length),
+                "binarize": False,
+                "bits_per_word": bits_per_word,
+                "additional_bits": _config.additional_bits,
+                "stream": args.stream,
+                "verify": True,
+            }
+            for message_length in MESSAGE_LENGTHS
+            for _ in range(args.n_iterations)
+        ])
+        LOGGER.info(f"Added {len(jobs)} encoding jobs to the queue, run queue_worker.py to process them")
+        raise SystemExit(0)
+
+    stop_event = threading.Event()
+
+    def handle_sigint(signum, frame):
+        if stop_event.is_set():  # Second Ctrl+C interrupts immediately
+            raise KeyboardInterrupt
+        LOGGER.warning("Interrupted, waiting for running iterations to finish. Press Ctrl+C again to abort.")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handle_sigint)
+
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
+
+    try:
+        run(
+            args.base_path,
+            MESSAGE_LENGTHS,
+            args.n_iterations,
+            _config.bits_per_word,
+            _config.additional_bits,
+            args.concurrency,
+            stop_event,
+            args.stream,
+            ReportStore(args.store_path, args.run_id) if args.store_path else None,
+        )
+    except KeyboardInterrupt:
+        dump_metrics(os.path.join(args.base_path, METRICS_NAME))
+        LOGGER.warning("Aborted, finished reports are saved and running iterations are discarded.")
+        os._exit(130)  # Threads of running iterations would otherwise be joined at interpreter exit
+
+    dump_metrics(os.path.join(args.base_path, METRICS_NAME))
+    LOGGER.info("All processes finished!" if not stop_event.is_set() else "Stopped, progress saved.")
@@ -0,0 +1,130 @@
+from steganography.helper import clean_container, remove_brackets
+from steganography.providers import get_rough_token_count
+from models.pool_arguments import PoolArguments
+from utils import prompts
+from utils.constants import (
+    CONTAINER_SPLIT_SIZE,
+    SYNONYM_TOKENS,
+    SYNONYMS_BATCH_MAX_OUTPUT_TOKENS,
+    SYNONYMS_BATCH_MAX_TOKENS,
+    SYNONYMS_BATCH_MAX_WORDS,
+)
+
+
+def get_prompt_tokens(bits_per_word: int) -> int:
+    """Returns the estimated number of tokens of the synonyms system prompt repeated by every request."""
+    return get_rough_token_count(prompts.ALL_SYNONYMS_GENERATION_PROMPT.replace("N_SYNONYMS", str(2**bits_per_word)))
+
+
+def estimate_split_tokens(pool_arguments: PoolArguments) -> (int, int):
+    """Returns the estimated input and output tokens a container split adds to a synonyms request."""
+    words = pool_arguments.container_split
+    input_tokens = get_rough_token_count(str(words))
+    output_tokens = sum(get_rough_token_count(w) + 2**pool_arguments.bits_per_word * SYNONYM_TOKENS for w in words)
+    return input_tokens, output_tokens
+
+
+def pack_pool_arguments(
+    pool_arguments: list[PoolArguments],
+    max_tokens: int = SYNONYMS_BATCH_MAX_TOKENS,
+    max_output_tokens: int = SYNONYMS_BATCH_MAX_OUTPUT_TOKENS,
+    max_words: int = SYNONYMS_BATCH_MAX_WORDS,
+) -> list[list[PoolArguments]]:
+    """
+    Pack consecutive container splits into batches sent as one synonyms request each.
+
+    Only neighbouring splits are packed together, so every word keeps its original context and gets the
+    following words as additional context. A batch is closed once the next split would exceed the
+    estimated token budget, the completion limit or the number of words per request.
+
+    Args:
+        pool_arguments (list[PoolArguments]): Container splits in container order.
+        max_tokens (int, optional): Estimated prompt and completion tokens of one request.
+        max_output_tokens (int, optional): Estimated completion tokens of one request.
+        max_words (int, optional): Maximum number of words in one request.
+
+    Returns:
+        list[list[PoolArguments]]: Batches of container splits in container order.
+    """
+    batches, batch = [], []
+    tokens = output_tokens = words = 0
+
+    for split in pool_arguments:
+        if isinstance(split.container_split, str):  # Raw text splits cannot be de-multiplexed by words
+            if batch:
+                batches.append(batch)
+            batches.append([split])
+            batch, tokens, output_tokens, words = [], 0, 0, 0
+            continue
+
+        split_input, split_output = estimate_split_tokens(split)
+        if batch and (
+            split.bits_per_word != batch[0].bits_per_word
+            or tokens + split_input + split_output > max_tokens
+            or output_tokens + split_output > max_output_tokens
+            or words + len(split.container_split) > max_words
+        ):
+            batches.append(batch)
+            batch, tokens, output_tokens, words = [], 0, 0, 0
+
+        if not batch:
+            tokens = get_prompt_tokens(split.bits_per_word)
+        batch.append(split)
+        tokens += split_input + split_output
+        output_tokens += split_output
+        words += len(split.container_split)
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def merge_pool_arguments(batch: list[PoolArguments]) -> PoolArguments:
+    """Returns the pool arguments of a single request covering all splits of the batch."""
+    if len(batch) == 1:
+        return batch[0]
+    return PoolArguments(
+        container_split=[word for split in batch for word in split.container_split],
+        bits_per_word=batch[0].bits_per_word,
+    )
+
+
+def _normalize_word(word: str) -> str:
+    return clean_container(remove_brackets(str(word))).strip().lower()
+
+
+def demultiplex_synonyms(
+    splits: list[list[str]], synonyms: list[dict], lookahead: int = CONTAINER_SPLIT_SIZE
+) -> list[list[dict]]:
+    """
+    Distribute the `words` array of a batched response back to the container splits it was requested for.
+
+    Entries are matched to container words in order. The model skips numbers and may drop a word, so an
+    entry is matched against the next `lookahead` words. An entry that matches none of them is assigned to
+    the current word, as the model changed its spelling.
+
+    Args:
+        splits (list[list[str]]): Words of every split of the batch in container order.
+        synonyms (list[dict]): The [{word: [synonyms]}] response of the batched request.
+        lookahead (int, optional): Number of words an entry is matched against. Defaults to CONTAINER_SPLIT_SIZE.
+
+    Returns:
+        list[list[dict]]: Synonym entries of every split.
+    """
+    positions = [(idx, _normalize_word(word)) for idx, split in enumerate(splits) for word in split]
+    results, cursor = [[] for _ in splits], 0
+
+    for entry in synonyms:
+        if not isinstance(entry, dict) or not entry or not positions:
+            continue
+
+        word = _normalize_word(next(iter(entry)))
+        window = range(cursor, min(cursor + lookahead, len(positions)))
+        match = next((p for p in window if positions[p][1] == word), None)
+        if match is None:
+            match = min(cursor, len(positions) - 1)
+
+        results[positions[match][0]].append(entry)
+        cursor = match + 1
+
+    return results
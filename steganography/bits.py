@@ -0,0 +1,169 @@
+from functools import lru_cache
+
+import numpy as np
+
+from utils.constants import N_ASCII_BITS
+
+MAX_CODE_TABLE_WIDTH = 16
+
+
+@lru_cache(maxsize=None)
+def get_codes(width: int) -> tuple[str, ...] | None:
+    """Returns all binary codes of the given width, or None if the table would be too large to keep."""
+    if width > MAX_CODE_TABLE_WIDTH:
+        return None
+    if not width:
+        return ("",)
+    return tuple(format(i, f"0{width}b") for i in range(2**width))
+
+
+def format_code(value: int, width: int) -> str:
+    """Returns the binary code string of an integer code of the given width."""
+    codes = get_codes(width)
+    return codes[value] if codes is not None else format(value, f"0{width}b")
+
+
+class BitBuffer:
+    """
+    Immutable sequence of bits packed into bytes, most significant bit first.
+
+    Bits are read as integers by offset and width without unpacking the buffer. Conversion from and to
+    '0'/'1' strings goes through NumPy `packbits`/`unpackbits` and is only needed at the API edge.
+    """
+
+    __slots__ = ("data", "length")
+
+    def __init__(self, data: bytes = b"", length: int | None = None):
+        self.data = bytes(data)
+        self.length = len(self.data) * 8 if length is None else length
+        assert 0 <= self.length <= len(self.data) * 8, "Bit length does not fit the data"
+
+    @classmethod
+    def from_str(cls, bits: str) -> "BitBuffer":
+        """Pack a string of '0' and '1' characters."""
+        array = np.frombuffer(bits.encode("ascii"), dtype=np.uint8) - ord("0")
+        if array.size and array.max() > 1:
+            raise ValueError("Binary string can only contain '0' and '1' characters")
+        return cls(np.packbits(array).tobytes(), len(bits))
+
+    @classmethod
+    def from_text(cls, text: str) -> "BitBuffer":
+        """Pack the bits of an ASCII-encoded message."""
+        return cls(text.encode("ascii"))
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "BitBuffer":
+        """Pack an array of 0 and 1 values."""
+        return cls(np.packbits(array.astype(np.uint8, copy=False)).tobytes(), len(array))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, BitBuffer):
+            return NotImplemented
+        return self.length == other.length and self.to_array().tobytes() == other.to_array().tobytes()
+
+    def __repr__(self) -> str:
+        return f"BitBuffer({self.to_str()!r})" if self.length <= 64 else f"BitBuffer(<{self.length} bits>)"
+
+    def __getitem__(self, item: int | slice) -> "int | BitBuffer":
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.length)
+            if step == 1:
+                return BitBuffer.from_array(self.to_array()[start:max(start, stop)])
+            return BitBuffer.from_array(self.to_array()[start:stop:step])
+
+        if item < 0:
+            item += self.length
+        if not 0 <= item < self.length:
+            raise IndexError("Bit index out of range")
+        return (self.data[item >> 3] >> (7 - (item & 7))) & 1
+
+    def read(self, offset: int, width: int) -> int:
+        """
+        Read bits as an unsigned integer.
+
+        Args:
+            offset (int): Offset of the first bit.
+            width (int): Number of bits to read.
+
+        Returns:
+            int: The bits from offset to offset + width, the first one being the most significant.
+
+        Raises:
+            IndexError: If the bits are out of the buffer.
+        """
+        if offset < 0 or width < 0 or offset + width > self.length:
+            raise IndexError("Bit range out of range")
+        if not width:
+            return 0
+
+        start, end = offset >> 3, (offset + width + 7) >> 3
+        chunk = int.from_bytes(self.data[start:end], "big")
+        return (chunk >> ((end << 3) - offset - width)) & ((1 << width) - 1)
+
+    def read_code(self, offset: int, width: int) -> str:
+        """Read bits as a binary code string as used by secret key mappings."""
+        return format_code(self.read(offset, width), width)
+
+    def to_array(self) -> np.ndarray:
+        """Returns the bits as an array of 0 and 1 values."""
+        return np.unpackbits(np.frombuffer(self.data, dtype=np.uint8), count=self.length)
+
+    def to_str(self) -> str:
+        """Returns the bits as a string of '0' and '1' characters."""
+        return (self.to_array() + ord("0")).tobytes().decode("ascii")
+
+    def to_text(self) -> str:
+        """
+        Decode the bits as text.
+
+        The bits are right-aligned to whole bytes and leading zero bytes are dropped, so padding bits
+        before the message do not produce characters.
+        """
+        padding = -self.length % N_ASCII_BITS
+        if padding:
+            array = np.concatenate((np.zeros(padding, dtype=np.uint8), self.to_array()))
+            data = np.packbits(array).tobytes()
+        else:
+            data = self.data[:self.length >> 3]
+        return data.lstrip(b"\x00").decode()
+
+
+class BitWriter:
+    """Appends integer codes of varying width and packs them into a BitBuffer."""
+
+    __slots__ = ("_data", "_accumulator", "_n_pending", "length")
+
+    def __init__(self):
+        self._data = bytearray()
+        self._accumulator, self._n_pending = 0, 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def write(self, value: int, width: int):
+        """Append the width lowest bits of value, most significant first."""
+        self._accumulator = (self._accumulator << width) | value
+        self._n_pending += width
+        self.length += width
+
+        n_bytes = self._n_pending >> 3
+        if n_bytes:
+            self._n_pending -= n_bytes << 3
+            self._data += (self._accumulator >> self._n_pending).to_bytes(n_bytes, "big")
+            self._accumulator &= (1 << self._n_pending) - 1
+
+    def write_code(self, code: str):
+        """Append a binary code string."""
+        if code:
+            self.write(int(code, 2), len(code))
+
+    def to_buffer(self) -> BitBuffer:
+        """Returns the bits written so far."""
+        data = bytes(self._data)
+        if self._n_pending:
+            data += (self._accumulator << (8 - self._n_pending)).to_bytes(1, "big")
+        return BitBuffer(data, self.length)
@@ -0,0 +1,192 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from hashlib import sha256
+
+from utils import constants
+from utils.constants import (
+    SYNONYM_CACHE_MAX_AGE,
+    SYNONYM_CACHE_MAX_BYTES,
+    SYNONYM_CACHE_MAX_ENTRIES,
+    SYNONYM_CACHE_PATH,
+    SYNONYM_CACHE_TOUCH_INTERVAL,
+)
+from utils.prompts import PROMPT_VERSION
+
+
+class SynonymCache:
+    """
+    Disk-backed, content-addressed cache for generated synonym maps.
+
+    Entries are stored in a local SQLite file and keyed by a hash of the container split, the prompt version,
+    the model name and the bit width. Entries older than `max_age` seconds are dropped on read, and the least
+    recently used entries are evicted once `max_entries` or `max_bytes` is exceeded. Triggers keep the number
+    and size of entries in the `counters` table, so limits are checked without scanning entries. Hits are
+    read-only: the access time is refreshed at most every `touch_interval` seconds and hit/miss counters are
+    persisted with the next write.
+    """
+
+    def __init__(
+        self,
+        path: str = SYNONYM_CACHE_PATH,
+        max_entries: int = SYNONYM_CACHE_MAX_ENTRIES,
+        max_bytes: int = SYNONYM_CACHE_MAX_BYTES,
+        max_age: float = SYNONYM_CACHE_MAX_AGE,
+        touch_interval: float = SYNONYM_CACHE_TOUCH_INTERVAL,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.touch_interval = touch_interval
+        self.hits, self.misses = 0, 0
+        self._pending = {"hits": 0, "misses": 0}
+
+        self._lock = threading.Lock()
+        self._connection, self._pid = None, None
+
+    @staticmethod
+    def make_key(container_split: str | list[str], model: str, bits_per_word: int) -> str:
+        """Returns the cache key of a container split for the given model and bit width."""
+        payload = json.dumps([container_split, PROMPT_VERSION, model, bits_per_word])
+        return sha256(payload.encode("utf-8")).hexdigest()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():  # Connections must not cross a fork
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._pid = os.getpid()
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS synonyms (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS synonyms_accessed ON synonyms (accessed);
+                CREATE INDEX IF NOT EXISTS synonyms_created ON synonyms (created);
+                CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+
+                BEGIN IMMEDIATE;
+                INSERT OR IGNORE INTO counters (name, value) SELECT 'entries', COUNT(*) FROM synonyms;
+                INSERT OR IGNORE INTO counters (name, value) SELECT 'size', COALESCE(SUM(size), 0) FROM synonyms;
+                CREATE TRIGGER IF NOT EXISTS synonyms_insert AFTER INSERT ON synonyms BEGIN
+                    UPDATE counters SET value = value + 1 WHERE name = 'entries';
+                    UPDATE counters SET value = value + new.size WHERE name = 'size';
+                END;
+                CREATE TRIGGER IF NOT EXISTS synonyms_delete AFTER DELETE ON synonyms BEGIN
+                    UPDATE counters SET value = value - 1 WHERE name = 'entries';
+                    UPDATE counters SET value = value - old.size WHERE name = 'size';
+                END;
+                CREATE TRIGGER IF NOT EXISTS synonyms_update AFTER UPDATE OF size ON synonyms BEGIN
+                    UPDATE counters SET value = value + new.size - old.size WHERE name = 'size';
+                END;
+                COMMIT;
+            """)
+        return self._connection
+
+    def _flush_counters(self):
+        for name, value in self._pending.items():
+            if value:
+                self.connection.execute(
+                    "INSERT INTO counters (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    (name, value)
+                )
+                self._pending[name] = 0
+
+    def _get_totals(self) -> tuple[int, int]:
+        counters = dict(self.connection.execute(
+            "SELECT name, value FROM counters WHERE name IN ('entries', 'size')"
+        ).fetchall())
+        return counters["entries"], counters["size"]
+
+    def get(self, key: str) -> list[dict] | None:
+        """Returns cached synonyms for the key or None, counting the lookup as a hit or a miss."""
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value, created, accessed FROM synonyms WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.max_age:
+                with self.connection:
+                    self.connection.execute("DELETE FROM synonyms WHERE key = ?", (key,))
+                    self._flush_counters()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                self._pending["misses"] += 1
+                return None
+
+            self.hits += 1
+            self._pending["hits"] += 1
+            if now - row[2] > self.touch_interval:
+                with self.connection:
+                    self.connection.execute("UPDATE synonyms SET accessed = ? WHERE key = ?", (now, key))
+                    self._flush_counters()
+            return json.loads(row[0])
+
+    def put(self, key: str, synonyms: list[dict]):
+        """Store synonyms under the key and evict entries exceeding the size or age limits."""
+        now = time.time()
+        value = json.dumps(synonyms)
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO synonyms (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                "created = excluded.created, accessed = excluded.accessed",
+                (key, value, len(value), now, now)
+            )
+            self._flush_counters()
+            self._evict(now)
+
+    def _evict(self, now: float):
+        self.connection.execute("DELETE FROM synonyms WHERE created < ?", (now - self.max_age,))
+        entries, size = self._get_totals()
+        while entries > self.max_entries or size > self.max_bytes:
+            # Enough of the least recently used entries for the entry limit, and for the byte limit by average size
+            excess = max(entries - self.max_entries, -(-(size - self.max_bytes) * entries // max(size, 1)), 1)
+            deleted = self.connection.execute(
+                "DELETE FROM synonyms WHERE key IN (SELECT key FROM synonyms ORDER BY accessed LIMIT ?)", (excess,)
+            ).rowcount
+            if not deleted:
+                break
+            entries, size = self._get_totals()
+
+    def stats(self) -> dict[str, int]:
+        """Returns persisted hit/miss counters together with the current number and size of entries."""
+        with self._lock:
+            with self.connection:
+                self._flush_counters()
+            counters = dict(self.connection.execute("SELECT name, value FROM counters").fetchall())
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "entries": counters["entries"],
+            "size": counters["size"],
+        }
+
+    def clear(self):
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM synonyms")
+            self.connection.execute("DELETE FROM counters WHERE name IN ('hits', 'misses')")
+            self._pending = {"hits": 0, "misses": 0}
+
+
+_cache: SynonymCache | None = None
+
+
+def get_synonym_cache() -> SynonymCache | None:
+    """Returns the process-wide synonym cache or None if caching is disabled."""
+    global _cache
+    if not constants.SYNONYM_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        _cache = SynonymCache()
+    return _cache
@@ -0,0 +1,106 @@
+import numpy as np
+
+from steganography.bits import format_code
+
+RandomGenerator = np.random.Generator
+
+
+def get_rng(rng: RandomGenerator | int | None = None) -> RandomGenerator:
+    """Returns a random generator, seeding a new one from an integer or from OS entropy when None."""
+    if isinstance(rng, RandomGenerator):
+        return rng
+    return np.random.default_rng(rng)
+
+
+def _draw_values(width: int, n: int, rng: RandomGenerator) -> list[int]:
+    """Draw n independent, possibly repeated width-bit values."""
+    if width <= 63:
+        return rng.integers(0, 1 << width, size=n, dtype=np.uint64).tolist()
+
+    n_bytes, excess = (width + 7) // 8, -width % 8
+    data = rng.bytes(n_bytes * n)
+    return [int.from_bytes(data[i:i + n_bytes], "big") >> excess for i in range(0, len(data), n_bytes)]
+
+
+def draw_distinct_codes(width: int, n: int, rng: RandomGenerator | None = None) -> list[int]:
+    """
+    Draw n distinct width-bit codes in random order.
+
+    Sparse draws are rejection sampled, so the work is proportional to n and not to the 2**width code
+    space, and widths beyond 64 bits are drawn from random bytes. Draws covering more than half of the
+    space take a prefix of a permutation of the space, which is then at most 2 * n large.
+
+    Args:
+        width (int): Number of bits of a code.
+        n (int): Number of codes to draw.
+        rng (np.random.Generator, optional): Random generator. Defaults to a generator seeded from OS entropy.
+
+    Returns:
+        list[int]: The codes as integers.
+
+    Raises:
+        ValueError: If there are fewer than n codes of the given width.
+    """
+    rng = get_rng(rng)
+    if n > 1 << width:
+        raise ValueError(f"Cannot draw {n} distinct codes of {width} bits")
+    if 2 * n > 1 << width:
+        return rng.permutation(1 << width)[:n].tolist()
+
+    codes, seen = [], set()
+    while len(codes) < n:
+        for value in _draw_values(width, n - len(codes), rng):
+            if value not in seen:
+                seen.add(value)
+                codes.append(value)
+    return codes
+
+
+def assign_sequential_codes(synonyms: list[str]) -> dict[str, str]:
+    """Assign codes 0, 1, 2, ... of width log2(len(synonyms)) to synonyms in order, dropping the rest."""
+    width = len(synonyms).bit_length() - 1
+    return {format_code(idx, width): synonym for idx, synonym in enumerate(synonyms[:1 << width])}
+
+
+def assign_codes(
+    synonyms: list[str],
+    include_sequence: str,
+    selected_synonym: str | None = None,
+    rng: RandomGenerator | None = None,
+) -> dict[str, str]:
+    """
+    Assign distinct random codes of len(include_sequence) bits to synonyms so that include_sequence is one of them.
+
+    Synonyms beyond the 2**width available codes are dropped.
+
+    Args:
+        synonyms (list[str]): Distinct synonyms to be assigned codes.
+        include_sequence (str): The binary code that has to be assigned.
+        selected_synonym (str, optional): A synonym to assign include_sequence to. Defaults to a random one.
+        rng (np.random.Generator, optional): Random generator. Defaults to a generator seeded from OS entropy.
+
+    Returns:
+        dict[str, str]: Binary codes mapped to synonyms, in random order.
+    """
+    rng = get_rng(rng)
+    width = len(include_sequence)
+    synonyms = synonyms[:1 << width]
+    include_value = int(include_sequence, 2) if include_sequence else 0
+
+    codes = draw_distinct_codes(width, len(synonyms), rng)
+    if selected_synonym in synonyms:
+        include_idx = synonyms.index(selected_synonym)
+    else:
+        include_idx = int(rng.integers(len(synonyms)))
+
+    if include_value in codes:  # Swap so that include_sequence goes to the chosen synonym
+        idx = codes.index(include_value)
+        codes[idx] = codes[include_idx]
+    codes[include_idx] = include_value
+
+    return {format_code(codes[idx], width): synonyms[idx] for idx in rng.permutation(len(synonyms)).tolist()}
+
+
+def resize_codes(mapping: dict[str, str], width: int) -> dict[str, str]:
+    """Assign codes 0, 1, 2, ... of a smaller width to the first 2**width synonyms of a mapping."""
+    return {format_code(idx, width): synonym for idx, synonym in enumerate(list(mapping.values())[:1 << width])}
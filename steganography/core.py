@@ -1,33 +1,139 @@
 import time
 
 from steganography import helper
-from steganography.gpt import generate_container
-from steganography.secret_key import generate_secret_key_mp, align_container_and_secret_key, fix_token_container_size
+from steganography.bits import BitBuffer
+from steganography.codes import get_rng
+from steganography.decoder import DecodingIndex, compile_secret_key
+from steganography.gpt import generate_container, get_model_name
+from steganography.planner import get_planner
+from steganography.streaming import stream_container_and_synonyms
+from steganography.tokenizer import TokenTable, tokenize
+from steganography.secret_key import (
+    generate_synonyms_chunks,
+    build_secret_key,
+    align_container_and_secret_key,
+    fix_token_container_size,
+)
 from models.pool_arguments import SecretKeyGenerationBody
-from utils.constants import SYNONYM_MAP
+from utils.constants import CONTAINER_SPLIT_SIZE, SYNONYM_MAP
 from utils.logger import get_logger
+from utils.metrics import record_embedding, stage
+from utils.tracing import span, traced
 
 logger = get_logger(__name__)
 
 
+def get_container_length(message_bits: int, bits_per_word: int, additional_bits: int) -> int:
+    """Returns the number of container words to generate for a message, sized by the capacity planner."""
+    return get_planner().get_container_length(message_bits, bits_per_word, additional_bits, model=get_model_name())
+
+
+def to_bit_buffer(message: str | BitBuffer, binarize: bool = True) -> BitBuffer:
+    """Returns the bits of a message, binarizing text or packing a binary string."""
+    if isinstance(message, BitBuffer):
+        return message
+    return BitBuffer.from_text(message) if binarize else BitBuffer.from_str(message)
+
+
+def get_binary_message_chunks(
+    binary_message: str | BitBuffer, bits_per_word: int, additional_bits: int
+) -> list[str]:
+    """Returns message chunks included into partially binarized synonyms when additional bits are used."""
+    if additional_bits:
+        binary_message = to_bit_buffer(binary_message, binarize=False)
+        chunk_size = bits_per_word + additional_bits
+        return [
+            binary_message.read_code(offset, min(chunk_size, len(binary_message) - offset))
+            for offset in range(0, len(binary_message), chunk_size)
+        ]
+    return []
+
+
+def embed_tokens(
+    tokens: TokenTable, secret_key: SYNONYM_MAP, binary_message: BitBuffer, offset: int = 0
+) -> (list[str], int):
+    """
+    Replace tokens with synonyms encoding the binary message from a bit offset.
+
+    Args:
+        tokens (TokenTable): The container tokens.
+        secret_key (SYNONYM_MAP): The secret key aligned with the tokens. Token mappings are adjusted
+            in place when the last message part is shorter than the token container size.
+        binary_message (BitBuffer): The binary message to embed.
+        offset (int, optional): Bits of the message embedded before these tokens. Defaults to 0.
+
+    Returns:
+        tuple: The encoded tokens and the offset of the first bit that was not embedded.
+    """
+    encoded_tokens, current_idx = [], offset
+    for body, ending, is_title, replacement_token in zip(
+        tokens.bodies, tokens.endings, tokens.capitalized.tolist(), secret_key
+    ):
+        token = body.lower() if is_title and body not in replacement_token else body
+        # Ingest token, tokens with duplicated synonyms are skipped
+        if token in replacement_token and current_idx < len(binary_message) and \
+                not helper.has_duplicates(replacement_token):
+            token_container_size = len(list(replacement_token[token].keys())[0])
+            message_part = binary_message.read_code(
+                current_idx, min(token_container_size, len(binary_message) - current_idx)
+            )
+            if len(message_part) != token_container_size:
+                replacement_token[token] = fix_token_container_size(replacement_token[token], len(message_part))
+
+            new_token = replacement_token[token][message_part]
+            if is_title:
+                new_token = new_token.capitalize()
+
+            encoded_tokens.append(new_token + ending)
+            current_idx += token_container_size
+        else:  # Skipping token
+            encoded_tokens.append(body + ending)
+
+    return encoded_tokens, current_idx
+
+
+def embed_message(container: str | TokenTable, secret_key: SYNONYM_MAP, binary_message: str | BitBuffer) -> str:
+    """
+    Replace container tokens with synonyms encoding the binary message.
+
+    Args:
+        container (str | TokenTable): The container text or its token table.
+        secret_key (SYNONYM_MAP): The secret key aligned with the container. Token mappings are adjusted
+            in place when the last message part is shorter than the token container size.
+        binary_message (str | BitBuffer): The binary message to embed.
+
+    Returns:
+        str: The encoded message.
+    """
+    encoded_tokens, _ = embed_tokens(tokenize(container), secret_key, to_bit_buffer(binary_message, binarize=False))
+    return " ".join(encoded_tokens)
+
+
+@traced("encode_message")
 def encode_message(
-    message: str,
+    message: str | BitBuffer,
     bits_per_word: int,
     additional_bits: int = 0,
     binarize: bool = True,
     container: str | None = None,
+    stream: bool = False,
+    seed: int | None = None,
 ) -> (str, SYNONYM_MAP, dict[str, float]):
     """
     Encodes a message using a container-based technique.
 
     Args:
-        message (str): The input message to be encoded.
+        message (str | BitBuffer): The input message to be encoded, or its bits.
         bits_per_word (int): How may bits per word should be encoded (No more than MAX_BITS_PER_WORD).
         additional_bits (int, optional): How many additional bits needs to be added to bits_per_word
             (No more than bits_per_word * MAX_ADDITIONAL_BITS_MULTIPLIER). Defaults to 0.
-        binarize (bool, optional): If True, the input message is binarized using helper.binarize_message.
-            Defaults to True.
+        binarize (bool, optional): If True, the input message is binarized, otherwise it is a string of '0'
+            and '1' characters. Ignored for a BitBuffer. Defaults to True.
         container (str, optional): If set container won't be generated by GPT model.
+        stream (bool, optional): If True and the container is generated, it is streamed and synonyms of every
+            container split are requested as soon as the split is complete. Defaults to False.
+        seed (int, optional): Seed of the random generator drawing codes with additional bits, for reproducible
+            secret keys. Defaults to None, seeding from OS entropy.
 
     Returns:
         Tuple[str, SYNONYM_MAP, dict[str, float]]: A tuple containing the encoded message, the synonym map,
@@ -38,70 +144,154 @@ def encode_message(
         with corresponding values from the generated secret key.
     """
     time_report, usage_report = {}, {}
+    rng = get_rng(seed)
 
-    binary_message = helper.binarize_message(message) if binarize else message
-    if additional_bits:
-        chunk_size = bits_per_word + additional_bits
-        binary_message_chunks = list(helper.divide_chunks(binary_message, chunk_size))
+    binary_message = to_bit_buffer(message, binarize)
+    binary_message_chunks = get_binary_message_chunks(binary_message, bits_per_word, additional_bits)
+
+    if container is None and stream:
+        container_length = get_container_length(len(binary_message), bits_per_word, additional_bits)
+        container, synonyms_chunks, time_report, usage_report = stream_container_and_synonyms(
+            container_length, bits_per_word
+        )
+        tokens = tokenize(container)
+        secret_key_generation_body = SecretKeyGenerationBody(
+            pool_arguments=[],
+            additional_bits=additional_bits,
+            binary_message_chunks=binary_message_chunks,
+        )
     else:
-        binary_message_chunks = []
+        if container is None:
+            with stage("container_generation", time_report):
+                container_length = get_container_length(len(binary_message), bits_per_word, additional_bits)
+                container, usage = generate_container(container_length)
+            usage_report["container_generation"] = usage
+
+        tokens = tokenize(container)
+        container_splits = helper.divide_chunks(tokens.surfaces, CONTAINER_SPLIT_SIZE)
+
+        with span("secret_key_body"):
+            secret_key_generation_body = SecretKeyGenerationBody.from_list(
+                container_splits,
+                bits_per_word,
+                additional_bits,
+                binary_message_chunks,
+            )
+
+        with stage("secret_key_generation", time_report):
+            synonyms_chunks, usage = generate_synonyms_chunks(secret_key_generation_body)
+        usage_report["secret_key_generation"] = usage
+
+    with stage("code_assignment", time_report):
+        secret_key = build_secret_key(synonyms_chunks, secret_key_generation_body, rng)
+    with stage("alignment", time_report):
+        secret_key = align_container_and_secret_key(tokens, secret_key)
+    with stage("substitution", time_report):
+        encoded_message = embed_message(tokens, secret_key, binary_message)
+
+    record_embedding(len(binary_message), usage_report)
+    return container, encoded_message, secret_key, time_report, usage_report
+
+
+@traced("encode_batch")
+def encode_batch(
+    messages: list[str | BitBuffer],
+    bits_per_word: int,
+    additional_bits: int = 0,
+    binarize: bool = True,
+    container: str | None = None,
+    seed: int | None = None,
+) -> list[tuple[str, str, SYNONYM_MAP, dict[str, float], dict]]:
+    """
+    Encodes many messages into one shared container.
+
+    The container and the message-independent synonyms are generated once for the whole batch, sized for
+    the longest message. Only code assignment (with additional bits), alignment and substitution are
+    repeated per message.
+
+    Args:
+        messages (list[str | BitBuffer]): The input messages to be encoded, or their bits.
+        bits_per_word (int): How may bits per word should be encoded (No more than MAX_BITS_PER_WORD).
+        additional_bits (int, optional): How many additional bits needs to be added to bits_per_word
+            (No more than bits_per_word * MAX_ADDITIONAL_BITS_MULTIPLIER). Defaults to 0.
+        binarize (bool, optional): If True, the input messages are binarized, otherwise they are strings of
+            '0' and '1' characters. Ignored for BitBuffers. Defaults to True.
+        container (str, optional): If set container won't be generated by GPT model.
+        seed (int, optional): Seed of the random generator drawing codes with additional bits. Defaults to None.
+
+    Returns:
+        list[tuple]: One (container, encoded_message, secret_key, time_report, usage_report) tuple per message,
+            in the same order and layout as `encode_message` returns. Shared stages report the same time and
+            usage for every message, per message stages are reported under "embedding" and the number of
+            messages sharing the stages under usage_report["batch_size"].
+    """
+    shared_time_report, shared_usage_report = {}, {"batch_size": len(messages)}
+    if not messages:
+        return []
+
+    binary_messages = [to_bit_buffer(message, binarize) for message in messages]
+    rng = get_rng(seed)
 
-    s = time.time()
     if container is None:
-        container_length = len(binary_message) // (bits_per_word + additional_bits) * 1.5
-        container, usage = generate_container(container_length)
-        time_report["container_generation"] = round(time.time() - s, 2)
-        usage_report["container_generation"] = usage
-
-    s = time.time()
-    container_splits = helper.divide_chunks(container.split(), 5)
-
-    secret_key_generation_body = SecretKeyGenerationBody.from_list(
-        container_splits,
-        bits_per_word,
-        additional_bits,
-        binary_message_chunks,
-    )
-
-    secret_key, usage = generate_secret_key_mp(secret_key_generation_body)
-    time_report["secret_key_generation"] = round(time.time() - s, 2)
-    usage_report["secret_key_generation"] = usage
-
-    secret_key = align_container_and_secret_key(container, secret_key)
-
-    encoded_message, current_idx = [], 0
-    for token, replacement_token in zip(container.split(), secret_key):
-        ends_with_special, token = helper.check_endswith_special(token)
-        if helper.is_token_replacable(token, replacement_token) and current_idx < len(binary_message):  # Ingest token
-            if helper.has_duplicates(replacement_token):
-                encoded_message.append(token + ends_with_special)
-                continue
-
-            token, was_capital = helper.check_capitalization(token, replacement_token)
-            token_container_size = len(list(replacement_token[token].keys())[0])
-            message_part = binary_message[current_idx:current_idx + token_container_size]
-            if len(message_part) != token_container_size:
-                replacement_token[token] = fix_token_container_size(replacement_token[token], len(message_part))
+        with stage("container_generation", shared_time_report):
+            message_bits = max(len(m) for m in binary_messages)
+            container_length = get_container_length(message_bits, bits_per_word, additional_bits)
+            container, usage = generate_container(container_length)
+        shared_usage_report["container_generation"] = usage
 
-            new_token = replacement_token[token][message_part]
-            if was_capital:
-                new_token = new_token.capitalize()
+    tokens = tokenize(container)
+    with span("secret_key_body"):
+        secret_key_generation_body = SecretKeyGenerationBody.from_list(
+            helper.divide_chunks(tokens.surfaces, CONTAINER_SPLIT_SIZE),
+            bits_per_word,
+            additional_bits,
+            [],
+        )
+    with stage("secret_key_generation", shared_time_report):
+        synonyms_chunks, usage = generate_synonyms_chunks(secret_key_generation_body)
+    shared_usage_report["secret_key_generation"] = usage
 
-            encoded_message.append(new_token + ends_with_special)
-            current_idx += token_container_size
-        else:  # Skipping token
-            encoded_message.append(token + ends_with_special)
+    shared_secret_key = None
+    if not additional_bits:  # Codes do not depend on the message, the key is aligned once
+        with stage("code_assignment", shared_time_report):
+            shared_secret_key = build_secret_key(synonyms_chunks, secret_key_generation_body)
+        with stage("alignment", shared_time_report):
+            shared_secret_key = align_container_and_secret_key(tokens, shared_secret_key)
+
+    results = []
+    for binary_message in binary_messages:
+        time_report = dict(shared_time_report)
+        with stage("embedding", time_report):
+            if shared_secret_key is not None:
+                secret_key = [dict(replacement_token) for replacement_token in shared_secret_key]
+            else:
+                message_body = secret_key_generation_body.model_copy(update={
+                    "binary_message_chunks": get_binary_message_chunks(binary_message, bits_per_word, additional_bits)
+                })
+                with stage("code_assignment"):
+                    secret_key = build_secret_key(synonyms_chunks, message_body, rng)
+                with stage("alignment"):
+                    secret_key = align_container_and_secret_key(tokens, secret_key)
+
+            with stage("substitution"):
+                encoded_message = embed_message(tokens, secret_key, binary_message)
 
-    return container, " ".join(encoded_message), secret_key, time_report, usage_report
+        usage_report = dict(shared_usage_report)
+        record_embedding(len(binary_message), usage_report, shares=len(binary_messages))
+        results.append((container, encoded_message, secret_key, time_report, usage_report))
 
+    return results
 
-def decode_message(container: str, secret_key: SYNONYM_MAP, clean_output: bool = True) -> str:
+
+@traced("decode_message")
+def decode_message(container: str, secret_key: SYNONYM_MAP | DecodingIndex, clean_output: bool = True) -> str:
     """
     Decode a message hidden within a container using a provided secret key.
 
     Args:
         container (str): The container string containing the encoded message.
-        secret_key (SYNONYM_MAP): A mapping of base tokens to their synonyms and binary representations.
+        secret_key (SYNONYM_MAP | DecodingIndex): A mapping of base tokens to their synonyms and binary
+            representations, or a DecodingIndex compiled from it with `compile_secret_key` for repeated decoding.
         clean_output (bool, optional): If True, the decoded message will be returned as plain text;
             if False, it will be returned as a binary sequence. Default is True.
 
@@ -112,42 +302,15 @@ def decode_message(container: str, secret_key: SYNONYM_MAP, clean_output: bool =
         The decoding process involves identifying and replacing base tokens with their corresponding binary sequences
         according to the provided secret_key. The decoded message is returned along with the time spent on decoding.
     """
-    start_time = time.time()
-
-    clean_encoded_message = helper.clean_container(container)
-    binary_sequence, current_idx, counter = "", 0, 0
-    for replacement_token in secret_key:
-        base_token = list(replacement_token.keys())[0]
-        mapping = sorted(
-            [[k, v] for k, v in list(replacement_token.values())[0].items()],
-            key=lambda x: len(x[1]),
-            reverse=True
-        )
+    start_time = time.perf_counter()
 
-        is_found = False
-        for binary_data, token in mapping:
-            span = clean_encoded_message[current_idx:current_idx + len(token)]
-            is_end_of_word = helper.check_is_end_of_word(clean_encoded_message, current_idx + len(token))
+    with stage("decode"):
+        binary_sequence = compile_secret_key(secret_key).decode_bits(container)
 
-            if helper.has_duplicates(replacement_token):
-                current_idx += len(base_token) + 1
-                is_found = True
-                break
-
-            if token.lower() == span.lower() and is_end_of_word:
-                binary_sequence += binary_data
-                current_idx += len(token) + 1
-                is_found = True
-                break
-
-        counter += 1
-        if not is_found:
-            break
-
-    if clean_output:
-        decoded_message = helper.get_text_from_binary(binary_sequence)
-    else:
-        decoded_message = binary_sequence
+        if clean_output:
+            decoded_message = binary_sequence.to_text()
+        else:
+            decoded_message = binary_sequence.to_str()
 
-    spent_time = time.time() - start_time
+    spent_time = time.perf_counter() - start_time
     return decoded_message, spent_time
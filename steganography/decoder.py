@@ -0,0 +1,128 @@
+from steganography.bits import BitBuffer, BitWriter
+from steganography.helper import clean_container
+from steganography.tokenizer import TokenTable, tokenize
+from utils.constants import SYNONYM_MAP
+
+
+class DecodingIndex:
+    """
+    Compiled form of a secret key used to decode messages in a single linear pass.
+
+    For every key position the index keeps a hash table per surface length, mapping the lowercase
+    synonym (possibly multi-word) to its binary code as an (integer, width) pair. Positions whose synonyms contain duplicates are
+    stored as skips of the base token length, mirroring the encoder which never replaces such tokens.
+    """
+
+    __slots__ = ("entries",)
+
+    def __init__(self, entries: list[tuple[int, tuple[int, ...], dict[int, dict[str, tuple[int, int]]] | None]]):
+        self.entries = entries
+
+    @classmethod
+    def from_secret_key(cls, secret_key: SYNONYM_MAP) -> "DecodingIndex":
+        """
+        Compile a secret key into a decoding index.
+
+        Args:
+            secret_key (SYNONYM_MAP): A mapping of base tokens to their synonyms and binary representations.
+
+        Returns:
+            DecodingIndex: The compiled index.
+        """
+        entries = []
+        for replacement_token in secret_key:
+            base_token, mapping = next(iter(replacement_token.items()))
+            if mapping and len(mapping) != len(set(mapping.values())):  # Duplicates are never used by the encoder
+                entries.append((len(base_token) + 1, (), None))
+                continue
+
+            tables = {}
+            for binary_data, token in sorted(mapping.items(), key=lambda x: len(x[1]), reverse=True):
+                code = (int(binary_data, 2) if binary_data else 0, len(binary_data))
+                tables.setdefault(len(token), {}).setdefault(token.lower(), code)
+            entries.append((0, tuple(tables), tables))
+        return cls(entries)
+
+    def decode(self, container: str | TokenTable) -> str:
+        """Extract the binary sequence hidden in the container as a string of '0' and '1' characters."""
+        return self.decode_bits(container).to_str()
+
+    def decode_bits(self, container: str | TokenTable) -> BitBuffer:
+        """
+        Extract the binary sequence hidden in the container.
+
+        Args:
+            container (str | TokenTable): The container string containing the encoded message, or the token
+                table of the container cleaned with `clean_container`.
+
+        Returns:
+            BitBuffer: The decoded binary sequence.
+        """
+        tokens = container if isinstance(container, TokenTable) else tokenize(clean_container(container))
+        binary_sequence = BitWriter()
+        self.decode_text(tokens.text, binary_sequence, boundaries=tokens.get_boundaries())
+        return binary_sequence.to_buffer()
+
+    def decode_text(
+        self,
+        text: str,
+        binary_sequence: BitWriter,
+        first_entry: int = 0,
+        final: bool = True,
+        boundaries: bytearray | None = None,
+    ) -> (int, int, bool):
+        """
+        Decode a cleaned text from a key position, writing the codes found to binary_sequence.
+
+        Args:
+            text (str): Cleaned container text, starting at the word of the first entry and ending at a word end.
+            binary_sequence (BitWriter): Writer the decoded codes are appended to.
+            first_entry (int, optional): Key position the text starts at. Defaults to 0.
+            final (bool, optional): If False, more text may follow, so decoding stops at the first entry that
+                needs text past the end instead of treating it as the end of the message. Defaults to True.
+            boundaries (bytearray, optional): Word end flags of the text from `TokenTable.get_boundaries`.
+
+        Returns:
+            tuple: The next key position, the text offset it starts at and True if decoding stopped only
+                because the text ended before the key.
+        """
+        text_length = len(text)
+        if boundaries is None:
+            boundaries = tokenize(text).get_boundaries()  # Offsets where a word ends
+
+        current_idx = 0
+        for entry in range(first_entry, len(self.entries)):
+            skip, lengths, tables = self.entries[entry]
+            if tables is None:
+                if not final and current_idx + skip > text_length + 1:
+                    return entry, current_idx, True
+                current_idx += skip
+                continue
+
+            binary_data = None
+            for length in lengths:  # Longest first
+                end_idx = current_idx + length
+                if end_idx > text_length:
+                    if not final:
+                        return entry, current_idx, True
+                    continue
+                if not boundaries[end_idx]:
+                    continue
+
+                binary_data = tables[length].get(text[current_idx:end_idx].lower())
+                if binary_data is not None:
+                    current_idx = end_idx + 1
+                    break
+
+            if binary_data is None:
+                return entry, current_idx, False
+            binary_sequence.write(*binary_data)
+
+        return len(self.entries), current_idx, False
+
+
+def compile_secret_key(secret_key: SYNONYM_MAP | DecodingIndex) -> DecodingIndex:
+    """Returns a decoding index for the secret key, reusing it if the key is already compiled."""
+    if isinstance(secret_key, DecodingIndex):
+        return secret_key
+    return DecodingIndex.from_secret_key(secret_key)
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Iterable
+
+import httpx
+import openai
+
+from utils.constants import (
+    LLM_CONCURRENCY,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    OPENAI_TIMEOUT,
+)
+from utils.logger import get_logger
+from utils.tracing import propagate
+
+logger = get_logger(__name__)
+
+
+class AsyncEngine:
+    """
+    Long-lived asyncio engine used to run LLM requests concurrently inside one process.
+
+    The engine owns a background event loop thread and a single `openai.AsyncOpenAI` client with a bounded
+    HTTP connection pool, so TLS connections are reused across requests and across encodes. Synchronous code
+    submits coroutines with `run` and blocks only the calling thread.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = LLM_CONCURRENCY,
+        max_connections: int = OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections: int = OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    ):
+        self.concurrency = concurrency
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+
+        self._client = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="synsteg-engine", daemon=True)
+        self._thread.start()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        """Returns the shared AsyncOpenAI client, creating it on first use inside the engine loop."""
+        if self._client is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                ),
+                timeout=OPENAI_TIMEOUT,
+            )
+            self._client = openai.AsyncOpenAI(http_client=http_client, max_retries=0)
+        return self._client
+
+    def run(self, coroutine: Awaitable) -> Any:
+        """Run a coroutine on the engine loop and wait for its result from the calling thread."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("AsyncEngine.run cannot be called from inside the engine loop")
+        return asyncio.run_coroutine_threadsafe(propagate(coroutine), self._loop).result()
+
+    async def gather(self, function: Callable[[Any], Awaitable], items: Iterable, concurrency: int | None = None):
+        """
+        Apply an async function to every item with bounded concurrency, preserving the input order.
+
+        Args:
+            function (Callable[[Any], Awaitable]): Coroutine function called with one item.
+            items (Iterable): Items to process.
+            concurrency (int, optional): Maximum number of in-flight calls. Defaults to the engine concurrency.
+
+        Returns:
+            list: Results in the same order as items.
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def bounded(item):
+            async with semaphore:
+                return await function(item)
+
+        return await asyncio.gather(*[bounded(item) for item in items])
+
+    def map(self, function: Callable[[Any], Awaitable], items: Iterable, concurrency: int | None = None) -> list:
+        """Synchronous wrapper around `gather`."""
+        return self.run(self.gather(function, items, concurrency))
+
+    def close(self):
+        """Close the shared client and stop the engine loop."""
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result()
+            self._client = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+_engine: AsyncEngine | None = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> AsyncEngine:
+    """Returns the process-wide AsyncEngine, starting it on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncEngine()
+            logger.info(f"Started async LLM engine with concurrency {_engine.concurrency}")
+        return _engine
@@ -1,13 +1,70 @@
 import json
 import random
+import threading
+import time
+from typing import Callable
 
 import openai
 import backoff
 
+from steganography.providers import LLMProvider, create_provider, get_estimated_usage, get_rough_token_count
+from steganography.rate_limit import async_rate_limited, is_permanent_error, rate_limited
+from steganography.single_flight import get_coalesced_usage, get_request_key, get_single_flight
 from utils import prompts, constants
+from utils.metrics import record_llm_usage
+from utils.tracing import span
 
+_provider = None
+_provider_lock = threading.Lock()
 
-@backoff.on_exception(backoff.expo, (openai.RateLimitError, openai.APIStatusError))
+
+def get_provider() -> LLMProvider:
+    """Returns the LLM provider used by this process, creating the default one on first use."""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = create_provider(constants.LLM_PROVIDER)
+        return _provider
+
+
+def set_provider(provider: LLMProvider):
+    """Replace the LLM provider used by this process, e.g. with an offline or a record-and-replay backend."""
+    global _provider
+    with _provider_lock:
+        _provider = provider
+
+
+def get_model_name(model: str = constants.OPENAI_MODEL_SYNONYMS) -> str:
+    """Returns the provider and model generating synonyms, e.g. "openai/gpt-4o", to keep their results apart."""
+    return f"{get_provider().name}/{model}"
+
+
+def get_rate_limit_key(model: str) -> str | None:
+    """
+    Returns the upstream provider and model whose quota a request counts against, e.g. "openai/gpt-4o" also when
+    recording OpenAI responses, or None for providers making no network calls.
+    """
+    provider = get_provider()
+    return None if provider.is_local else f"{provider.upstream_name}/{model}"
+
+
+def get_estimated_tokens(prompt: str, input_message: str) -> int:
+    """Returns the tokens reserved for a request before its usage is known."""
+    return get_rough_token_count(prompt + input_message) + constants.RATE_LIMIT_COMPLETION_TOKENS
+
+
+retry_llm_errors = backoff.on_exception(
+    backoff.expo,
+    (openai.RateLimitError, openai.APIStatusError),
+    max_tries=constants.LLM_RETRY_MAX_TRIES,
+    max_time=constants.LLM_RETRY_MAX_TIME,
+    max_value=constants.LLM_RETRY_MAX_WAIT,
+    jitter=backoff.full_jitter,
+    giveup=is_permanent_error,
+)
+
+
+@retry_llm_errors
 def get_openai_json_output(prompt: str, input_message: str, output_key: str = None, temperature: float = 1.0):
     """
     Retrieves JSON output from the OpenAI GPT-3 model based on given prompt and input message.
@@ -27,25 +84,21 @@ def get_openai_json_output(prompt: str, input_message: str, output_key: str = No
         openai.APIStatusError: If there is an issue with the OpenAI API status.
 
     Note:
-        This function uses exponential backoff for retries in case of RateLimitError or APIStatusError.
+        Requests are scheduled by the rate limiter of the model and retried with a capped, fully jittered
+        exponential backoff in case of RateLimitError or APIStatusError.
     """
-
-    client = openai.OpenAI()
-
-    response = client.chat.completions.create(
-        model=constants.OPENAI_MODEL_SYNONYMS,
-        temperature=temperature,
-        messages=[{"role": "system", "content": prompt}, {'role': 'user', 'content': input_message}],
-        response_format={"type": "json_object"}
-    )
+    model = constants.OPENAI_MODEL_SYNONYMS
+    with rate_limited(get_rate_limit_key(model), get_estimated_tokens(prompt, input_message)) as permit:
+        content, usage = get_provider().complete(prompt, input_message, model, temperature, json_output=True)
+        permit.usage = usage
 
     if output_key:
-        return json.loads(response.choices[0].message.content)[output_key], response.usage.model_dump()
+        return json.loads(content)[output_key], usage
     else:
-        return json.loads(response.choices[0].message.content), response.usage.model_dump()
+        return json.loads(content), usage
 
 
-@backoff.on_exception(backoff.expo, (openai.RateLimitError, openai.APIStatusError))
+@retry_llm_errors
 def get_openai_output(prompt: str, input_message: str, temperature: float = 1.0):
     """
     Retrieves OpenAI model output based on a given prompt and input message.
@@ -59,15 +112,103 @@ def get_openai_output(prompt: str, input_message: str, temperature: float = 1.0)
     Returns:
         str or None: The generated model output as a string. Returns None if no choices are available in the response.
     """
-    client = openai.OpenAI()
+    model = constants.OPENAI_MODEL_CONTAINER
+    with rate_limited(get_rate_limit_key(model), get_estimated_tokens(prompt, input_message)) as permit:
+        content, usage = get_provider().complete(prompt, input_message, model, temperature)
+        permit.usage = usage
+    return content, usage
+
+
+@retry_llm_errors
+async def async_get_openai_json_output(
+    prompt: str, input_message: str, output_key: str = None, temperature: float = 1.0
+):
+    """
+    Asynchronous counterpart of `get_openai_json_output` running on the shared AsyncEngine.
+
+    Args:
+        prompt (str): The system-level instruction or prompt for the conversation.
+        input_message (str): The user's input message in the conversation.
+        output_key (str, optional): The key for extracting a specific value from the JSON output.
+        temperature (float, optional): Controls the randomness of the model's output (default is 1.0).
+
+    Returns:
+        dict or specified data type: The JSON output and the usage of the request.
+    """
+    model = constants.OPENAI_MODEL_SYNONYMS
+    async with async_rate_limited(get_rate_limit_key(model), get_estimated_tokens(prompt, input_message)) as permit:
+        content, usage = await get_provider().acomplete(prompt, input_message, model, temperature, json_output=True)
+        permit.usage = usage
+
+    if output_key:
+        return json.loads(content)[output_key], usage
+    else:
+        return json.loads(content), usage
+
+
+def normalize_container(container: str) -> str:
+    """Replace paragraph breaks with sentence ends and remove line breaks and standalone dots."""
+    return container.replace('.\n\n', '. ').replace('\n\n', '. ').replace('\n', '').replace(' . ', ' ')
+
+
+def get_container_request(words_number: int, topic: str | None = None, container: str = "") -> str:
+    """
+    Returns the input message asking for a container on a topic, or for a continuation of the partial
+    container with only the missing words.
+
+    Args:
+        words_number (int): The desired number of words in the whole container.
+        topic (str, optional): The container topic. Defaults to a random one from constants.TOPICS.
+        container (str, optional): The partial container generated by previous attempts.
+    """
+    topic = topic or random.choice(constants.TOPICS)
+    if not container:
+        return prompts.CONTAINER_GENERATION_INPUT.format(
+            topic=topic, words_number=int(words_number * constants.CONTAINER_BUFFER)
+        )
 
-    response = client.chat.completions.create(
-        model=constants.OPENAI_MODEL_CONTAINER,
-        temperature=temperature,
-        messages=[{"role": "system", "content": prompt}, {'role': 'user', 'content': input_message}]
+    words = container.split()
+    return prompts.CONTAINER_CONTINUATION_INPUT.format(
+        topic=topic,
+        words_number=int((words_number - len(words)) * constants.CONTAINER_BUFFER) + 1,
+        context=" ".join(words[-constants.CONTAINER_CONTINUATION_CONTEXT:]),
     )
 
-    return response.choices[0].message.content if response.choices else None, response.usage.model_dump()
+
+def request_container(input_message: str) -> (str, dict[str, int]):
+    """
+    Request one container attempt, attaching to an identical request in flight if containers are coalesced.
+    A caller served by another request gets the usage of `get_coalesced_usage`.
+    """
+    prompt, temperature = prompts.CONTAINER_GENERATION_PROMPT, constants.CONTAINER_TEMPERATURE
+    if not constants.SINGLE_FLIGHT_CONTAINERS:
+        return get_openai_output(prompt, input_message, temperature)
+
+    key = get_request_key(prompt, input_message, get_model_name(constants.OPENAI_MODEL_CONTAINER), temperature)
+    (text, usage), shared = get_single_flight().do(key, get_openai_output, prompt, input_message, temperature)
+    return (text, get_coalesced_usage()) if shared else (text, usage)
+
+
+def add_attempt_usage(usage: dict[str, int] | None, attempt_usage: dict[str, int]) -> dict[str, int]:
+    """
+    Add token usage of a container generation attempt to the usage of the previous attempts. Attempts served by
+    an identical request in flight are counted in "coalesced_requests".
+    """
+    if usage is None:
+        usage = {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0, "attempts": 0}
+    for key in ("completion_tokens", "prompt_tokens", "total_tokens"):
+        usage[key] += attempt_usage[key]
+    if attempt_usage.get("coalesced"):
+        usage["coalesced_requests"] = usage.get("coalesced_requests", 0) + 1
+    usage["attempts"] += 1
+    return usage
+
+
+def get_short_container_error(container: str, words_number: int) -> RuntimeError:
+    return RuntimeError(
+        f"Generated container has {len(container.split())} of {words_number} words "
+        f"after {constants.CONTAINER_MAX_ATTEMPTS} attempts"
+    )
 
 
 def generate_container(words_number: int) -> str:
@@ -87,22 +228,119 @@ def generate_container(words_number: int) -> str:
     The generated container text is then processed to improve formatting by replacing multiple newlines
     with periods, removing extra spaces, and ensuring proper sentence endings.
 
-    If the generated text contains fewer words than the specified `words_number`, the function recursively
-    calls itself until the desired word count is achieved.
+    If the generated text contains fewer words than the specified `words_number`, the partial text is kept
+    and the model is asked to continue it with the missing words only, up to constants.CONTAINER_MAX_ATTEMPTS
+    requests in total. The usage of all attempts is summed, with their number in the "attempts" key.
+
+    Raises:
+        RuntimeError: If the container is still too short after the last attempt.
     """
+    topic, container, usage = random.choice(constants.TOPICS), "", None
 
-    input_message = prompts.CONTAINER_GENERATION_INPUT.format(
-        topic=random.choice(constants.TOPICS),
-        words_number=int(words_number * constants.CONTAINER_BUFFER)
-    )
+    for attempt in range(constants.CONTAINER_MAX_ATTEMPTS):
+        start = time.perf_counter()
+        with span("llm_request", stage="container_generation", attempt=attempt):
+            text, attempt_usage = request_container(get_container_request(words_number, topic, container))
+        record_llm_usage(
+            "container_generation", get_model_name(constants.OPENAI_MODEL_CONTAINER), attempt_usage,
+            time.perf_counter() - start
+        )
+        container = f"{container} {normalize_container(text)}".strip()
+        usage = add_attempt_usage(usage, attempt_usage)
 
-    container, usage = get_openai_output(
-        prompt=prompts.CONTAINER_GENERATION_PROMPT,
-        input_message=input_message,
-        temperature=constants.CONTAINER_TEMPERATURE
-    )
+        if len(container.split()) >= words_number:
+            return container, usage
+
+    raise get_short_container_error(container, words_number)
+
+
+@retry_llm_errors
+async def async_stream_container_attempt(
+    input_message: str, on_words: Callable[[list[str]], None] | None = None, words: list[str] | None = None
+) -> (str, dict[str, int]):
+    """
+    Stream one container completion, reporting words as soon as they are complete.
+
+    The raw text is normalized in segments that end with a space followed by a regular character, so
+    normalization never depends on text that has not arrived yet. Every time new words are complete,
+    on_words is called with the list of all complete words so far.
+
+    Args:
+        input_message (str): The container generation input message.
+        on_words (Callable[[list[str]], None], optional): Callback receiving the complete words so far.
+        words (list[str], optional): Words of the partial container this attempt continues. The list is
+            extended in place, so on_words keeps receiving the same list across continuations. If the request
+            fails, the list is truncated back to its words before the request, so a retry starts from them.
+
+    Returns:
+        tuple: The normalized container and the estimated usage of the request (streams carry no usage).
+    """
+    pieces, pending = [], ""
+    words = [] if words is None else words
+    n_words = len(words)
+    model, prompt = constants.OPENAI_MODEL_CONTAINER, prompts.CONTAINER_GENERATION_PROMPT
+    try:
+        async with async_rate_limited(get_rate_limit_key(model), get_estimated_tokens(prompt, input_message)) as permit:
+            async for piece in get_provider().astream(prompt, input_message, model, constants.CONTAINER_TEMPERATURE):
+                pieces.append(piece)
+                pending += piece
+
+                cut = len(pending) - 1
+                while cut > 0 and not (pending[cut - 1] == ' ' and pending[cut] not in ' .\n'):
+                    cut -= 1
+                if cut > 0:
+                    words += normalize_container(pending[:cut]).split()
+                    pending = pending[cut:]
+                    if on_words is not None:
+                        on_words(words)
+
+            content = "".join(pieces)
+            usage = get_estimated_usage(prompt, input_message, content)
+            permit.usage = usage
+    except BaseException:
+        del words[n_words:]  # Words of the failed stream would be followed by the words of the retry
+        if on_words is not None:
+            on_words(words)
+        raise
+
+    words += normalize_container(pending).split()
+    if on_words is not None:
+        on_words(words)
+    return normalize_container(content), usage
+
+
+async def async_stream_container(
+    words_number: int, on_words: Callable[[list[str]], None] | None = None
+) -> (str, dict[str, int]):
+    """
+    Streaming counterpart of `generate_container`.
+
+    Args:
+        words_number (int): The desired number of words in the generated container.
+        on_words (Callable[[list[str]], None], optional): Callback receiving the complete words of the container
+            as soon as they are available, continuations included.
+
+    Returns:
+        tuple: The generated container text and the estimated usage of all attempts.
+
+    Raises:
+        RuntimeError: If the container is still too short after the last attempt.
+    """
+    topic, container, usage, words = random.choice(constants.TOPICS), "", None, []
+
+    for attempt in range(constants.CONTAINER_MAX_ATTEMPTS):
+        input_message = get_container_request(words_number, topic, container)
+        start = time.perf_counter()
+        with span("llm_request", stage="container_generation", attempt=attempt):
+            text, attempt_usage = await async_stream_container_attempt(input_message, on_words, words)
+        record_llm_usage(
+            "container_generation", get_model_name(constants.OPENAI_MODEL_CONTAINER), attempt_usage,
+            time.perf_counter() - start
+        )
+        container = f"{container} {text}".strip()
+        usage = add_attempt_usage(usage, attempt_usage)
+
+        if len(container.split()) >= words_number:
+            return container, usage
 
-    container = container.replace('.\n\n', '. ').replace('\n\n', '. ').replace('\n', '').replace(' . ', ' ')
-    if len(container.split()) < words_number:
-        return generate_container(words_number)
-    return container, usage
+    raise get_short_container_error(container, words_number)
@@ -1,22 +1,28 @@
-from random import sample, randint
+from random import randint
 
-from utils.constants import N_ASCII_BITS, PUNCTUATION, BRACKETS, SPECIAL_TOKENS
+from steganography.bits import BitBuffer, format_code
+from steganography.codes import RandomGenerator, draw_distinct_codes
+from utils.constants import PUNCTUATION, BRACKETS, SPECIAL_TOKENS
+
+PUNCTUATION_TABLE = str.maketrans('', '', PUNCTUATION)
+BRACKETS_TABLE = str.maketrans('', '', BRACKETS)
 
 
 def binarize_message(message: str) -> str:
     """Binarize an ASCII-encoded message."""
-    return ''.join([bin(x)[2:].zfill(N_ASCII_BITS) for x in list(message.encode('ascii'))])
+    return BitBuffer.from_text(message).to_str()
 
 
-def get_text_from_binary(binary: str) -> str:
+def get_text_from_binary(binary: str | BitBuffer) -> str:
     """Convert binary-encoded text to a human-readable string."""
-    bigint = int(binary, base=2)
-    return bigint.to_bytes((bigint.bit_length() + 7) // N_ASCII_BITS, 'big').decode()
+    if isinstance(binary, str):
+        binary = BitBuffer.from_str(binary)
+    return binary.to_text()
 
 
 def clean_container(container: str) -> str:
     """Clean container from punctuation tokens"""
-    return container.translate(str.maketrans('', '', PUNCTUATION))
+    return container.translate(PUNCTUATION_TABLE)
 
 
 def check_endswith_special(token: str) -> (str, str):
@@ -37,7 +43,7 @@ def has_duplicates(replacement_token: dict) -> bool:
 
 def remove_brackets(container: str) -> str:
     """Remove brackets from container string"""
-    return container.translate(str.maketrans('', '', BRACKETS))
+    return container.translate(BRACKETS_TABLE)
 
 
 def divide_chunks(text: str | list, chunk_size: int) -> list[str]:
@@ -84,13 +90,10 @@ def to_plain_text(text: str) -> str:
     return text.replace('_', ' ').capitalize()
 
 
-def generate_random_sequences(sequence_length: int, n_sequences: int) -> list[str]:
+def generate_random_sequences(sequence_length: int, n_sequences: int, rng: RandomGenerator | None = None) -> list[str]:
     if n_sequences > 2**sequence_length:
         sequence_length = n_sequences
-    return [
-        "".join([str(i) for i in map(int, f'{n:0>32b}')])[-sequence_length:]
-        for n in sample(range(2**sequence_length + 1), n_sequences)
-    ]
+    return [format_code(n, sequence_length) for n in draw_distinct_codes(sequence_length, n_sequences, rng)]
 
 
 def get_random_message(n_bits: int) -> str:
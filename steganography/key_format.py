@@ -0,0 +1,200 @@
+import json
+import sys
+import zlib
+from array import array
+
+from steganography.bits import get_codes
+from utils.constants import SYNONYM_MAP
+
+MAGIC = b"SSK"
+VERSION = 1
+FLAG_COMPRESSED = 1
+
+MAX_CODE_WIDTH = 32
+
+# Record kinds of the integer stream
+FILLER_RUN = 0  # count, then count key ids: {key: {"0": key, "1": key}}
+FILLER = 1  # key id, value id: {key: {"0": value, "1": value}}
+CARRIER = 2  # key id, width, n, then n (code, value id) pairs
+RAW = 3  # key id, n, then n (code string id, value id) pairs
+
+_INT_TYPE = next(t for t in "IL" if array(t).itemsize == 4)
+
+
+def _get_filler_value(mapping: dict[str, str]) -> str | None:
+    """Returns the value of a {"0": value, "1": value} filler mapping or None for any other mapping."""
+    if len(mapping) != 2:
+        return None
+    items = list(mapping.items())
+    if items[0][0] == "0" and items[1][0] == "1" and items[0][1] == items[1][1]:
+        return items[0][1]
+    return None
+
+
+def _get_code_width(mapping: dict[str, str]) -> int | None:
+    """Returns the common width of binary codes in the mapping or None if they cannot be stored as integers."""
+    widths = {len(k) for k in mapping}
+    if len(widths) != 1:
+        return None
+    width = widths.pop()
+    if not 0 < width <= MAX_CODE_WIDTH:
+        return None
+    for code in mapping:
+        if code.strip("01"):
+            return None
+    return width
+
+
+def dumps_secret_key(secret_key: SYNONYM_MAP, compress: bool = True) -> bytes:
+    """
+    Serialize a secret key into the compact binary format.
+
+    The format stores every distinct string once in an interned string table, binary codes as integers with
+    their bit width, and consecutive non-carrier words as run-length encoded records.
+
+    Args:
+        secret_key (SYNONYM_MAP): A secret key in the JSON layout.
+        compress (bool, optional): If True, the payload is compressed with zlib. Defaults to True.
+
+    Returns:
+        bytes: The serialized secret key.
+    """
+    strings, string_ids = [], {}
+
+    def intern(string: str) -> int:
+        string_id = string_ids.get(string)
+        if string_id is None:
+            if "\x00" in string:
+                raise ValueError("Secret key strings cannot contain NUL characters")
+            string_id = string_ids[string] = len(strings)
+            strings.append(string)
+        return string_id
+
+    ints, run = array(_INT_TYPE, [0]), []  # The first integer is the number of records
+
+    def flush_run():
+        if run:
+            ints[0] += 1
+            ints.extend((FILLER_RUN, len(run)))
+            ints.extend(run)
+            run.clear()
+
+    for replacement_token in secret_key:
+        for key, mapping in replacement_token.items():  # Always only one cycle
+            value = _get_filler_value(mapping)
+            if value is not None and value == key:
+                run.append(intern(key))
+                continue
+
+            flush_run()
+            ints[0] += 1
+            if value is not None:
+                ints.extend((FILLER, intern(key), intern(value)))
+                continue
+
+            width = _get_code_width(mapping)
+            if width is not None:
+                ints.extend((CARRIER, intern(key), width, len(mapping)))
+                for code, synonym in mapping.items():
+                    ints.extend((int(code, 2), intern(synonym)))
+            else:
+                ints.extend((RAW, intern(key), len(mapping)))
+                for code, synonym in mapping.items():
+                    ints.extend((intern(code), intern(synonym)))
+    flush_run()
+
+    if sys.byteorder == "big":
+        ints.byteswap()
+
+    blob = "\x00".join(strings).encode("utf-8")
+    payload = len(strings).to_bytes(4, "little") + len(blob).to_bytes(4, "little") + blob + ints.tobytes()
+    flags = 0
+    if compress:
+        payload, flags = zlib.compress(payload), flags | FLAG_COMPRESSED
+    return MAGIC + bytes([VERSION, flags]) + payload
+
+
+def loads_secret_key(data: bytes) -> SYNONYM_MAP:
+    """
+    Deserialize a secret key from the compact binary format into the JSON layout.
+
+    Args:
+        data (bytes): Data produced by `dumps_secret_key`.
+
+    Returns:
+        SYNONYM_MAP: The secret key.
+
+    Raises:
+        ValueError: If the data is not a valid compact secret key.
+    """
+    if not is_compact_secret_key(data):
+        raise ValueError("Not a compact secret key")
+    version, flags = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version != VERSION:
+        raise ValueError(f"Unsupported compact secret key version: {version}")
+
+    payload = data[len(MAGIC) + 2:]
+    try:
+        if flags & FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+
+        n_strings = int.from_bytes(payload[:4], "little")
+        blob_size = int.from_bytes(payload[4:8], "little")
+        strings = payload[8:8 + blob_size].decode("utf-8").split("\x00") if n_strings else []
+        if len(strings) != n_strings:
+            raise ValueError("Corrupted string table")
+
+        ints = array(_INT_TYPE)
+        ints.frombytes(payload[8 + blob_size:])
+        if sys.byteorder == "big":
+            ints.byteswap()
+        ints, get_string = ints.tolist(), strings.__getitem__
+
+        secret_key, idx = [], 1
+        for _ in range(ints[0]):
+            kind = ints[idx]
+            if kind == FILLER_RUN:
+                count = ints[idx + 1]
+                for string_id in ints[idx + 2:idx + 2 + count]:
+                    key = strings[string_id]
+                    secret_key.append({key: {"0": key, "1": key}})
+                idx += 2 + count
+            elif kind == FILLER:
+                value = strings[ints[idx + 2]]
+                secret_key.append({strings[ints[idx + 1]]: {"0": value, "1": value}})
+                idx += 3
+            elif kind == CARRIER:
+                key, width, n = strings[ints[idx + 1]], ints[idx + 2], ints[idx + 3]
+                codes, start = get_codes(width), idx + 4
+                values = map(get_string, ints[start + 1:start + 2 * n:2])
+                if codes is not None:
+                    mapping = dict(zip(map(codes.__getitem__, ints[start:start + 2 * n:2]), values))
+                else:
+                    mapping = {format(code, f"0{width}b"): v for code, v in zip(ints[start:start + 2 * n:2], values)}
+                secret_key.append({key: mapping})
+                idx += 4 + 2 * n
+            elif kind == RAW:
+                key, n = strings[ints[idx + 1]], ints[idx + 2]
+                start = idx + 3
+                secret_key.append({key: dict(zip(
+                    map(get_string, ints[start:start + 2 * n:2]), map(get_string, ints[start + 1:start + 2 * n:2])
+                ))})
+                idx += 3 + 2 * n
+            else:
+                raise ValueError(f"Unknown record kind: {kind}")
+    except (IndexError, UnicodeDecodeError, zlib.error) as e:
+        raise ValueError(f"Corrupted compact secret key: {e}")
+
+    return secret_key
+
+
+def is_compact_secret_key(data: bytes) -> bool:
+    """Check if the data starts with the compact secret key header."""
+    return isinstance(data, (bytes, bytearray)) and data[:len(MAGIC)] == MAGIC and len(data) >= len(MAGIC) + 2
+
+
+def load_secret_key(data: bytes | str) -> SYNONYM_MAP:
+    """Load a secret key from either the compact binary format or the JSON layout."""
+    if isinstance(data, (bytes, bytearray)) and is_compact_secret_key(data):
+        return loads_secret_key(bytes(data))
+    return json.loads(data)
@@ -0,0 +1,379 @@
+import json
+import math
+import os
+import threading
+from glob import glob
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from models.capacity_plan import CapacityPlan
+from models.report import ReportModel
+from steganography.key_format import loads_secret_key
+from utils.constants import (
+    CONTAINER_BUFFER,
+    CONTAINER_LENGTH_MULTIPLIER,
+    CONTAINER_TOKENS_PER_WORD,
+    MAX_ADDITIONAL_BITS_MULTIPLIER,
+    MAX_BITS_PER_WORD,
+    N_ASCII_BITS,
+    PLANNER_MIN_REPORTS,
+    PLANNER_TARGET_PROBABILITY,
+    SYNONYM_MAP,
+    SYNONYM_TOKENS,
+)
+from utils.logger import get_logger
+from utils.report_store import BLOBS_DIR, METRICS_DIR, list_parts
+
+logger = get_logger(__name__)
+
+_planner = None
+_planner_lock = threading.Lock()
+
+
+def get_message_bits(message: str) -> int:
+    """Returns the number of bits of a report message, which is either binary or ASCII text."""
+    if message and not message.strip("01"):
+        return len(message)
+    return len(message) * N_ASCII_BITS
+
+
+def get_carried_bits(secret_key: SYNONYM_MAP) -> list[int]:
+    """Returns the number of bits every container word of an aligned secret key can carry."""
+    carried_bits = []
+    for replacement_token in secret_key:
+        mapping = next(iter(replacement_token.values()))
+        if not mapping or len(mapping) != len(set(mapping.values())):  # Fillers and duplicates are skipped
+            carried_bits.append(0)
+        else:
+            carried_bits.append(len(next(iter(mapping))))
+    return carried_bits
+
+
+def infer_parameters(secret_key: SYNONYM_MAP) -> tuple[int, int] | None:
+    """
+    Infer bits_per_word and additional_bits of a report stored before they were recorded.
+
+    Codes are bits_per_word + additional_bits wide, while every word has at most 2**bits_per_word synonyms.
+    """
+    width = n_synonyms = 0
+    for replacement_token in secret_key:
+        mapping = next(iter(replacement_token.values()))
+        if mapping and len(mapping) == len(set(mapping.values())):
+            width = max(width, len(next(iter(mapping))))
+            n_synonyms = max(n_synonyms, len(mapping))
+    if not width:
+        return None
+    bits_per_word = min(n_synonyms.bit_length() - 1, width)
+    return bits_per_word, width - bits_per_word
+
+
+def get_report_tokens(usage_report: dict) -> int:
+    """Returns the total number of tokens spent on all stages of a report."""
+    return sum(usage.get("total_tokens", 0) for usage in usage_report.values() if isinstance(usage, dict))
+
+
+def get_default_yield(bits_per_word: int, additional_bits: int) -> float:
+    """Returns the bits per container word assumed when there are not enough reports to measure it."""
+    return (bits_per_word + additional_bits) / CONTAINER_LENGTH_MULTIPLIER
+
+
+def estimate_tokens_per_word(bits_per_word: int) -> float:
+    """Returns the estimated tokens spent per container word when there are no reports to measure it."""
+    return CONTAINER_TOKENS_PER_WORD + 2**bits_per_word * SYNONYM_TOKENS
+
+
+class CapacityPlanner:
+    """
+    Sizes containers from the bits per container word actually carried in stored reports.
+
+    Not every container word carries bits: numbers, words with duplicated synonyms and tokens
+    misaligned with the secret key are skipped. For every (model, bits_per_word, additional_bits)
+    the planner keeps the measured yield of each report, that is the number of message bits divided
+    by the number of container words needed to carry them, or the container capacity divided by its
+    length when the message did not fit. The container length for a target success probability is
+    taken from the matching lower quantile of the yields, target_probability being used when none is given.
+    """
+
+    def __init__(self, min_reports: int = PLANNER_MIN_REPORTS, target_probability: float = PLANNER_TARGET_PROBABILITY):
+        self.min_reports = min_reports
+        self.target_probability = target_probability
+        self.stats = {}
+
+    def add_report(self, report: ReportModel | dict) -> bool:
+        """
+        Add the yield of a report to the statistics.
+
+        Args:
+            report (ReportModel | dict): A report object or its JSON layout.
+
+        Returns:
+            bool: False if the report has no usable secret key and was skipped.
+        """
+        if isinstance(report, ReportModel):
+            report = {k: getattr(report, k, None) for k in report.fields}
+
+        secret_key, container = report.get("secret_key"), report.get("container")
+        if not secret_key or not container:
+            return False
+
+        parameters = (report.get("bits_per_word"), report.get("additional_bits"))
+        if parameters[0] is None:
+            parameters = infer_parameters(secret_key)
+            if parameters is None:
+                return False
+
+        message = report.get("message") or ""
+        message_bits = get_message_bits(message)
+        carried_bits = get_carried_bits(secret_key)
+
+        total, words_used = 0, len(container.split())
+        for idx, bits in enumerate(carried_bits):
+            total += bits
+            if total >= message_bits:
+                words_used = idx + 1
+                break
+        if not words_used:
+            return False
+
+        stats = self.stats.setdefault((report.get("model"), *parameters), {
+            "yields": [], "successes": 0, "tokens_per_word": []
+        })
+        stats["yields"].append(min(total, message_bits) / words_used)
+        stats["successes"] += report.get("decoded_message") == message
+        tokens = get_report_tokens(report.get("encoding_usage_report") or {})
+        if tokens:
+            stats["tokens_per_word"].append(tokens / len(container.split()))
+        return True
+
+    @classmethod
+    def from_reports(cls, reports, min_reports: int = PLANNER_MIN_REPORTS) -> "CapacityPlanner":
+        """Create a planner from report objects or their JSON layout."""
+        planner = cls(min_reports)
+        for report in reports:
+            planner.add_report(report)
+        return planner
+
+    def add_directory(self, path: str) -> int:
+        """Add the JSON reports stored by statistics_collection.py or local_runner.py. Returns the number added."""
+        n_reports = 0
+        for item in glob(f"{path}/*.json"):
+            with open(item) as f:
+                report = json.load(f)
+            if isinstance(report, dict) and "secret_key" in report:
+                n_reports += self.add_report(report)
+        logger.info(f"Capacity planner loaded {n_reports} reports from {path}")
+        return n_reports
+
+    def add_store(self, path: str) -> int:
+        """
+        Add the reports of a Parquet report store. Returns the number added.
+
+        Metrics and blobs of a report are written to part files with the same name in both datasets, so parts are
+        read in pairs and joined on uuid. Token usage is restored from the <stage>_total_tokens metric columns.
+        """
+        n_reports = 0
+        for part in list_parts(path, BLOBS_DIR):
+            metrics_path = os.path.join(path, METRICS_DIR, os.path.relpath(part, BLOBS_DIR))
+            if not os.path.exists(metrics_path):
+                continue
+            metrics = {row["uuid"]: row for row in pq.read_table(metrics_path).to_pylist()}
+            blob_columns = ["uuid", "message", "container", "decoded_message", "secret_key"]
+            for blob in pq.read_table(os.path.join(path, part), columns=blob_columns).to_pylist():
+                row = metrics.get(blob["uuid"])
+                if row is None or not blob["secret_key"]:
+                    continue
+                n_reports += self.add_report({
+                    **blob,
+                    "secret_key": loads_secret_key(blob["secret_key"]),
+                    "bits_per_word": row.get("bits_per_word"),
+                    "additional_bits": row.get("additional_bits"),
+                    "model": row.get("model"),
+                    "encoding_usage_report": {
+                        name.removesuffix("_total_tokens"): {"total_tokens": value}
+                        for name, value in row.items() if name.endswith("_total_tokens") and value is not None
+                    },
+                })
+        logger.info(f"Capacity planner loaded {n_reports} reports from the store at {path}")
+        return n_reports
+
+    @classmethod
+    def from_directory(cls, path: str, min_reports: int = PLANNER_MIN_REPORTS) -> "CapacityPlanner":
+        """Create a planner from the JSON reports stored by statistics_collection.py or local_runner.py."""
+        planner = cls(min_reports)
+        planner.add_directory(path)
+        return planner
+
+    @classmethod
+    def from_store(cls, path: str, min_reports: int = PLANNER_MIN_REPORTS) -> "CapacityPlanner":
+        """Create a planner from the reports of a Parquet report store."""
+        planner = cls(min_reports)
+        planner.add_store(path)
+        return planner
+
+    def get_stats(self, bits_per_word: int, additional_bits: int, model: str | None = None) -> dict | None:
+        """
+        Returns statistics of a parameter set measured with the model, falling back to reports without a model
+        and then to reports of all models, which are also used when no model is given. Statistics with fewer
+        than min_reports reports are ignored.
+        """
+        candidates = []
+        if model is not None:
+            candidates += [self.stats.get((model, bits_per_word, additional_bits)),
+                           self.stats.get((None, bits_per_word, additional_bits))]
+
+        merged = {"yields": [], "successes": 0, "tokens_per_word": []}
+        for (_, b, a), stats in self.stats.items():
+            if (b, a) == (bits_per_word, additional_bits):
+                merged["yields"] += stats["yields"]
+                merged["successes"] += stats["successes"]
+                merged["tokens_per_word"] += stats["tokens_per_word"]
+        candidates.append(merged)
+
+        for stats in candidates:
+            if stats is not None and len(stats["yields"]) >= self.min_reports:
+                return stats
+        return None
+
+    def plan_parameters(
+        self,
+        message_bits: int,
+        bits_per_word: int,
+        additional_bits: int = 0,
+        target_probability: float | None = None,
+        model: str | None = None,
+    ) -> CapacityPlan:
+        """
+        Plan the container for a message with the given parameters.
+
+        Args:
+            message_bits (int): Length of the binary message.
+            bits_per_word (int): Bits per word.
+            additional_bits (int, optional): Additional bits per word. Defaults to 0.
+            target_probability (float, optional): Probability that the container fits the whole message.
+                Defaults to the target probability of the planner.
+            model (str, optional): Provider and model name as returned by `gpt.get_model_name`.
+
+        Returns:
+            CapacityPlan: The container length in words and the expected yield and token usage.
+        """
+        if target_probability is None:
+            target_probability = self.target_probability
+        assert 0 < target_probability < 1, "target_probability should be between 0 and 1"
+
+        stats = self.get_stats(bits_per_word, additional_bits, model)
+        if stats is None:
+            expected_yield = get_default_yield(bits_per_word, additional_bits)
+            tokens_per_word = estimate_tokens_per_word(bits_per_word)
+            n_reports, success_rate = 0, None
+        else:
+            expected_yield = float(np.quantile(stats["yields"], 1 - target_probability, method="lower"))
+            tokens_per_word = float(np.mean(stats["tokens_per_word"])) if stats["tokens_per_word"] else \
+                estimate_tokens_per_word(bits_per_word)
+            n_reports, success_rate = len(stats["yields"]), stats["successes"] / len(stats["yields"])
+
+        container_length = math.ceil(message_bits / expected_yield) if expected_yield > 0 else 0
+        return CapacityPlan(
+            model=model,
+            bits_per_word=bits_per_word,
+            additional_bits=additional_bits,
+            container_length=container_length,
+            expected_yield=round(expected_yield, 4),
+            estimated_tokens=round(container_length * CONTAINER_BUFFER * tokens_per_word),
+            n_reports=n_reports,
+            success_rate=success_rate,
+        )
+
+    def get_container_length(
+        self,
+        message_bits: int,
+        bits_per_word: int,
+        additional_bits: int = 0,
+        target_probability: float | None = None,
+        model: str | None = None,
+    ) -> int:
+        """Returns the number of container words needed to fit the message with the target probability."""
+        return self.plan_parameters(message_bits, bits_per_word, additional_bits, target_probability, model) \
+            .container_length
+
+    def plan(
+        self,
+        message_bits: int,
+        target_probability: float | None = None,
+        model: str | None = None,
+        measured_only: bool = True,
+    ) -> list[CapacityPlan]:
+        """
+        Recommend parameters for a message, cheapest first.
+
+        Every allowed bits_per_word and additional_bits combination is planned and the plans are sorted by
+        estimated tokens and then by container length. Plans whose measured decode success rate is below the
+        target probability are ranked after all the others, so they are only recommended if nothing meets it.
+
+        Args:
+            message_bits (int): Length of the binary message.
+            target_probability (float, optional): Probability that the container fits the whole message.
+                Defaults to the target probability of the planner.
+            model (str, optional): Provider and model name as returned by `gpt.get_model_name`.
+            measured_only (bool, optional): If True, only parameter sets with enough reports are recommended.
+
+        Returns:
+            list[CapacityPlan]: Plans of all parameter sets, the recommended one first.
+        """
+        if target_probability is None:
+            target_probability = self.target_probability
+
+        plans = []
+        for bits_per_word in range(1, MAX_BITS_PER_WORD + 1):
+            max_additional_bits = bits_per_word * MAX_ADDITIONAL_BITS_MULTIPLIER - bits_per_word
+            for additional_bits in range(max_additional_bits + 1):
+                plan = self.plan_parameters(message_bits, bits_per_word, additional_bits, target_probability, model)
+                if plan.n_reports or not measured_only:
+                    plans.append(plan)
+        return sorted(plans, key=lambda p: (
+            p.success_rate is not None and p.success_rate < target_probability, p.estimated_tokens, p.container_length
+        ))
+
+
+def get_planner() -> CapacityPlanner:
+    """Returns the capacity planner used by this process. Without reports it falls back to the default yield."""
+    global _planner
+    with _planner_lock:
+        if _planner is None:
+            _planner = CapacityPlanner()
+        return _planner
+
+
+def set_planner(planner: CapacityPlanner):
+    """Replace the capacity planner used by this process, e.g. with one loaded from stored reports."""
+    global _planner
+    with _planner_lock:
+        _planner = planner
+
+
+def load_planner(
+    reports_path: str | None = None,
+    store_path: str | None = None,
+    target_probability: float = PLANNER_TARGET_PROBABILITY,
+    min_reports: int = PLANNER_MIN_REPORTS,
+) -> CapacityPlanner:
+    """
+    Load the capacity planner of this process from stored reports, so generated containers are sized from the
+    measured yield instead of the default one.
+
+    Args:
+        reports_path (str, optional): Path to folder with JSON reports.
+        store_path (str, optional): Path to a Parquet report store.
+        target_probability (float, optional): Probability that a generated container fits the whole message.
+        min_reports (int, optional): Reports of a parameter set needed before its measured yield is trusted.
+
+    Returns:
+        CapacityPlanner: The planner now used by this process.
+    """
+    planner = CapacityPlanner(min_reports, target_probability)
+    if reports_path and os.path.isdir(reports_path):
+        planner.add_directory(reports_path)
+    if store_path and os.path.isdir(store_path):
+        planner.add_store(store_path)
+    set_planner(planner)
+    return planner
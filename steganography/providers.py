@@ -0,0 +1,394 @@
+import ast
+import asyncio
+import fcntl
+import json
+import os
+import random
+import re
+import threading
+import time
+from hashlib import sha256
+from typing import AsyncIterator
+
+import httpx
+import openai
+
+from steganography.engine import get_engine
+from utils import constants
+
+USAGE = dict[str, int]
+
+OFFLINE_VOCABULARY = """
+ability able about above accept across act active actual add address admit adult affect after again against age
+agency agent agree ahead allow almost alone along already also although always amount analysis ancient animal
+answer anyone appear apply approach area argue arm around arrive art article artist assume attack attention
+author avoid away baby back bad bag ball bank bar base beat beautiful because become bed before begin behavior
+behind believe benefit best better between beyond big bill billion bit black blood blue board body book born
+both box boy break bring brother budget build building business buy call camera campaign cancer candidate
+capital car card care career carry case catch cause cell center central century certain chair challenge chance
+change character charge check child choice choose church citizen city civil claim class clear clearly close
+coach cold collection college color come commercial common community company compare computer concern
+condition conference consider consumer contain continue control cost could country couple course court cover
+create crime cultural culture cup current customer cut dark data daughter day dead deal death debate decade
+decide decision deep defense degree democratic describe design despite detail determine develop difference
+different difficult dinner direction director discover discuss disease doctor dog door down draw dream drive
+drop drug during each early east easy economic economy edge education effect effort eight either election
+else employee end energy enjoy enough enter entire environment especially establish even evening event ever
+every evidence exactly example executive exist expect experience expert explain eye face fact factor fail fall
+family far fast father fear federal feel feeling field fight figure fill film final finally financial find fine
+finger finish fire firm first fish five floor fly focus follow food foot force foreign forget form former
+forward four free friend front full fund future game garden general generation girl give glass goal good
+government great green ground group grow growth guess gun guy hair half hand hang happen happy hard have head
+health hear heart heat heavy help here herself high himself history hold home hope hospital hot hotel hour house
+however huge human hundred husband idea identify image imagine impact important improve include including
+increase indeed indicate individual industry information inside instead institution interest interesting
+international interview into investment involve issue item itself join just keep kind kitchen know knowledge
+land language large last late later laugh lawyer lead leader learn least leave left legal less letter level
+""".split()
+
+
+def get_rough_token_count(text: str) -> int:
+    """Returns a rough number of tokens in a text, used where a tokenizer is not available."""
+    return max(1, len(text) // constants.CHARS_PER_TOKEN)
+
+
+def get_estimated_usage(prompt: str, input_message: str, content: str) -> USAGE:
+    """Returns usage of a request estimated from the lengths of its prompt and response."""
+    prompt_tokens = get_rough_token_count(prompt + input_message)
+    completion_tokens = get_rough_token_count(content)
+    return {
+        "completion_tokens": completion_tokens,
+        "prompt_tokens": prompt_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class LLMProvider:
+    """
+    Interface of a chat completion backend.
+
+    Providers return the raw message content together with the token usage of the request, so the
+    callers in `steganography.gpt` do not depend on a specific API. Providers with `is_local` set make no
+    network calls and are not rate limited.
+    """
+
+    name = None
+    is_local = False
+
+    @property
+    def upstream_name(self) -> str:
+        """Returns the name of the API the requests are sent to, whose quota they count against."""
+        return self.name
+
+    def complete(
+        self, prompt: str, input_message: str, model: str, temperature: float, json_output: bool = False
+    ) -> (str, USAGE):
+        """Returns the response content and usage for a system prompt and a user message."""
+        raise NotImplementedError
+
+    async def acomplete(
+        self, prompt: str, input_message: str, model: str, temperature: float, json_output: bool = False
+    ) -> (str, USAGE):
+        """Asynchronous counterpart of `complete`."""
+        raise NotImplementedError
+
+    async def astream(self, prompt: str, input_message: str, model: str, temperature: float) -> AsyncIterator[str]:
+        """
+        Yields the response content in pieces as it is generated. Streamed responses carry no usage, callers
+        estimate it. Providers without streaming yield the whole response at once.
+        """
+        content, _ = await self.acomplete(prompt, input_message, model, temperature)
+        yield content
+
+
+class OpenAIProvider(LLMProvider):
+    """OpenAI chat completions with a shared pooled client per process and the AsyncEngine client."""
+
+    name = "openai"
+
+    def __init__(self):
+        self._client, self._client_pid = None, None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self) -> openai.OpenAI:
+        """Returns a process-wide OpenAI client with a bounded, reusable HTTP connection pool."""
+        with self._client_lock:
+            if self._client is None or self._client_pid != os.getpid():  # Connections must not cross a fork
+                self._client_pid = os.getpid()
+                self._client = openai.OpenAI(http_client=httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=constants.OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=constants.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                    ),
+                    timeout=constants.OPENAI_TIMEOUT,
+                ), max_retries=0)  # Retries go through steganography.rate_limit
+            return self._client
+
+    @staticmethod
+    def _get_request(prompt: str, input_message: str, model: str, temperature: float, json_output: bool) -> dict:
+        request = {
+            "model": model,
+            "temperature": temperature,
+            "messages": [{"role": "system", "content": prompt}, {'role': 'user', 'content': input_message}],
+        }
+        if json_output:
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    def complete(self, prompt, input_message, model, temperature, json_output=False):
+        response = self.client.chat.completions.create(
+            **self._get_request(prompt, input_message, model, temperature, json_output)
+        )
+        return response.choices[0].message.content if response.choices else None, response.usage.model_dump()
+
+    async def acomplete(self, prompt, input_message, model, temperature, json_output=False):
+        response = await get_engine().client.chat.completions.create(
+            **self._get_request(prompt, input_message, model, temperature, json_output)
+        )
+        return response.choices[0].message.content if response.choices else None, response.usage.model_dump()
+
+    async def astream(self, prompt, input_message, model, temperature):
+        stream = await get_engine().client.chat.completions.create(
+            **self._get_request(prompt, input_message, model, temperature, False), stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class OfflineProvider(LLMProvider):
+    """
+    Deterministic offline backend for benchmarks and load tests.
+
+    Containers and synonym lists are generated from a vocabulary with a random generator seeded by the
+    provider seed and the request, so the same request always gets the same response. Latency of every
+    request is `latency` seconds plus a uniform jitter of up to `jitter` seconds.
+    """
+
+    name = "offline"
+    is_local = True
+
+    def __init__(self, seed: int = 0, latency: float = 0.0, jitter: float = 0.0):
+        self.seed = seed
+        self.latency = latency
+        self.jitter = jitter
+        self._latency_rng = random.Random(seed)
+
+    def _get_rng(self, *parts) -> random.Random:
+        return random.Random(sha256(json.dumps([self.seed, *parts]).encode("utf-8")).digest())
+
+    def _get_delay(self) -> float:
+        return self.latency + self._latency_rng.uniform(0, self.jitter) if self.latency or self.jitter else 0.0
+
+    def generate_container(self, input_message: str) -> str:
+        """Returns a text of the requested number of words made of vocabulary words and sentences."""
+        match = re.search(r"Length: (\d+) words", input_message)
+        words_number = int(match.group(1)) if match else 100
+
+        rng, words, sentence = self._get_rng("container", input_message), [], []
+        while len(words) + len(sentence) < words_number:
+            sentence.append(rng.choice(OFFLINE_VOCABULARY))
+            if len(sentence) >= rng.randint(6, 14):
+                words += [sentence[0].capitalize(), *sentence[1:-1], sentence[-1] + "."]
+                sentence = []
+        if sentence:
+            words += [sentence[0].capitalize(), *sentence[1:-1], sentence[-1] + "."] if len(sentence) > 1 else \
+                [sentence[0].capitalize() + "."]
+        return " ".join(words)
+
+    def generate_synonyms(self, prompt: str, input_message: str) -> str:
+        """Returns a JSON response with the requested number of distinct synonyms for every context word."""
+        match = re.search(r"strictly (\d+) synonyms", prompt)
+        n_synonyms = min(int(match.group(1)) if match else 4, len(OFFLINE_VOCABULARY) - 1)
+
+        context = input_message.split(":", 1)[-1].strip()
+        try:
+            words = ast.literal_eval(context)
+        except (ValueError, SyntaxError):
+            words = context.split()
+        if isinstance(words, str):
+            words = words.split()
+
+        result = []
+        for word in words:
+            if word.isnumeric():
+                continue
+            rng = self._get_rng("synonyms", word, context)
+            stem = word.rstrip(constants.PUNCTUATION).lower()
+            synonyms = rng.sample([w for w in OFFLINE_VOCABULARY if w != stem], n_synonyms)
+            if word.istitle():
+                synonyms = [s.capitalize() for s in synonyms]
+            result.append({word: synonyms})
+        return json.dumps({"words": result})
+
+    def _respond(self, prompt: str, input_message: str, json_output: bool) -> (str, USAGE):
+        if json_output:
+            content = self.generate_synonyms(prompt, input_message)
+        else:
+            content = self.generate_container(input_message)
+        return content, get_estimated_usage(prompt, input_message, content)
+
+    def complete(self, prompt, input_message, model, temperature, json_output=False):
+        time.sleep(self._get_delay())
+        return self._respond(prompt, input_message, json_output)
+
+    async def acomplete(self, prompt, input_message, model, temperature, json_output=False):
+        await asyncio.sleep(self._get_delay())
+        return self._respond(prompt, input_message, json_output)
+
+    async def astream(self, prompt, input_message, model, temperature):
+        content, _ = self._respond(prompt, input_message, False)
+        words = content.split(" ")
+        delay = self._get_delay() / max(len(words), 1)
+        for idx, word in enumerate(words):
+            await asyncio.sleep(delay)
+            yield word if idx == 0 else " " + word
+
+
+class RecordReplayProvider(LLMProvider):
+    """
+    Record-and-replay backend around another provider.
+
+    In "record" mode every response of the wrapped provider is appended as one JSON line to a cassette file,
+    keyed by a hash of the request. Appends are locked with `flock`, so pool workers and other processes can
+    record to the same cassette. In "replay" mode responses are served from the cassette without calling any
+    API; repeated identical requests cycle through the recorded responses in order. Cassettes written as a
+    single JSON object by earlier versions are still replayed.
+    """
+
+    name = "cassette"
+    modes = ["record", "replay"]
+
+    @property
+    def is_local(self) -> bool:
+        return self.mode == "replay" or self.provider.is_local
+
+    @property
+    def upstream_name(self) -> str:
+        return self.name if self.provider is None else self.provider.upstream_name
+
+    def __init__(self, cassette_path: str, mode: str = "replay", provider: LLMProvider | None = None):
+        assert mode in self.modes, f"Invalid mode. Must be in {self.modes}"
+        assert mode == "replay" or provider is not None, "provider should be specified when recording"
+
+        self.cassette_path = cassette_path
+        self.mode = mode
+        self.provider = provider
+
+        self._lock = threading.Lock()
+        self._positions = {}
+        if os.path.exists(cassette_path):
+            self.cassette = self.load_cassette(cassette_path)
+        elif mode == "replay":
+            raise FileNotFoundError(f"Cassette {cassette_path} does not exist")
+        else:
+            self.cassette = {}
+
+    @staticmethod
+    def load_cassette(cassette_path: str) -> dict[str, list[dict]]:
+        cassette = {}
+        with open(cassette_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "key" not in record:  # Whole cassette written on one line by earlier versions
+                    for key, responses in record.items():
+                        cassette.setdefault(key, []).extend(responses)
+                    continue
+                response = {"content": record["content"], "usage": record["usage"]}
+                cassette.setdefault(record["key"], []).append(response)
+        return cassette
+
+    @staticmethod
+    def get_key(prompt: str, input_message: str, model: str, temperature: float, json_output: bool) -> str:
+        payload = json.dumps([prompt, input_message, model, temperature, json_output])
+        return sha256(payload.encode("utf-8")).hexdigest()
+
+    def _replay(self, key: str) -> (str, USAGE):
+        with self._lock:
+            responses = self.cassette.get(key)
+            if not responses:
+                raise KeyError(f"No recorded response for request {key} in {self.cassette_path}")
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+        response = responses[position % len(responses)]
+        return response["content"], response["usage"]
+
+    def _record(self, key: str, content: str, usage: USAGE):
+        with self._lock:
+            self.cassette.setdefault(key, []).append({"content": content, "usage": usage})
+            line = json.dumps({"key": key, "content": content, "usage": usage}) + "\n"
+            with open(self.cassette_path, "ab+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if f.seek(0, os.SEEK_END):
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":  # Cassettes of earlier versions don't end with a newline
+                        line = "\n" + line
+                f.write(line.encode("utf-8"))
+                f.flush()
+
+    def complete(self, prompt, input_message, model, temperature, json_output=False):
+        key = self.get_key(prompt, input_message, model, temperature, json_output)
+        if self.mode == "replay":
+            return self._replay(key)
+        content, usage = self.provider.complete(prompt, input_message, model, temperature, json_output)
+        self._record(key, content, usage)
+        return content, usage
+
+    async def acomplete(self, prompt, input_message, model, temperature, json_output=False):
+        key = self.get_key(prompt, input_message, model, temperature, json_output)
+        if self.mode == "replay":
+            return self._replay(key)
+        content, usage = await self.provider.acomplete(prompt, input_message, model, temperature, json_output)
+        self._record(key, content, usage)
+        return content, usage
+
+    async def astream(self, prompt, input_message, model, temperature):
+        key = self.get_key(prompt, input_message, model, temperature, False)
+        if self.mode == "replay":
+            content, _ = self._replay(key)
+            yield content
+            return
+
+        pieces = []
+        async for piece in self.provider.astream(prompt, input_message, model, temperature):
+            pieces.append(piece)
+            yield piece
+        content = "".join(pieces)
+        self._record(key, content, get_estimated_usage(prompt, input_message, content))
+
+
+def create_provider(
+    name: str = constants.LLM_PROVIDER,
+    cassette_path: str | None = None,
+    seed: int = 0,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+) -> LLMProvider:
+    """
+    Create a provider by name.
+
+    Args:
+        name (str): One of LLM_PROVIDERS: "openai", "offline", "record" (OpenAI responses recorded to
+            cassette_path) or "replay" (responses served from cassette_path).
+        cassette_path (str, optional): Cassette file used by "record" and "replay".
+        seed (int, optional): Seed of the offline provider. Defaults to 0.
+        latency (float, optional): Latency of the offline provider in seconds. Defaults to 0.
+        jitter (float, optional): Maximum additional random latency of the offline provider. Defaults to 0.
+
+    Returns:
+        LLMProvider: The provider.
+    """
+    assert name in constants.LLM_PROVIDERS, f"Invalid provider. Must be in {constants.LLM_PROVIDERS}"
+
+    if name == "openai":
+        return OpenAIProvider()
+    if name == "offline":
+        return OfflineProvider(seed=seed, latency=latency, jitter=jitter)
+
+    assert cassette_path, "cassette_path should be specified for record and replay providers"
+    if name == "record":
+        return RecordReplayProvider(cassette_path, mode="record", provider=OpenAIProvider())
+    return RecordReplayProvider(cassette_path, mode="replay")
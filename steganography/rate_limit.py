@@ -0,0 +1,392 @@
+import asyncio
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import openai
+
+from utils import constants
+from utils.logger import get_logger
+from utils.metrics import get_registry
+
+logger = get_logger(__name__)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second up to `capacity` tokens.
+
+    Callers reserve tokens before they are available: the bucket goes into debt and the caller is told how
+    long to wait, so waiting callers are served in the order they arrived instead of racing for refills.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._state = {"tokens": capacity, "updated": self._clock()}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _clock() -> float:
+        return time.monotonic()
+
+    def _transact(self, function):
+        with self._lock:
+            return function(self._state)
+
+    def _refill(self, state: dict) -> float:
+        now = self._clock()
+        state["tokens"] = min(self.capacity, state["tokens"] + (now - state["updated"]) * self.rate)
+        state["updated"] = now
+        return state["tokens"]
+
+    def reserve(self, amount: float) -> float:
+        """Take tokens from the bucket. Returns the seconds to wait before the reserved tokens are available."""
+        def function(state):
+            state["tokens"] = self._refill(state) - amount
+            return max(0.0, -state["tokens"] / self.rate)
+        return self._transact(function)
+
+    def adjust(self, amount: float):
+        """Take more tokens, or give tokens back if amount is negative, once the real cost of a request is known."""
+        def function(state):
+            state["tokens"] = min(self.capacity, self._refill(state) - amount)
+        self._transact(function)
+
+    def pause(self, seconds: float):
+        """Empty the bucket so that nothing is available for the next seconds, e.g. after a 429 response."""
+        def function(state):
+            state["tokens"] = min(self._refill(state), -seconds * self.rate)
+        self._transact(function)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket with its state in a JSON file locked with `flock`, shared by all processes using the same path.
+
+    Wall clock time is used, since monotonic clocks of different processes are not comparable.
+    """
+
+    def __init__(self, path: str, rate: float, capacity: float):
+        super(SharedTokenBucket, self).__init__(rate, capacity)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    @staticmethod
+    def _clock() -> float:
+        return time.time()
+
+    def _transact(self, function):
+        with self._lock, open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            data = f.read()
+            state = json.loads(data) if data else {"tokens": self.capacity, "updated": self._clock()}
+            result = function(state)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+            return result
+
+
+class _Waiter:
+    __slots__ = ("event", "loop", "future", "granted")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None):
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+        self.granted = False
+
+    def grant(self):
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class AdaptiveConcurrency:
+    """
+    Limit of requests in flight adapted with AIMD, shared by threads and the AsyncEngine event loop.
+
+    Every successful request increases the limit by 1 / limit, so the limit grows by about one per round
+    of requests. A 429 multiplies it by `decrease`, and a request whose seconds per token exceed the
+    baseline by `latency_tolerance` times multiplies it by `latency_decrease`, at most once per `cooldown`
+    seconds so that all requests failing in the same burst shrink the limit once.
+    """
+
+    def __init__(
+        self,
+        initial: float = constants.ADAPTIVE_CONCURRENCY_INITIAL,
+        minimum: float = constants.ADAPTIVE_CONCURRENCY_MIN,
+        maximum: float = constants.ADAPTIVE_CONCURRENCY_MAX,
+        decrease: float = constants.ADAPTIVE_CONCURRENCY_DECREASE,
+        latency_decrease: float = constants.ADAPTIVE_LATENCY_DECREASE,
+        latency_tolerance: float = constants.ADAPTIVE_LATENCY_TOLERANCE,
+        cooldown: float = constants.ADAPTIVE_DECREASE_COOLDOWN,
+    ):
+        self.limit = float(initial)
+        self.minimum, self.maximum = minimum, maximum
+        self.decrease, self.latency_decrease = decrease, latency_decrease
+        self.latency_tolerance, self.cooldown = latency_tolerance, cooldown
+        self.in_flight = 0
+        self.baseline = None  # Lowest recent seconds per token, drifting up slowly
+        self._last_decrease = 0.0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def _try_acquire(self) -> bool:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return True
+        return False
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self._waiters.popleft().grant()
+
+    def acquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+        waiter.event.wait()
+
+    async def aacquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = _Waiter(asyncio.get_running_loop())
+            self._waiters.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self.in_flight -= 1
+                    self._wake()
+                else:
+                    self._waiters.remove(waiter)
+            raise
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def _shrink(self, multiplier: float):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * multiplier)
+        logger.debug(f"Concurrency limit decreased to {self.limit:.2f}")
+
+    def on_success(self, latency: float, tokens: int):
+        with self._lock:
+            seconds_per_token = latency / max(tokens, 1)
+            if self.baseline is None or seconds_per_token < self.baseline:
+                self.baseline = seconds_per_token
+            else:
+                self.baseline += (seconds_per_token - self.baseline) * 0.01
+
+            if seconds_per_token > self.baseline * self.latency_tolerance:
+                self._shrink(self.latency_decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._wake()
+
+    def on_overload(self):
+        with self._lock:
+            self._shrink(self.decrease)
+
+
+class Permit:
+    """Admission of one request by a RateLimiter. The caller sets `usage` once the response arrived."""
+
+    __slots__ = ("estimated_tokens", "usage", "start")
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.usage = None
+        self.start = time.perf_counter()
+
+
+class RateLimiter:
+    """
+    Scheduler of the requests to one model: request and token buckets sized from the quota of the model in
+    `constants.MODEL_RATE_LIMITS` and an AdaptiveConcurrency limit.
+
+    A request reserves one request and its estimated tokens, waits until both buckets can serve it, then waits
+    for a concurrency slot. Once its usage is known the token bucket is corrected by the difference between
+    the real and the estimated tokens. A 429 pauses both buckets for the retry-after time of the response
+    and shrinks the concurrency limit, so retries of all callers are spread instead of sent at once.
+    """
+
+    def __init__(self, model: str, limits: dict | None = None, state_path: str | None = None):
+        self.model = model
+        self.requests = self.tokens = None
+        if limits:
+            self.requests = self._get_bucket(state_path, "requests", limits["requests_per_minute"])
+            self.tokens = self._get_bucket(state_path, "tokens", limits["tokens_per_minute"])
+        self.concurrency = AdaptiveConcurrency()
+
+    def _get_bucket(self, state_path: str | None, kind: str, per_minute: float) -> TokenBucket:
+        rate = per_minute * constants.RATE_LIMIT_HEADROOM / 60
+        capacity = max(rate * constants.RATE_LIMIT_BURST_SECONDS, 1.0)
+        if state_path:
+            path = os.path.join(state_path, f"{self.model.replace('/', '_')}_{kind}.json")
+            return SharedTokenBucket(path, rate, capacity)
+        return TokenBucket(rate, capacity)
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        if wait and constants.METRICS_ENABLED:
+            get_registry().observe("rate_limit_wait_seconds", wait, model=self.model)
+        return wait
+
+    def _finish(self, permit: Permit, error: BaseException | None):
+        self.concurrency.release()
+        if isinstance(error, openai.RateLimitError):
+            self.on_rate_limit(error)
+        elif error is None and permit.usage is not None:
+            self.concurrency.on_success(time.perf_counter() - permit.start, permit.usage.get("total_tokens", 0))
+
+        if self.tokens is not None:
+            used = permit.usage.get("total_tokens", permit.estimated_tokens) if permit.usage else 0
+            self.tokens.adjust(used - permit.estimated_tokens)
+
+    def on_rate_limit(self, error: openai.RateLimitError):
+        retry_after = get_retry_after(error)
+        logger.warning(f"Rate limited on {self.model}, pausing requests for {retry_after:.1f}s")
+        if constants.METRICS_ENABLED:
+            get_registry().inc("rate_limited_total", model=self.model)
+        self.concurrency.on_overload()
+        if self.requests is not None:
+            self.requests.pause(retry_after)
+            self.tokens.pause(retry_after)
+
+    @contextmanager
+    def limit(self, estimated_tokens: int):
+        """Wait until a request of estimated_tokens can be sent and yield its Permit."""
+        time.sleep(self._reserve(estimated_tokens))
+        self.concurrency.acquire()
+        permit, error = Permit(estimated_tokens), None
+        try:
+            yield permit
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._finish(permit, error)
+
+    def _refund(self, estimated_tokens: int):
+        if self.requests is not None:
+            self.requests.adjust(-1)
+            self.tokens.adjust(-estimated_tokens)
+
+    async def _run(self, function, *args):
+        # Shared buckets wait for a file lock, which must not block the event loop
+        if isinstance(self.tokens, SharedTokenBucket):
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    async def _arefund(self, reservation: asyncio.Future, estimated_tokens: int):
+        await asyncio.wait([reservation])
+        if not reservation.cancelled() and reservation.exception() is None:
+            await self._run(self._refund, estimated_tokens)
+
+    @asynccontextmanager
+    async def alimit(self, estimated_tokens: int):
+        """
+        Asynchronous counterpart of `limit` for requests running on the AsyncEngine. A request cancelled
+        before it got its concurrency slot gives its reserved request and tokens back.
+        """
+        reservation = asyncio.ensure_future(self._run(self._reserve, estimated_tokens))
+        try:
+            await asyncio.sleep(await asyncio.shield(reservation))
+            await self.concurrency.aacquire()
+        except asyncio.CancelledError:
+            await asyncio.shield(self._arefund(reservation, estimated_tokens))
+            raise
+
+        permit, error = Permit(estimated_tokens), None
+        try:
+            yield permit
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await self._run(self._finish, permit, error)
+
+
+def get_retry_after(error: openai.APIStatusError) -> float:
+    """Returns the seconds to wait from the retry-after headers of a response, or the default pause."""
+    headers = error.response.headers if getattr(error, "response", None) is not None else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return constants.RATE_LIMIT_RETRY_AFTER
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """Returns True for API errors that fail again on retry, like invalid requests and authentication errors."""
+    return isinstance(error, openai.APIStatusError) and not isinstance(error, openai.RateLimitError) and \
+        error.status_code < 500 and error.status_code not in (408, 409)
+
+
+@contextmanager
+def rate_limited(model: str | None, estimated_tokens: int):
+    """
+    Yield the Permit of a request to a provider and model once its limiter admits it. Models without a quota in
+    `constants.MODEL_RATE_LIMITS` are limited by the adaptive concurrency only. Requests without a model, made by
+    providers without network calls like the offline provider, are not limited.
+    """
+    if not constants.RATE_LIMIT_ENABLED or model is None:
+        yield Permit(estimated_tokens)
+        return
+    with get_rate_limiter(model).limit(estimated_tokens) as permit:
+        yield permit
+
+
+@asynccontextmanager
+async def async_rate_limited(model: str | None, estimated_tokens: int):
+    """Asynchronous counterpart of `rate_limited`."""
+    if not constants.RATE_LIMIT_ENABLED or model is None:
+        yield Permit(estimated_tokens)
+        return
+    async with get_rate_limiter(model).alimit(estimated_tokens) as permit:
+        yield permit
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    """Returns the rate limiter of a provider and model, e.g. "openai/gpt-4o", shared by this process."""
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter(
+                model, constants.MODEL_RATE_LIMITS.get(model), constants.RATE_LIMIT_STATE_PATH
+            )
+        return _limiters[model]
+
+
+def reset_rate_limiters():
+    """Drop the rate limiters of this process, e.g. after the limits in constants were changed."""
+    with _limiters_lock:
+        _limiters.clear()
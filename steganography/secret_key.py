@@ -1,14 +1,24 @@
+from copy import deepcopy
 from multiprocessing import Pool
-import math
-from itertools import product
+import time
 from typing import Any
 
-import numpy as np
-
-from steganography.gpt import get_openai_json_output
-from steganography.helper import clean_container, remove_brackets, generate_random_sequences
+from steganography.batching import demultiplex_synonyms, get_prompt_tokens, merge_pool_arguments, pack_pool_arguments
+from steganography.cache import get_synonym_cache
+from steganography.codes import RandomGenerator, assign_codes, assign_sequential_codes, get_rng, resize_codes
+from steganography.engine import get_engine
+from steganography.gpt import get_openai_json_output, async_get_openai_json_output, get_model_name
+from steganography.helper import clean_container
+from steganography.single_flight import get_coalesced_usage, get_request_key, get_single_flight
+from steganography.tokenizer import TokenTable, tokenize
 from models.pool_arguments import PoolArguments, SecretKeyGenerationBody
-from utils import prompts
+from utils import constants, prompts
+from utils.constants import ASYNC_ENGINE_ENABLED, SYNONYM_MAP
+from utils.logger import get_logger
+from utils.metrics import record_cache_hit, record_coalesced, record_llm_usage
+from utils.tracing import span
+
+logger = get_logger(__name__)
 
 
 def binarize_synonyms(base_token: str, synonyms: list[str]) -> dict[str, str]:
@@ -30,14 +40,14 @@ def binarize_synonyms(base_token: str, synonyms: list[str]) -> dict[str, str]:
 
     if not len(synonyms):
         return {"0": base_token, "1": base_token}
-    return {
-        "".join(index): synonym
-        for index, synonym in zip(product("01", repeat=int(math.log2(len(synonyms)))), synonyms)
-    }
+    return assign_sequential_codes(synonyms)
 
 
 def binarize_synonyms_partially(
-        synonyms: list[str], include_sequence: str, selected_synonym: str | None = None
+        synonyms: list[str],
+        include_sequence: str,
+        selected_synonym: str | None = None,
+        rng: RandomGenerator | None = None,
 ) -> dict[str, str]:
     """
         Binarize a base token by assigning binary indices to synonyms so that include_sequence always will be used.
@@ -52,6 +62,7 @@ def binarize_synonyms_partially(
             synonyms (list[str]): A list of synonyms to be assigned binary indices.
             include_sequence (str): A binary sequence to include in binarization.
             selected_synonym (str | None): A synonym to map to include_sequence if specified
+            rng (np.random.Generator | None): Random generator used to draw the codes, for reproducible keys.
 
         Returns:
             dict[str, str]: A dictionary mapping binary indices to corresponding synonyms.
@@ -62,19 +73,106 @@ def binarize_synonyms_partially(
     if not len(synonyms):
         raise ValueError("synonyms cannot be empty in this function")
 
-    binary_sequences = generate_random_sequences(len(include_sequence), len(synonyms))
-    if include_sequence not in binary_sequences:
-        binary_sequences[np.random.randint(0, len(binary_sequences))] = include_sequence
+    return assign_codes(synonyms, include_sequence, selected_synonym, rng)
 
-    if selected_synonym:
-        binarized_synonyms = {selected_synonym: include_sequence}
-        binary_sequences.remove(include_sequence)
-        for synonym, binary_sequence in zip([s for s in synonyms if s != selected_synonym], binary_sequences):
-            binarized_synonyms[synonym] = binary_sequence
-    else:
-        binarized_synonyms = {synonym: binary_sequence for synonym, binary_sequence in zip(synonyms, binary_sequences)}
 
-    return {binarized_synonyms[k]: k for k in sorted(list(binarized_synonyms), key=lambda _: np.random.random())}
+def get_synonyms_request(pool_arguments: PoolArguments) -> (str, str):
+    """Returns the system prompt and the input message used to generate synonyms for a container split."""
+    input_message = prompts.ALL_SYNONYMS_GENERATION_INPUT.format(context=pool_arguments.container_split)
+    prompt = prompts.ALL_SYNONYMS_GENERATION_PROMPT.replace("N_SYNONYMS", str(2**pool_arguments.bits_per_word))
+    return prompt, input_message
+
+
+def get_cached_synonyms(pool_arguments: PoolArguments) -> (str | None, list[dict] | None):
+    """Returns the cache key and the cached synonyms of a container split if there are any."""
+    cache = get_synonym_cache()
+    if cache is None:
+        return None, None
+
+    model = get_model_name()  # Offline and recorded responses are kept apart
+    key = cache.make_key(pool_arguments.container_split, model, pool_arguments.bits_per_word)
+    return key, cache.get(key)
+
+
+def cache_synonyms(key: str | None, synonyms: list[dict]):
+    """Store generated synonyms in the cache if they have the expected [{word: [synonyms]}] layout."""
+    cache = get_synonym_cache()
+    if cache is None or key is None:
+        return
+    if synonyms and all(isinstance(s, dict) for s in synonyms):
+        cache.put(key, synonyms)
+
+
+def sum_usage(usage: dict, other: dict) -> dict:
+    """Returns the token usage of two requests, adding up their numeric values."""
+    total = dict(usage)
+    for key, value in other.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def send_synonyms_request(prompt: str, input_message: str, words: int) -> (list[dict], dict[str, int]):
+    """
+    Send a synonyms request to the LLM, retrying once on a malformed response.
+    The usage contains the number of requests and their latency, which are recorded by `update_usage_report`
+    in the process aggregating the results, as multiprocessing workers do not share metrics.
+    """
+    start, temperature = time.perf_counter(), constants.SYNONYMS_TEMPERATURE
+    with span("llm_request", stage="synonyms", words=words):
+        synonyms, usage = get_openai_json_output(prompt, input_message, "words", temperature)
+        requests = 1
+        if synonyms and isinstance(synonyms[0], str):
+            synonyms, retry_usage = get_openai_json_output(prompt, input_message, "words", temperature)
+            usage = sum_usage(usage, retry_usage)
+            requests += 1
+    return synonyms, {**usage, "requests": requests, "latency": time.perf_counter() - start}
+
+
+async def async_send_synonyms_request(prompt: str, input_message: str, words: int) -> (list[dict], dict[str, int]):
+    """Asynchronous counterpart of `send_synonyms_request`."""
+    start, temperature = time.perf_counter(), constants.SYNONYMS_TEMPERATURE
+    with span("llm_request", stage="synonyms", words=words):
+        synonyms, usage = await async_get_openai_json_output(prompt, input_message, "words", temperature)
+        requests = 1
+        if synonyms and isinstance(synonyms[0], str):
+            synonyms, retry_usage = await async_get_openai_json_output(prompt, input_message, "words", temperature)
+            usage = sum_usage(usage, retry_usage)
+            requests += 1
+    return synonyms, {**usage, "requests": requests, "latency": time.perf_counter() - start}
+
+
+def get_synonyms_request_key(prompt: str, input_message: str) -> str:
+    return get_request_key(prompt, input_message, get_model_name(), constants.SYNONYMS_TEMPERATURE)
+
+
+def request_synonyms(pool_arguments: PoolArguments) -> (list[dict], dict[str, int]):
+    """
+    Request synonyms of a container split from the LLM, attaching to an identical request in flight if there is
+    one. A caller served by another request gets a copy of its synonyms and the usage of `get_coalesced_usage`.
+    """
+    prompt, input_message = get_synonyms_request(pool_arguments)
+    words = len(pool_arguments.container_split)
+    if not constants.SINGLE_FLIGHT_ENABLED:
+        return send_synonyms_request(prompt, input_message, words)
+
+    key = get_synonyms_request_key(prompt, input_message)
+    (synonyms, usage), shared = get_single_flight().do(key, send_synonyms_request, prompt, input_message, words)
+    return (deepcopy(synonyms), get_coalesced_usage()) if shared else (synonyms, usage)
+
+
+async def async_request_synonyms(pool_arguments: PoolArguments) -> (list[dict], dict[str, int]):
+    """Asynchronous counterpart of `request_synonyms`."""
+    prompt, input_message = get_synonyms_request(pool_arguments)
+    words = len(pool_arguments.container_split)
+    if not constants.SINGLE_FLIGHT_ENABLED:
+        return await async_send_synonyms_request(prompt, input_message, words)
+
+    key = get_synonyms_request_key(prompt, input_message)
+    (synonyms, usage), shared = await get_single_flight().ado(
+        key, async_send_synonyms_request, prompt, input_message, words
+    )
+    return (deepcopy(synonyms), get_coalesced_usage()) if shared else (synonyms, usage)
 
 
 def generate_synonyms(pool_arguments: PoolArguments) -> dict[str, list[str]]:
@@ -88,44 +186,181 @@ def generate_synonyms(pool_arguments: PoolArguments) -> dict[str, list[str]]:
         dict[str, list[str]]: A dictionary containing word categories as keys and lists of
         binarized synonyms as values. Each synonym list corresponds to a specific word category.
     """
-    input_message = prompts.ALL_SYNONYMS_GENERATION_INPUT.format(context=pool_arguments.container_split)
-    prompt = prompts.ALL_SYNONYMS_GENERATION_PROMPT.replace("N_SYNONYMS", str(2**pool_arguments.bits_per_word))
-    synonyms, usage = get_openai_json_output(prompt, input_message, "words", 0.7)
-    if synonyms and isinstance(synonyms[0], str):
-        synonyms, usage = get_openai_json_output(prompt, input_message, "words", 0.7)
+    cache_key, synonyms = get_cached_synonyms(pool_arguments)
+    if synonyms is not None:
+        return synonyms, get_cached_usage()
 
+    synonyms, usage = request_synonyms(pool_arguments)
+    cache_synonyms(cache_key, synonyms)
     return synonyms, usage
 
 
-def generate_secret_key_mp(secret_key_generation_body: SecretKeyGenerationBody):
+async def async_generate_synonyms(pool_arguments: PoolArguments) -> dict[str, list[str]]:
+    """
+    Asynchronous counterpart of `generate_synonyms` running on the shared AsyncEngine.
+
+    Args:
+        pool_arguments (PoolArguments): The context for which synonyms are to be generated.
+
+    Returns:
+        dict[str, list[str]]: A dictionary containing word categories as keys and lists of
+        binarized synonyms as values. Each synonym list corresponds to a specific word category.
+    """
+    cache_key, synonyms = get_cached_synonyms(pool_arguments)
+    if synonyms is not None:
+        return synonyms, get_cached_usage()
+
+    synonyms, usage = await async_request_synonyms(pool_arguments)
+    cache_synonyms(cache_key, synonyms)
+    return synonyms, usage
+
+
+def get_batch_request(batch: list[PoolArguments]) -> (list, list, PoolArguments | None):
+    """
+    Look up every split of a batch in the cache.
+
+    Returns:
+        tuple: Cache keys of the splits, their (synonyms, usage) results with None for cache misses and
+        the pool arguments of a single request covering all missing splits, or None if nothing is missing.
+    """
+    keys, results = [], []
+    for pool_arguments in batch:
+        cache_key, synonyms = get_cached_synonyms(pool_arguments)
+        keys.append(cache_key)
+        results.append(None if synonyms is None else (synonyms, get_cached_usage()))
+
+    missing = [pool_arguments for pool_arguments, result in zip(batch, results) if result is None]
+    return keys, results, merge_pool_arguments(missing) if missing else None
+
+
+def fill_batch_results(
+    batch: list[PoolArguments], keys: list, results: list, synonyms: list[dict], usage: dict[str, int]
+) -> list[tuple]:
+    """
+    De-multiplex the response of a batched request into results of the missing splits and cache them.
+    Usage of the request is reported with the first missing split. Responses shared from an identical request
+    in flight were cached by that request.
     """
-    Generate a secret key using multiprocessing.
+    missing = [idx for idx, result in enumerate(results) if result is None]
+    if len(missing) == 1:
+        chunks = [synonyms]
+    else:
+        chunks = demultiplex_synonyms([batch[idx].container_split for idx in missing], synonyms)
+
+    coalesced = usage.get("coalesced", False)
+    for n, (idx, chunk) in enumerate(zip(missing, chunks)):
+        if n == 0:
+            results[idx] = (chunk, usage)
+        else:
+            results[idx] = (chunk, get_coalesced_usage(0) if coalesced else get_batched_usage())
+        if not coalesced:
+            cache_synonyms(keys[idx], chunk)
+    return results
 
-    This function takes a list of container chunks as input and utilizes the multiprocessing
-    pool to concurrently generate secret key chunks using the `generate_synonyms` function.
+
+def generate_batch_synonyms(batch: list[PoolArguments]) -> list[tuple]:
+    """
+    Generate synonyms for a batch of consecutive container splits with a single request.
 
     Args:
-        secret_key_generation_body (SecretKeyGenerationBody): A list of container chunks,
-            bits per word and additional bits used as input for secret key generation.
+        batch (list[PoolArguments]): Consecutive container splits packed by `pack_pool_arguments`.
 
     Returns:
-        list: A list of secret key chunks generated using multiprocessing.
+        list[tuple]: (synonyms, usage) of every split of the batch.
     """
+    keys, results, request = get_batch_request(batch)
+    if request is None:
+        return results
+
+    synonyms, usage = request_synonyms(request)
+    return fill_batch_results(batch, keys, results, synonyms, usage)
+
+
+async def async_generate_batch_synonyms(batch: list[PoolArguments]) -> list[tuple]:
+    """Asynchronous counterpart of `generate_batch_synonyms` running on the shared AsyncEngine."""
+    keys, results, request = get_batch_request(batch)
+    if request is None:
+        return results
+
+    synonyms, usage = await async_request_synonyms(request)
+    return fill_batch_results(batch, keys, results, synonyms, usage)
+
 
-    secret_key, synonyms_chunks, is_filled = [], [], False
-    usage_report = {
-        "completion_tokens": 77,
-        "prompt_tokens": 268,
-        "total_tokens": 345,
+def get_batches(pool_arguments: list[PoolArguments]) -> list[list[PoolArguments]]:
+    """Returns container splits packed into batches, or one split per batch if batching is disabled."""
+    if constants.SYNONYMS_BATCHING_ENABLED:
+        return pack_pool_arguments(pool_arguments)
+    return [[split] for split in pool_arguments]
+
+
+def get_initial_usage_report() -> dict[str, int]:
+    """Returns the usage report every secret key generation starts from."""
+    return {
+        "completion_tokens": 0,
+        "prompt_tokens": 0,
+        "total_tokens": 0,
+        "cached_requests": 0,
+        "coalesced_requests": 0,
+        "requests": 0,
+        "unbatched_requests": 0,
     }
 
-    with Pool() as pool:
-        for (result, usage) in pool.imap(generate_synonyms, secret_key_generation_body.pool_arguments):
-            synonyms_chunks += result
-            usage_report["completion_tokens"] += usage["completion_tokens"]
-            usage_report["prompt_tokens"] += usage["prompt_tokens"]
-            usage_report["total_tokens"] += usage["total_tokens"]
 
+def get_cached_usage() -> dict[str, int]:
+    """Returns the usage of a request served from the synonym cache."""
+    return {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0, "cached": True}
+
+
+def get_batched_usage() -> dict[str, int]:
+    """Returns the usage of a split generated by a batched request reported with another split."""
+    return {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0, "requests": 0}
+
+
+def update_usage_report(usage_report: dict[str, int], usage: dict[str, int]) -> dict[str, int]:
+    """Add token usage of a single request to the aggregated usage report and record it in the metrics."""
+    usage_report["completion_tokens"] += usage["completion_tokens"]
+    usage_report["prompt_tokens"] += usage["prompt_tokens"]
+    usage_report["total_tokens"] += usage["total_tokens"]
+    if usage.get("cached"):
+        usage_report["cached_requests"] += 1
+        record_cache_hit("synonyms")
+    elif usage.get("coalesced"):
+        usage_report["coalesced_requests"] += usage["coalesced_requests"]
+        record_coalesced("synonyms", usage["coalesced_requests"])
+    else:
+        if usage.get("requests", 1):
+            record_llm_usage("synonyms", get_model_name(), usage, usage.get("latency"))
+        usage_report["requests"] += usage.get("requests", 1)
+        usage_report["unbatched_requests"] += 1
+    return usage_report
+
+
+def add_batching_savings(usage_report: dict[str, int], bits_per_word: int) -> dict[str, int]:
+    """Add the number of requests and system prompt tokens saved by batching to the usage report."""
+    saved_requests = max(usage_report["unbatched_requests"] - usage_report["requests"], 0)
+    usage_report["saved_requests"] = saved_requests
+    usage_report["saved_prompt_tokens"] = saved_requests * get_prompt_tokens(bits_per_word)
+    return usage_report
+
+
+def build_secret_key(
+    synonyms_chunks: list[dict],
+    secret_key_generation_body: SecretKeyGenerationBody,
+    rng: RandomGenerator | int | None = None,
+) -> SYNONYM_MAP:
+    """
+    Binarize generated synonyms into a secret key.
+
+    Args:
+        synonyms_chunks (list[dict]): Generated synonyms in container order, one {token: synonyms} dict per word.
+        secret_key_generation_body (SecretKeyGenerationBody): Bits per word, additional bits and message chunks.
+        rng (np.random.Generator | int | None): Random generator or seed used to draw codes with additional bits.
+            Defaults to a generator seeded from OS entropy.
+
+    Returns:
+        SYNONYM_MAP: A secret key with binary codes assigned to synonyms.
+    """
+    secret_key, is_filled, rng = [], False, get_rng(rng)
     for idx, synonym in enumerate(synonyms_chunks):
         if is_filled:
             break
@@ -134,14 +369,81 @@ def generate_secret_key_mp(secret_key_generation_body: SecretKeyGenerationBody):
             if secret_key_generation_body.additional_bits:
                 try:
                     binary_message_chunk = secret_key_generation_body.binary_message_chunks[idx]
-                    partially_binarized = binarize_synonyms_partially(list(set(value)), binary_message_chunk)
+                    partially_binarized = binarize_synonyms_partially(
+                        list(dict.fromkeys(value)), binary_message_chunk, rng=rng
+                    )
                     secret_key.append({key: partially_binarized})
                 except IndexError:
                     is_filled = True
             else:
                 secret_key.append({key: binarize_synonyms(key, value)})
 
-    return secret_key, usage_report
+    return secret_key
+
+
+def generate_synonyms_mp(secret_key_generation_body: SecretKeyGenerationBody) -> (list[dict], dict[str, int]):
+    """Generate synonyms for every batch of container splits using a multiprocessing pool."""
+    synonyms_chunks, usage_report = [], get_initial_usage_report()
+    pool_arguments = secret_key_generation_body.pool_arguments
+
+    # Workers do not share spans, their request latency is attached to the span of the whole map instead
+    batches, llm_seconds = get_batches(pool_arguments), 0.0
+    with span("pool_map", batches=len(batches)) as current, Pool() as pool:
+        for batch_results in pool.imap(generate_batch_synonyms, batches):
+            for (result, usage) in batch_results:
+                synonyms_chunks += result
+                update_usage_report(usage_report, usage)
+                llm_seconds += usage.get("latency", 0)
+        if current is not None:
+            current.attributes["llm_seconds"] = round(llm_seconds, 4)
+
+    if pool_arguments:
+        add_batching_savings(usage_report, pool_arguments[0].bits_per_word)
+    return synonyms_chunks, usage_report
+
+
+def generate_synonyms_async(
+    secret_key_generation_body: SecretKeyGenerationBody, concurrency: int | None = None
+) -> (list[dict], dict[str, int]):
+    """Generate synonyms for every batch of container splits concurrently on the shared AsyncEngine."""
+    synonyms_chunks, usage_report = [], get_initial_usage_report()
+    pool_arguments = secret_key_generation_body.pool_arguments
+
+    results = get_engine().map(async_generate_batch_synonyms, get_batches(pool_arguments), concurrency)
+    for batch_results in results:
+        for (result, usage) in batch_results:
+            synonyms_chunks += result
+            update_usage_report(usage_report, usage)
+
+    if pool_arguments:
+        add_batching_savings(usage_report, pool_arguments[0].bits_per_word)
+    return synonyms_chunks, usage_report
+
+
+def generate_synonyms_chunks(
+    secret_key_generation_body: SecretKeyGenerationBody,
+    use_async: bool = ASYNC_ENGINE_ENABLED,
+    concurrency: int | None = None,
+) -> (list[dict], dict[str, int]):
+    """
+    Generate synonyms for every container split with the async engine, falling back to multiprocessing
+    when it is unavailable.
+
+    Args:
+        secret_key_generation_body (SecretKeyGenerationBody): A list of container chunks,
+            bits per word and additional bits used as input for secret key generation.
+        use_async (bool, optional): If False, the multiprocessing path is used. Defaults to ASYNC_ENGINE_ENABLED.
+        concurrency (int, optional): Maximum number of in-flight requests for the async engine.
+
+    Returns:
+        tuple: Generated synonyms in container order and the usage report.
+    """
+    if use_async:
+        try:
+            return generate_synonyms_async(secret_key_generation_body, concurrency)
+        except RuntimeError as e:
+            logger.warning(f"Async engine unavailable, falling back to multiprocessing: {e}")
+    return generate_synonyms_mp(secret_key_generation_body)
 
 
 def clean_secret_key(secret_key: list[dict]):
@@ -165,13 +467,13 @@ def clean_secret_key(secret_key: list[dict]):
     return cleaned_secret_key
 
 
-def align_container_and_secret_key(container, secret_key):
+def align_container_and_secret_key(container: str | TokenTable, secret_key):
     """
     Aligns a container and a secret key lengths, generating a new secret key list based on the alignment.
     Adding skipped words and removing duplicates while cleaning secret key.
 
     Args:
-        container (str): The input container to align with the secret key.
+        container (str | TokenTable): The input container, or its token table, to align with the secret key.
         secret_key (str): The secret key to align with the container.
 
     Returns:
@@ -184,7 +486,7 @@ def align_container_and_secret_key(container, secret_key):
     secret_key_idx = 0
 
     secret_key = clean_secret_key(secret_key)
-    for idx, token in enumerate(clean_container(remove_brackets(container)).split()):
+    for token in tokenize(container).get_words():
         try:
             secret_key_token = list(secret_key[secret_key_idx].keys())[0]
         except IndexError:
@@ -218,9 +520,7 @@ def fix_token_container_size(tokens: dict[str, str], new_token_container_size: i
         dict[str, str]: A new dictionary of tokens with adjusted keys based on binary indices,
                        conforming to the specified container size.
     """
-    new_tokens_size = 2 ** new_token_container_size
-    new_tokens = list(tokens.values())[:new_tokens_size]
-    return {"".join(i): t for i, t in zip(product("01", repeat=int(math.log2(new_tokens_size))), new_tokens)}
+    return resize_codes(tokens, new_token_container_size)
 
 
 def is_secret_key_valid(secret_key: Any) -> bool:
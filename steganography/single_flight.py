@@ -0,0 +1,113 @@
+import asyncio
+import json
+import threading
+from hashlib import sha256
+from typing import Any, Awaitable, Callable
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+_CANCELLED = object()  # Result of a call whose leader was cancelled
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result, self.error = None, None
+
+
+class SingleFlight:
+    """
+    Coalesces identical requests in flight inside a process.
+
+    The first caller of a key runs the request, callers of the same key arriving before it finished wait for
+    its result, or its exception, instead of sending the request again. Results are not kept once the request
+    finished: repeated requests over time are served by the synonym cache. Threads and coroutines are
+    coalesced separately, coroutines per event loop.
+    """
+
+    def __init__(self):
+        self._calls, self._async_calls = {}, {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, function: Callable, *args) -> (Any, bool):
+        """
+        Run function(*args) unless a call with the same key is in flight.
+
+        Returns:
+            tuple: The result and True if it was shared from the call in flight.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+    async def ado(self, key: str, function: Callable[..., Awaitable], *args) -> (Any, bool):
+        """
+        Asynchronous counterpart of `do` for coroutines running on the same event loop.
+
+        A cancelled leader does not cancel its followers: the first follower to resume runs the request instead.
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        while (future := self._async_calls.get(loop_key)) is not None:
+            result = await asyncio.shield(future)
+            if result is not _CANCELLED:
+                return result, True
+
+        future = self._async_calls[loop_key] = loop.create_future()
+        try:
+            result = await function(*args)
+        except asyncio.CancelledError:
+            future.set_result(_CANCELLED)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Marked as retrieved, callers without followers re-raise it below
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._async_calls[loop_key]
+        return result, False
+
+
+def get_request_key(prompt: str, input_message: str, model: str, temperature: float) -> str:
+    """Returns the single-flight key of a request, model being the provider and model, e.g. "openai/gpt-4o"."""
+    return sha256(json.dumps([prompt, input_message, model, temperature]).encode("utf-8")).hexdigest()
+
+
+def get_coalesced_usage(requests: int = 1) -> dict[str, int]:
+    """Returns the usage of a request served by an identical request in flight, counting requests saved."""
+    return {
+        "completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0,
+        "requests": 0, "coalesced": True, "coalesced_requests": requests,
+    }
+
+
+def get_single_flight() -> SingleFlight:
+    """Returns the single-flight group of this process."""
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+        return _single_flight
@@ -0,0 +1,250 @@
+import json
+import mmap
+import os
+import time
+from itertools import islice
+from typing import Iterable, Iterator
+
+from steganography.bits import BitBuffer, BitWriter
+from steganography.codes import get_rng
+from steganography.core import embed_tokens, get_binary_message_chunks, to_bit_buffer
+from steganography.decoder import DecodingIndex
+from steganography.helper import clean_container, divide_chunks
+from steganography.secret_key import align_container_and_secret_key, build_secret_key, generate_synonyms_chunks
+from steganography.tokenizer import tokenize
+from models.pool_arguments import SecretKeyGenerationBody
+from utils.constants import CONTAINER_SPLIT_SIZE, STREAM_READ_SIZE, STREAM_WINDOW_WORDS, SYNONYM_MAP
+from utils.logger import get_logger
+from utils.metrics import record_embedding, stage
+from utils.tracing import traced
+
+logger = get_logger(__name__)
+
+WHITESPACE_BYTES = (b" ", b"\n", b"\t", b"\r")
+
+
+def iter_container_words(path: str, read_size: int = STREAM_READ_SIZE) -> Iterator[str]:
+    """
+    Yield the whitespace-separated words of a UTF-8 text file read through a memory map.
+
+    The file is decoded read_size bytes at a time, cut at the last ASCII whitespace of every block. Bytes of
+    multi-byte UTF-8 characters are never ASCII, so a cut never splits a character or a word.
+    """
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start, size = 0, len(data)
+            while start < size:
+                end = min(start + read_size, size)
+                if end < size:
+                    cut = max(data.rfind(w, start, end) for w in WHITESPACE_BYTES)
+                    if cut <= start:  # A word longer than the block, cut after it instead
+                        cuts = [c for c in (data.find(w, end) for w in WHITESPACE_BYTES) if c != -1]
+                        cut = min(cuts) if cuts else size
+                    end = cut
+                yield from data[start:end].decode("utf-8").split()
+                start = end
+
+
+def iter_windows(words: Iterable[str], window_words: int = STREAM_WINDOW_WORDS) -> Iterator[list[str]]:
+    """Yield consecutive lists of window_words words, the last one possibly shorter."""
+    words = iter(words)
+    while window := list(islice(words, window_words)):
+        yield window
+
+
+def add_usage(usage_report: dict, usage: dict) -> dict:
+    """Add the numeric values of the usage of a window to the usage of the previous windows."""
+    for key, value in usage.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            usage_report[key] = usage_report.get(key, 0) + value
+    return usage_report
+
+
+class StreamEncoder:
+    """
+    Encodes a message into a container of any size window by window.
+
+    Every window of container words goes through synonym generation, code assignment, alignment and
+    substitution on its own, continuing the message from the bit where the previous window stopped, so memory
+    depends on the window size only. Windows are cut at container split boundaries, so synonyms are requested
+    for the same splits as by `encode_message`. Once the whole message is embedded, the
+    remaining words are passed through without requests and without secret key records: the decoder stops
+    at the end of the key, as it stops at the first word missing from its mapping.
+    """
+
+    def __init__(
+        self,
+        message: str | BitBuffer,
+        bits_per_word: int,
+        additional_bits: int = 0,
+        binarize: bool = True,
+        seed: int | None = None,
+    ):
+        self.bits_per_word = bits_per_word
+        self.additional_bits = additional_bits
+        self.binary_message = to_bit_buffer(message, binarize)
+        self.binary_message_chunks = get_binary_message_chunks(self.binary_message, bits_per_word, additional_bits)
+        self.rng = get_rng(seed)
+
+        self.offset = 0  # Bits of the message embedded so far
+        self.n_chunks = 0  # Message chunks used by the codes of previous windows
+        self.n_words = 0
+        self.time_report, self.usage_report = {}, {}
+
+    @property
+    def is_done(self) -> bool:
+        return self.offset >= len(self.binary_message)
+
+    @property
+    def embedded_bits(self) -> int:
+        return min(self.offset, len(self.binary_message))
+
+    def encode_window(self, words: list[str]) -> (list[str], SYNONYM_MAP):
+        """
+        Encode the next window of container words.
+
+        Returns:
+            tuple: The encoded words and the secret key records of the window.
+        """
+        self.n_words += len(words)
+        if self.is_done:
+            return words, []
+
+        tokens = tokenize(" ".join(words))
+        secret_key_generation_body = SecretKeyGenerationBody.from_list(
+            divide_chunks(tokens.surfaces, CONTAINER_SPLIT_SIZE),
+            self.bits_per_word,
+            self.additional_bits,
+            self.binary_message_chunks[self.n_chunks:],
+        )
+
+        time_report = {}
+        with stage("secret_key_generation", time_report):
+            synonyms_chunks, usage = generate_synonyms_chunks(secret_key_generation_body)
+        with stage("code_assignment", time_report):
+            secret_key = build_secret_key(synonyms_chunks, secret_key_generation_body, self.rng)
+            self.n_chunks += len(secret_key)
+        with stage("alignment", time_report):
+            secret_key = align_container_and_secret_key(tokens, secret_key)
+        with stage("substitution", time_report):
+            encoded_words, self.offset = embed_tokens(tokens, secret_key, self.binary_message, self.offset)
+
+        add_usage(self.usage_report, usage)
+        for name, elapsed in time_report.items():
+            self.time_report[name] = round(self.time_report.get(name, 0.0) + elapsed, 4)
+        return encoded_words, secret_key
+
+    def encode(
+        self, words: Iterable[str], window_words: int = STREAM_WINDOW_WORDS
+    ) -> Iterator[tuple[list[str], SYNONYM_MAP]]:
+        """Yield the encoded words and the secret key records of every window of the container words."""
+        assert window_words % CONTAINER_SPLIT_SIZE == 0, f"window_words should be a multiple of {CONTAINER_SPLIT_SIZE}"
+        for window in iter_windows(words, window_words):
+            yield self.encode_window(window)
+
+
+@traced("encode_stream")
+def encode_file(
+    container_path: str,
+    encoded_path: str,
+    secret_key_path: str,
+    message: str | BitBuffer,
+    bits_per_word: int,
+    additional_bits: int = 0,
+    binarize: bool = True,
+    seed: int | None = None,
+    window_words: int = STREAM_WINDOW_WORDS,
+) -> StreamEncoder:
+    """
+    Encode a message into a container file, writing the encoded text and the secret key as they are produced.
+
+    Args:
+        container_path (str): Path to the UTF-8 container text, read through a memory map.
+        encoded_path (str): Path to write the encoded text to, words separated by single spaces.
+        secret_key_path (str): Path to write the secret key to, one JSON {token: {code: synonym}} record per line.
+        message (str | BitBuffer): The input message to be encoded, or its bits.
+        bits_per_word (int): How may bits per word should be encoded (No more than MAX_BITS_PER_WORD).
+        additional_bits (int, optional): How many additional bits needs to be added to bits_per_word. Defaults to 0.
+        binarize (bool, optional): If True, the input message is binarized, otherwise it is a string of '0'
+            and '1' characters. Ignored for a BitBuffer. Defaults to True.
+        seed (int, optional): Seed of the random generator drawing codes with additional bits. Defaults to None.
+        window_words (int, optional): Container words encoded at once. Defaults to STREAM_WINDOW_WORDS.
+
+    Returns:
+        StreamEncoder: The encoder, with the number of embedded bits and the time and usage reports.
+    """
+    encoder = StreamEncoder(message, bits_per_word, additional_bits, binarize, seed)
+    with open(encoded_path, "w") as encoded_file, open(secret_key_path, "w") as secret_key_file:
+        separator = ""
+        for encoded_words, secret_key in encoder.encode(iter_container_words(container_path), window_words):
+            encoded_file.write(separator + " ".join(encoded_words))
+            separator = " "
+            secret_key_file.writelines(json.dumps(record) + "\n" for record in secret_key)
+
+    if not encoder.is_done:
+        logger.warning(
+            f"Container of {encoder.n_words} words fits {encoder.embedded_bits} of {len(encoder.binary_message)} bits"
+        )
+    record_embedding(encoder.embedded_bits, {"secret_key_generation": encoder.usage_report})
+    return encoder
+
+
+def read_secret_key(path: str) -> Iterator[dict]:
+    """Yield the records of a secret key written by `encode_file`."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+@traced("decode_stream")
+def decode_file(
+    encoded_path: str,
+    secret_key_path: str,
+    clean_output: bool = True,
+    window_words: int = STREAM_WINDOW_WORDS,
+) -> (str, float):
+    """
+    Decode a message from an encoded text file and its secret key records written by `encode_file`.
+
+    The key is compiled window_words records at a time and the encoded text is read through a memory map
+    window_words words at a time, only as far as the compiled records need, so memory depends on the window
+    size and the message length only.
+
+    Args:
+        encoded_path (str): Path to the encoded text.
+        secret_key_path (str): Path to the secret key records, one JSON record per line.
+        clean_output (bool, optional): If True, the decoded message is returned as plain text, otherwise as a
+            string of '0' and '1' characters. Defaults to True.
+        window_words (int, optional): Key records and encoded words read at once. Defaults to STREAM_WINDOW_WORDS.
+
+    Returns:
+        tuple: The decoded message and the time spent on decoding.
+    """
+    start_time = time.perf_counter()
+    binary_sequence = BitWriter()
+    windows = iter_windows(iter_container_words(encoded_path), window_words)
+    text, is_final = "", False
+
+    with stage("decode"):
+        for records in iter_windows(read_secret_key(secret_key_path), window_words):
+            index, entry = DecodingIndex.from_secret_key(records), 0
+            while entry < len(index.entries):
+                entry, offset, needs_text = index.decode_text(text, binary_sequence, entry, is_final)
+                text = text[offset:]
+                if not needs_text:
+                    break
+                words = next(windows, None)
+                if words is None:
+                    is_final = True
+                else:
+                    text = f"{text} {clean_container(' '.join(words))}" if text else clean_container(' '.join(words))
+            if entry < len(index.entries):  # The message ended before the key
+                break
+
+        bits = binary_sequence.to_buffer()
+        decoded_message = bits.to_text() if clean_output else bits.to_str()
+
+    return decoded_message, time.perf_counter() - start_time
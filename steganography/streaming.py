@@ -0,0 +1,110 @@
+import asyncio
+import contextvars
+
+from steganography.engine import get_engine
+from steganography.gpt import async_stream_container
+from steganography.helper import divide_chunks
+from steganography.secret_key import (
+    add_batching_savings,
+    async_generate_synonyms,
+    get_initial_usage_report,
+    update_usage_report,
+)
+from models.pool_arguments import PoolArguments
+from utils.constants import CONTAINER_SPLIT_SIZE
+from utils.metrics import stage
+
+
+class SplitDispatcher:
+    """
+    Dispatches synonym generation for container splits while the container is still being generated.
+
+    Requests are keyed by the split words, so a split dispatched from a partial container is reused
+    only if the final container contains exactly the same split.
+    """
+
+    def __init__(self, bits_per_word: int, concurrency: int):
+        self.bits_per_word = bits_per_word
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = {}
+
+        self._words, self._n_dispatched = None, 0
+        # Requests are dispatched from inside the container request, but belong to the caller's trace
+        self._context = contextvars.copy_context()
+
+    async def _generate(self, split: list[str]):
+        async with self.semaphore:
+            return await async_generate_synonyms(PoolArguments(container_split=split, bits_per_word=self.bits_per_word))
+
+    def get_task(self, split: list[str]) -> asyncio.Task:
+        key = tuple(split)
+        if key not in self.tasks:
+            # Tasks copy the context they are created in, so each one starts from the dispatcher's context
+            self.tasks[key] = self._context.copy().run(asyncio.ensure_future, self._generate(split))
+        return self.tasks[key]
+
+    def on_words(self, words: list[str]):
+        """Dispatch every complete split of the words generated so far."""
+        if words is not self._words:  # A new container generation started
+            self._words, self._n_dispatched = words, 0
+        elif len(words) < self._n_dispatched:  # Words of a failed request were dropped before its retry
+            self._n_dispatched = len(words) - len(words) % CONTAINER_SPLIT_SIZE
+
+        while self._n_dispatched + CONTAINER_SPLIT_SIZE <= len(words):
+            self.get_task(words[self._n_dispatched:self._n_dispatched + CONTAINER_SPLIT_SIZE])
+            self._n_dispatched += CONTAINER_SPLIT_SIZE
+
+
+async def async_stream_container_and_synonyms(
+    words_number: int, bits_per_word: int, concurrency: int | None = None
+) -> (str, list[dict], dict[str, float], dict):
+    """
+    Generate a container with a streamed completion and generate synonyms of its splits as soon as they
+    are complete, overlapping the two stages.
+
+    Args:
+        words_number (int): The desired number of words in the generated container.
+        bits_per_word (int): Bits per word used to request synonyms.
+        concurrency (int, optional): Maximum number of in-flight synonym requests. Defaults to LLM_CONCURRENCY.
+
+    Returns:
+        tuple: The container, generated synonyms in container order, the time report and the usage report.
+    """
+    dispatcher = SplitDispatcher(bits_per_word, concurrency or get_engine().concurrency)
+    time_report = {}
+
+    with stage("container_generation", time_report):
+        container, container_usage = await async_stream_container(words_number, dispatcher.on_words)
+
+    with stage("secret_key_generation", time_report):  # Time left after the container was complete
+        synonyms_chunks, synonyms_usage = await gather_synonyms(dispatcher, container)
+    add_batching_savings(synonyms_usage, bits_per_word)
+
+    usage_report = {"container_generation": container_usage, "secret_key_generation": synonyms_usage}
+    return container, synonyms_chunks, time_report, usage_report
+
+
+async def gather_synonyms(dispatcher: SplitDispatcher, container: str) -> (list[dict], dict):
+    """
+    Wait for synonyms of every split of the final container and cancel requests of discarded splits. Usage of
+    a split repeated in the container is counted once, since its request is shared.
+    """
+    final_tasks = [dispatcher.get_task(split) for split in divide_chunks(container.split(), CONTAINER_SPLIT_SIZE)]
+    used_tasks = set(final_tasks)
+    discarded_tasks = [task for task in dispatcher.tasks.values() if task not in used_tasks]
+    for task in discarded_tasks:  # Splits of discarded or normalized-away text
+        task.cancel()
+    await asyncio.gather(*discarded_tasks, return_exceptions=True)
+
+    synonyms_chunks, synonyms_usage, counted_tasks = [], get_initial_usage_report(), set()
+    for task, (result, usage) in zip(final_tasks, await asyncio.gather(*final_tasks)):
+        synonyms_chunks += result
+        if task not in counted_tasks:
+            counted_tasks.add(task)
+            update_usage_report(synonyms_usage, usage)
+    return synonyms_chunks, synonyms_usage
+
+
+def stream_container_and_synonyms(words_number: int, bits_per_word: int, concurrency: int | None = None):
+    """Synchronous wrapper around `async_stream_container_and_synonyms` running on the shared AsyncEngine."""
+    return get_engine().run(async_stream_container_and_synonyms(words_number, bits_per_word, concurrency))
@@ -0,0 +1,84 @@
+import numpy as np
+
+from utils.constants import BRACKETS, PUNCTUATION, SPECIAL_TOKENS
+
+# Multi-character special tokens end with a single-character one listed before them, so the last character decides
+SPECIAL_ENDINGS = frozenset(token for token in SPECIAL_TOKENS if len(token) == 1)
+NORMALIZATION_TABLE = str.maketrans('', '', PUNCTUATION + BRACKETS)
+
+
+class TokenTable:
+    """
+    Whitespace tokens of a text computed in a single pass and shared by encoding, alignment and decoding.
+
+    Every token is stored as parallel columns: its surface form, its start and end character offsets in the
+    text, its normalized form without punctuation and brackets (empty for tokens made of them only), its body
+    without the trailing special token, the trailing special token itself and whether the body is capitalized.
+    Offsets and flags are NumPy arrays, strings are lists indexed by token. Columns other than surfaces and
+    offsets are computed on first use, since decoding only needs the offsets.
+    """
+
+    __slots__ = ("text", "surfaces", "starts", "ends", "_forms", "_bodies", "_endings", "_capitalized")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.surfaces = text.split()
+        self._forms = self._bodies = self._endings = self._capitalized = None
+
+        starts, offset, find = [], 0, text.find
+        for token in self.surfaces:
+            offset = find(token, offset)
+            starts.append(offset)
+            offset += len(token)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = self.starts + np.fromiter(map(len, self.surfaces), dtype=np.int64, count=len(self))
+
+    def __len__(self) -> int:
+        return len(self.surfaces)
+
+    @property
+    def forms(self) -> list[str]:
+        if self._forms is None:
+            # Only non-whitespace characters are removed, so the tokens of the normalized text match the surface
+            # tokens one to one unless a token was made of punctuation and brackets only
+            forms = self.text.translate(NORMALIZATION_TABLE).split()
+            if len(forms) != len(self.surfaces):
+                forms = [token.translate(NORMALIZATION_TABLE) for token in self.surfaces]
+            self._forms = forms
+        return self._forms
+
+    @property
+    def endings(self) -> list[str]:
+        if self._endings is None:
+            self._endings = [token[-1] if token[-1] in SPECIAL_ENDINGS else '' for token in self.surfaces]
+        return self._endings
+
+    @property
+    def bodies(self) -> list[str]:
+        if self._bodies is None:
+            self._bodies = [token[:-1] if ending else token for token, ending in zip(self.surfaces, self.endings)]
+        return self._bodies
+
+    @property
+    def capitalized(self) -> np.ndarray:
+        if self._capitalized is None:
+            self._capitalized = np.fromiter((body.istitle() for body in self.bodies), dtype=bool, count=len(self))
+        return self._capitalized
+
+    def get_words(self) -> list[str]:
+        """Returns the non-empty normalized forms, the words a secret key is aligned with."""
+        return [form for form in self.forms if form]
+
+    def get_boundaries(self) -> bytearray:
+        """Returns a flag per character offset of the text, and one past its end, set where a token ends."""
+        boundaries = np.zeros(len(self.text) + 1, dtype=np.uint8)
+        boundaries[self.ends] = 1
+        boundaries[-1] = 1
+        return bytearray(boundaries)
+
+
+def tokenize(text: str | TokenTable) -> TokenTable:
+    """Returns the token table of a text, reusing it if the text is already tokenized."""
+    if isinstance(text, TokenTable):
+        return text
+    return TokenTable(text)
@@ -0,0 +1,85 @@
+from datetime import timedelta
+
+import pytest
+
+import queue_worker
+from steganography.gpt import set_provider
+from steganography.providers import OfflineProvider
+from models.report import ReportModel
+from utils import constants
+from utils.constants import JobStatus, Procedures
+from utils.database import InMemoryDatabase
+from utils.job_queue import JobQueue, utc_now
+
+PAYLOAD = {"message": "1011001110001111", "binarize": False, "bits_per_word": 2, "additional_bits": 0}
+
+
+@pytest.fixture(autouse=True)
+def offline_provider(monkeypatch):
+    monkeypatch.setattr(constants, "SYNONYM_CACHE_ENABLED", False)
+    set_provider(OfflineProvider(seed=0))
+
+
+@pytest.fixture
+def job_queue():
+    return JobQueue(InMemoryDatabase())
+
+
+def expire_lease(queue: JobQueue, job_uuid: str):
+    queue.database.find_one_and_update(
+        "jobs", {"uuid": job_uuid}, {"$set": {"lease_expires": utc_now() - timedelta(seconds=1)}}
+    )
+
+
+def test_claim_is_exclusive(job_queue):
+    job = job_queue.enqueue(Procedures.ENCODING, PAYLOAD)
+    claimed = job_queue.claim("worker-1")
+    assert claimed.uuid == job.uuid and claimed.attempts == 1
+    assert job_queue.claim("worker-2") is None
+
+
+def test_encoding_job_saves_report_under_job_uuid(job_queue):
+    job = job_queue.enqueue(Procedures.ENCODING, {**PAYLOAD, "verify": True})
+    queue_worker.process(job_queue, job_queue.claim("worker-1"), "worker-1")
+
+    done = job_queue.get(job.uuid)
+    assert done.status == JobStatus.DONE and done.report_uuid == job.uuid
+    report = ReportModel(**job_queue.database.fetch_one(**ReportModel.get(job.uuid)))
+    assert report.decoded_message == PAYLOAD["message"]
+
+
+def test_retry_after_expired_lease_overwrites_report(job_queue):
+    job = job_queue.enqueue(Procedures.ENCODING, PAYLOAD)
+    first = job_queue.claim("worker-1")
+    queue_worker.run_encoding_job(job_queue.database, first)  # The worker crashes before completing the job
+    expire_lease(job_queue, job.uuid)
+
+    second = job_queue.claim("worker-2")
+    assert second.attempts == 2
+    queue_worker.process(job_queue, second, "worker-2")
+    assert not job_queue.complete(first, "worker-1", first.uuid)  # The lease was taken over
+
+    assert job_queue.database.count("reports", {}) == 1
+    assert job_queue.get(job.uuid).status == JobStatus.DONE
+
+
+def test_failed_job_is_retried_then_failed(job_queue, monkeypatch):
+    monkeypatch.setattr("utils.job_queue.get_backoff", lambda attempts: 0)
+    job = job_queue.enqueue(Procedures.DECODING, {"report_uuid": "missing"}, max_attempts=2)
+
+    queue_worker.process(job_queue, job_queue.claim("worker-1"), "worker-1")
+    assert job_queue.get(job.uuid).status == JobStatus.PENDING
+
+    queue_worker.process(job_queue, job_queue.claim("worker-1"), "worker-1")
+    failed = job_queue.get(job.uuid)
+    assert failed.status == JobStatus.FAILED and "does not exist" in failed.error_message
+    assert job_queue.claim("worker-1") is None
+
+
+def test_expired_last_attempt_is_failed(job_queue):
+    job = job_queue.enqueue(Procedures.ENCODING, PAYLOAD, max_attempts=1)
+    job_queue.claim("worker-1")
+    expire_lease(job_queue, job.uuid)
+
+    assert job_queue.claim("worker-2") is None
+    assert job_queue.get(job.uuid).status == JobStatus.FAILED
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from steganography.single_flight import SingleFlight
+
+
+def test_cancelled_leader_does_not_cancel_follower():
+    async def run():
+        single_flight, calls = SingleFlight(), []
+
+        async def request(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value
+
+        leader = asyncio.create_task(single_flight.ado("k", request, "leader"))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(single_flight.ado("k", request, "follower"))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower, calls
+
+    (result, shared), calls = asyncio.run(run())
+    assert (result, shared) == ("follower", False)
+    assert calls == ["leader", "follower"]
+
+
+def test_followers_share_result_of_promoted_leader():
+    async def run():
+        single_flight, calls = SingleFlight(), []
+
+        async def request(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value
+
+        leader = asyncio.create_task(single_flight.ado("k", request, "leader"))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(single_flight.ado("k", request, str(i))) for i in range(3)]
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        return await asyncio.gather(*followers), calls
+
+    results, calls = asyncio.run(run())
+    assert results == [("0", False), ("0", True), ("0", True)]
+    assert calls == ["leader", "0"]
+
+
+def test_leader_error_is_shared_with_followers():
+    async def run():
+        single_flight = SingleFlight()
+
+        async def request():
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        leader = asyncio.create_task(single_flight.ado("k", request))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(single_flight.ado("k", request))
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
@@ -1,8 +1,17 @@
 from hashlib import sha512
+import os
 
 import streamlit as st
 
+from models.config import Config
+from steganography import helper
+from steganography.engine import AsyncEngine, get_engine
+from steganography.planner import load_planner
 from utils.constants import PASSWORD_HASH
+from utils.database import BulkWriter, MongoDB, get_bulk_writer
+from utils.jobs import JobManager
+
+CONFIG_PATH = "config.json"
 
 
 def check_password():
@@ -28,3 +37,40 @@ def check_password():
     if "password_correct" in st.session_state:
         st.error("😕 Password incorrect")
     return False
+
+
+@st.cache_resource
+def get_config() -> Config:
+    """Returns the app config, loaded once per process and shared by all sessions and reruns."""
+    config = Config.from_json(CONFIG_PATH)
+    os.environ["OPENAI_API_KEY"] = config.openai_api_key
+    load_planner(**config.planner)
+    return config
+
+
+@st.cache_resource
+def get_database() -> MongoDB:
+    return MongoDB(**get_config().mongodb)
+
+
+@st.cache_resource
+def get_report_writer() -> BulkWriter:
+    return get_bulk_writer(get_database())
+
+
+@st.cache_resource
+def get_llm_engine() -> AsyncEngine:
+    """Returns the async engine holding the pooled LLM client, started after the API key is set."""
+    get_config()
+    return get_engine()
+
+
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    """Returns the executor running encodes and decodes of all sessions."""
+    return JobManager()
+
+
+@st.cache_data(max_entries=1024)
+def get_binary_message(message: str) -> str:
+    return helper.binarize_message(message)
@@ -1,5 +1,12 @@
 CONTAINER_BUFFER = 1.25
+CONTAINER_LENGTH_MULTIPLIER = 1.5  # Container words per carried bit group when no reports were measured
 CONTAINER_TEMPERATURE = 0.9
+SYNONYMS_TEMPERATURE = 0.7
+CONTAINER_SPLIT_SIZE = 5
+CONTAINER_MAX_ATTEMPTS = 4  # The first request and up to three continuations of a short container
+CONTAINER_CONTINUATION_CONTEXT = 100  # Last words of a partial container sent with a continuation request
+STREAM_WINDOW_WORDS = 2000  # Container words encoded at once by the streaming encoder, a multiple of the split size
+STREAM_READ_SIZE = 1024 * 1024  # Bytes of a memory-mapped container decoded at once
 
 N_ASCII_BITS = 8
 MAX_BITS_PER_WORD = 5
@@ -8,6 +15,69 @@ MAX_ADDITIONAL_BITS_MULTIPLIER = 3
 OPENAI_MODEL_CONTAINER = "gpt-4o"
 OPENAI_MODEL_SYNONYMS = "gpt-4o"
 
+LLM_PROVIDERS = ["openai", "offline", "record", "replay"]
+LLM_PROVIDER = "openai"
+CHARS_PER_TOKEN = 4
+
+ASYNC_ENGINE_ENABLED = True
+LLM_CONCURRENCY = 16
+OPENAI_MAX_CONNECTIONS = 32
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 16
+OPENAI_TIMEOUT = 120.0
+
+LLM_RETRY_MAX_TRIES = 6
+LLM_RETRY_MAX_TIME = 300.0  # Seconds after the first attempt when a request stops being retried
+LLM_RETRY_MAX_WAIT = 60.0  # Cap of the exponential wait before a retry, which is then fully jittered
+
+RATE_LIMIT_ENABLED = True
+MODEL_RATE_LIMITS = {  # Quota of the account per upstream provider and model, others get adaptive concurrency only
+    "openai/gpt-4o": {"requests_per_minute": 500, "tokens_per_minute": 30_000},
+}
+RATE_LIMIT_HEADROOM = 0.9  # Share of the quota requests are scheduled at, to stay just under it
+RATE_LIMIT_BURST_SECONDS = 5.0  # Capacity of a bucket in seconds of its rate
+RATE_LIMIT_COMPLETION_TOKENS = 1000  # Completion tokens reserved for a request until its usage is known
+RATE_LIMIT_RETRY_AFTER = 1.0  # Seconds the buckets are paused after a 429 without a retry-after header
+RATE_LIMIT_STATE_PATH = None  # Folder with bucket state shared by processes, e.g. ".cache/rate_limits"
+
+ADAPTIVE_CONCURRENCY_INITIAL = 16
+ADAPTIVE_CONCURRENCY_MIN = 1
+ADAPTIVE_CONCURRENCY_MAX = 64
+ADAPTIVE_CONCURRENCY_DECREASE = 0.5  # Multiplier of the limit after a 429
+ADAPTIVE_LATENCY_DECREASE = 0.9  # Multiplier of the limit after a request much slower than the baseline
+ADAPTIVE_LATENCY_TOLERANCE = 2.0  # Seconds per token over this many times the baseline count as congestion
+ADAPTIVE_DECREASE_COOLDOWN = 5.0  # Seconds between decreases, so a burst of 429s shrinks the limit once
+
+SYNONYM_CACHE_ENABLED = True
+SYNONYM_CACHE_PATH = ".cache/synonyms.sqlite3"
+SYNONYM_CACHE_MAX_ENTRIES = 100_000
+SYNONYM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+SYNONYM_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+SYNONYM_CACHE_TOUCH_INTERVAL = 60 * 60  # Hits refresh the LRU access time at most this often, in seconds
+
+SINGLE_FLIGHT_ENABLED = True  # Identical synonym requests in flight are sent once
+SINGLE_FLIGHT_CONTAINERS = False  # Concurrent encodes would embed into the same container text
+
+SYNONYMS_BATCHING_ENABLED = True
+SYNONYMS_BATCH_MAX_TOKENS = 6000  # Estimated prompt and completion tokens of one batched request
+SYNONYMS_BATCH_MAX_OUTPUT_TOKENS = 4000
+SYNONYMS_BATCH_MAX_WORDS = 40  # Longer word lists make the model skip words and lose the context
+SYNONYM_TOKENS = 3  # Estimated completion tokens of one synonym with its quotes and separator
+
+METRICS_ENABLED = True
+METRICS_PORT = 9464
+METRICS_PREFIX = "synsteg"
+METRICS_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRICS_RATIO_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)  # Buckets of ratios like tokens per embedded bit
+
+PLANNER_TARGET_PROBABILITY = 0.95
+PLANNER_MIN_REPORTS = 10  # Reports of a parameter set needed before its measured yield is trusted
+CONTAINER_TOKENS_PER_WORD = 1.3
+
+TRACING_ENABLED = False
+PROFILING_ENABLED = False
+TRACING_OUTPUT_PATH = "artifacts/traces"
+PROFILE_TOP_FUNCTIONS = 40  # Functions listed in the text summary of a profile
+
 SPECIAL_TOKENS = [",", ".", "!", "?", "..."]
 PUNCTUATION = ",.?!"
 BRACKETS = "[](){}"
@@ -70,6 +140,33 @@ TOPICS = [
 
 PAGE_SIZE = 20
 
+MONGODB_MAX_POOL_SIZE = 50
+MONGODB_INDEXES = {
+    "reports": ["uuid", "created"],
+    "configs": ["uuid", "created"],
+    "jobs": ["uuid", "status", "available_at", "lease_expires"],
+}
+BULK_WRITE_BATCH_SIZE = 100
+BULK_WRITE_FLUSH_INTERVAL = 1.0  # Seconds the first buffered query waits for others before it is written
+BULK_WRITE_QUEUE_SIZE = 10000
+
+JOB_WORKERS = 4  # Encodes and decodes running at once across all app sessions
+JOB_MAX_PENDING = 32
+JOB_TTL = 600  # Seconds a finished job is kept for its session to fetch the result
+JOB_POLL_INTERVAL = 0.5
+
+QUEUE_LEASE_SECONDS = 60  # A running job whose worker stops renewing its lease for this long is claimed again
+QUEUE_HEARTBEAT_INTERVAL = 15
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_BACKOFF_BASE = 5.0  # Seconds before the first retry, doubled for every further attempt
+QUEUE_BACKOFF_MAX = 300.0
+QUEUE_POLL_INTERVAL = 1.0
+
+SERVICE_PORT = 8000
+SERVICE_MAX_BODY_SIZE = 16 * 1024 * 1024
+
+REPORT_STORE_FLUSH_SIZE = 50  # Reports buffered before they are written as new Parquet part files
+
 
 class Procedures:
     ENCODING = "Encoding"
@@ -77,11 +174,20 @@ class Procedures:
     values = [ENCODING, DECODING]
 
 
+class JobStatus:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    values = [PENDING, RUNNING, DONE, FAILED]
+
+
 class DBMethods:
     INSERT = "insert"
     UPDATE = "update"
     DELETE = "delete"
-    values = [INSERT, UPDATE, DELETE]
+    UPSERT = "upsert"
+    values = [INSERT, UPDATE, DELETE, UPSERT]
 
 
 PASSWORD_HASH = """
@@ -1,8 +1,40 @@
-from pymongo import MongoClient
+import atexit
+import queue
+import threading
+import time
+
+from pymongo import ASCENDING, DeleteMany, InsertOne, MongoClient, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from pymongo.server_api import ServerApi
 
-from utils.constants import PAGE_SIZE
+from utils.constants import (
+    BULK_WRITE_BATCH_SIZE,
+    BULK_WRITE_FLUSH_INTERVAL,
+    BULK_WRITE_QUEUE_SIZE,
+    MONGODB_INDEXES,
+    MONGODB_MAX_POOL_SIZE,
+    PAGE_SIZE,
+)
 from utils.constants import DBMethods
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_client(uri: str) -> MongoClient:
+    """
+    Returns the MongoClient of this process for a connection string, creating it on first use.
+    MongoClient is thread-safe and pools its connections, so one client per cluster is shared by every MongoDB.
+    """
+    with _clients_lock:
+        if uri not in _clients:
+            _clients[uri] = MongoClient(uri, maxPoolSize=MONGODB_MAX_POOL_SIZE)
+        return _clients[uri]
 
 
 class MongoDB:
@@ -17,9 +49,62 @@ class MongoDB:
         self.name = kwargs.get('name', kwargs['name'])
 
         if not self.user and not self.password:
-            self.client = MongoClient(f"mongodb://{self.host}:{self.port}")[self.name]
+            self.uri = f"mongodb://{self.host}:{self.port}"
         else:
-            self.client = MongoClient(f"mongodb+srv://{self.user}:{self.password}@{self.host}")[self.name]
+            self.uri = f"mongodb+srv://{self.user}:{self.password}@{self.host}"
+        self.client = get_client(self.uri)[self.name]
+
+    def ensure_indexes(self, indexes=MONGODB_INDEXES):
+        """
+        Creates indexes that are missing, existing indexes are left untouched
+        :param indexes: Indexed fields per collection. 'required': False, 'type': dict,
+        'example': {'reports': ['uuid', 'created']}
+        :return: Doesn't returns anything.
+        """
+        for collection, fields in indexes.items():
+            for field in fields:
+                self.client[collection].create_index([(field, ASCENDING)])
+
+    @staticmethod
+    def to_operation(method, query=None, docs=None):
+        """
+        Converts a query returned by a model's save, update or delete to a bulk write operation
+        :param method: Execution method. 'required': True, 'type': str, 'example': insert
+        :param query: Query. 'required': False, 'type': dict, 'example': {'uuid': 'uuid_example'}
+        :param docs: a document to insert or update 'required': False, 'type': dict
+        :return: pymongo operation.
+        """
+        if method == DBMethods.INSERT:
+            assert isinstance(docs, dict), 'docs should be a single document in bulk writes'
+            return InsertOne(docs)
+        elif method == DBMethods.UPDATE:
+            assert docs is not None and query is not None, 'query and docs should be specified for update method'
+            return UpdateOne(query, {'$set': docs})
+        elif method == DBMethods.UPSERT:
+            assert isinstance(docs, dict) and query is not None, 'query and docs should be specified for upsert method'
+            return ReplaceOne(query, docs, upsert=True)
+        else:  # delete
+            assert query is not None, 'query should be specified when using delete method'
+            return DeleteMany(query)
+
+    def execute_many(self, queries, ordered=True):
+        """
+        Executes queries of several models with one bulk write per collection
+        :param queries: Queries returned by model's save, update or delete. 'required': True, 'type': list,
+        'example': [report.save(), report.update()]
+        :param ordered: If True, queries run in the given order and stop at the first failed one, otherwise
+        MongoDB runs all of them in any order and reports the failed ones. 'required': False, 'type': bool
+        :return: Doesn't returns anything.
+        """
+        operations = {}
+        for query in queries:
+            assert query['method'] in self.methods, f"Invalid type argument. Must be in {self.methods}"
+            operations.setdefault(query['collection'], []).append(
+                self.to_operation(query['method'], query.get('query'), query.get('docs'))
+            )
+
+        for collection, collection_operations in operations.items():
+            self.client[collection].bulk_write(collection_operations, ordered=ordered)
 
     def fetch_all(self, collection, query, return_fields=(), sort=None, limit=PAGE_SIZE, page=0):
         """
@@ -64,6 +149,30 @@ class MongoDB:
 
         return dict(result) if result else None
 
+    def count(self, collection, query):
+        """
+        Counts records matching a query
+        :param collection: Name of collection. 'required': True, 'type': str, 'example': jobs
+        :param query: Query 'required': True, 'type': dict, 'example': {'status': 'pending'}
+        :return: number of matching documents.
+        """
+        return self.client[collection].count_documents(query)
+
+    def find_one_and_update(self, collection, query, update, sort=None):
+        """
+        Atomically updates the first record matching a query and returns it after the update
+        :param collection: Name of collection. 'required': True, 'type': str, 'example': jobs
+        :param query: Query 'required': True, 'type': dict, 'example': {'status': 'pending'}
+        :param update: Update operators. 'required': True, 'type': dict, 'example': {'$set': {'status': 'running'}}
+        :param sort: a list of (key, direction) pairs choosing the record if several match
+        'required': False, 'type': list, 'example': [('created', 1)] 1 == ASCENDING, -1 == DESCENDING
+        :return: the updated document or None if no record matches.
+        """
+        result = self.client[collection].find_one_and_update(
+            query, update, sort=sort, return_document=ReturnDocument.AFTER
+        )
+        return dict(result) if result else None
+
     def execute(self, collection, method, query=None, docs=None):
         """
         Executes a special query
@@ -89,6 +198,270 @@ class MongoDB:
             assert query is not None, 'query should be specified when using insert or update methods'
             self.client[collection].update_one(query, {'$set': docs})
 
+        elif method == DBMethods.UPSERT:
+            assert isinstance(docs, dict) and query is not None, 'query and docs should be specified for upsert method'
+            self.client[collection].replace_one(query, docs, upsert=True)
+
         else:  # delete
             assert query is not None, 'query should be specified when using insert or update methods'
             self.client[collection].delete_many(query)
+
+
+class BulkWriter:
+    """
+    Saves model queries from a background thread with bulk writes, keeping the database off the request path.
+
+    Queries are buffered and written when `batch_size` of them are waiting, when the oldest one waited
+    `flush_interval` seconds, and on `close`, which also runs at interpreter exit. Batches are written unordered,
+    so an invalid document fails alone: failed queries are logged and dropped, and a batch that could not be sent
+    is retried query by query. A database outage never fails an encode.
+    """
+
+    _FLUSH, _STOP = object(), object()
+
+    def __init__(
+        self,
+        database: MongoDB,
+        batch_size: int = BULK_WRITE_BATCH_SIZE,
+        flush_interval: float = BULK_WRITE_FLUSH_INTERVAL,
+        max_queue_size: int = BULK_WRITE_QUEUE_SIZE,
+    ):
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue(max_queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="mongodb-bulk-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, query: dict):
+        """
+        Queue a query returned by a model's save, update or delete.
+        If the queue is full, the query is dropped with a warning instead of blocking the caller.
+        """
+        assert not self._closed, "BulkWriter is closed"
+        try:
+            self._queue.put_nowait(query)
+        except queue.Full:
+            logger.warning(f"Bulk writer queue is full, dropped {query['method']} of {query['collection']}")
+
+    def flush(self):
+        """
+        Ask the writer thread to write the queued queries without waiting for the flush interval.
+        Does not block: a full queue is already being written in batches.
+        """
+        try:
+            self._queue.put_nowait(self._FLUSH)
+        except queue.Full:
+            pass
+
+    def _write(self, batch: list[dict]):
+        for queries in get_write_rounds(batch):
+            try:
+                self.database.execute_many(queries, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    query = queries[error["index"]]
+                    logger.error(f"Dropped {query['method']} of {query['collection']}: {error.get('errmsg')}")
+            except Exception as e:  # The writer thread must survive any failed batch
+                logger.warning(f"Bulk write of {len(queries)} queries failed, writing them one by one: {e}")
+                for query in queries:
+                    try:
+                        self.database.execute_many([query])
+                    except Exception as e:
+                        logger.exception(f"Dropped {query['method']} of {query['collection']}: {e}")
+
+    def _run(self):
+        batch, deadline = [], None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                query = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                query = None
+
+            if query is not None and query is not self._FLUSH and query is not self._STOP:
+                batch.append(query)
+                if deadline is None:  # The first query of a batch starts its flush interval
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (query is self._FLUSH or query is self._STOP or len(batch) >= self.batch_size
+                          or time.monotonic() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+
+            if query is self._STOP:
+                return
+
+    def close(self):
+        """Write the remaining queries and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+        atexit.unregister(self.close)
+
+
+def get_write_rounds(queries: list[dict]) -> list[list[dict]]:
+    """
+    Split queries into rounds that can be written unordered: every round has queries of one collection and at
+    most one query per record, so an update never runs before the insert of its record. Rounds keep the order
+    of the queries of every record.
+    """
+    rounds, record_rounds = [], {}
+    for query in queries:
+        selector = query.get('query') or query.get('docs')
+        uuid = selector.get('uuid') if isinstance(selector, dict) else None
+        record = (query['collection'], repr(uuid or selector) if selector else id(query))
+        idx = record_rounds.get(record, -1) + 1
+        while idx < len(rounds) and rounds[idx][0]['collection'] != query['collection']:
+            idx += 1
+        if idx == len(rounds):
+            rounds.append([])
+        rounds[idx].append(query)
+        record_rounds[record] = idx
+    return rounds
+
+
+def get_bulk_writer(database: MongoDB) -> BulkWriter:
+    """
+    Returns the bulk writer of this process for a database, creating it and ensuring the indexes on first use.
+    """
+    key = (database.uri, database.name)
+    with _writers_lock:
+        if key not in _writers:
+            try:
+                database.ensure_indexes()
+            except PyMongoError as e:
+                logger.error(f"Could not ensure indexes of {database.name}: {e}")
+            _writers[key] = BulkWriter(database)
+        return _writers[key]
+
+
+def _get_value(doc: dict, key: str):
+    for part in key.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    """Returns True if a document matches a query with equality and $or, $in, $ne, $lt, $lte, $gt, $gte operators"""
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(_matches(doc, sub_query) for sub_query in condition):
+                return False
+            continue
+
+        value = _get_value(doc, key)
+        if not isinstance(condition, dict) or not any(k.startswith('$') for k in condition):
+            if value != condition:
+                return False
+            continue
+
+        for operator, operand in condition.items():
+            if operator == '$in':
+                matched = value in operand
+            elif operator == '$ne':
+                matched = value != operand
+            elif operator in ('$lt', '$lte', '$gt', '$gte'):
+                if value is None:
+                    return False
+                matched = {
+                    '$lt': value < operand, '$lte': value <= operand, '$gt': value > operand, '$gte': value >= operand
+                }[operator]
+            else:
+                raise ValueError(f"Unsupported query operator {operator}")
+            if not matched:
+                return False
+    return True
+
+
+def _apply_update(doc: dict, update: dict):
+    for operator, values in update.items():
+        assert operator in ('$set', '$inc'), f"Unsupported update operator {operator}"
+        for key, value in values.items():
+            doc[key] = value if operator == '$set' else doc.get(key, 0) + value
+
+
+class InMemoryDatabase:
+    """
+    Thread-safe stand-in for MongoDB keeping collections in memory, for tests and single-node runs.
+    Supports the methods and the subset of query and update operators used by the models and the job queue.
+    """
+
+    methods = DBMethods.values
+
+    def __init__(self, **kwargs):
+        self.name = kwargs.get('name', 'memory')
+        self.uri = 'memory://'
+        self.collections = {}
+        self._lock = threading.Lock()
+
+    def _find(self, collection, query, sort=None):
+        docs = [doc for doc in self.collections.get(collection, []) if _matches(doc, query)]
+        for key, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: (_get_value(doc, key) is not None, _get_value(doc, key)), reverse=direction < 0)
+        return docs
+
+    def ensure_indexes(self, indexes=MONGODB_INDEXES):
+        pass
+
+    def fetch_all(self, collection, query, return_fields=(), sort=None, limit=PAGE_SIZE, page=0):
+        with self._lock:
+            docs = self._find(collection, query, sort)[page * limit:(page + 1) * limit]
+            return [{k: v for k, v in doc.items() if not return_fields or k in return_fields} for doc in docs]
+
+    def fetch_one(self, collection, query, return_fields=(), sort=None):
+        result = self.fetch_all(collection, query, return_fields, sort, limit=1)
+        return result[0] if result else None
+
+    def count(self, collection, query):
+        with self._lock:
+            return len(self._find(collection, query))
+
+    def find_one_and_update(self, collection, query, update, sort=None):
+        with self._lock:
+            docs = self._find(collection, query, sort)
+            if not docs:
+                return None
+            _apply_update(docs[0], update)
+            return dict(docs[0])
+
+    def _execute(self, collection, method, query=None, docs=None):
+        assert method in self.methods, f"Invalid type argument. Must be in {self.methods}"
+        records = self.collections.setdefault(collection, [])
+        if method == DBMethods.INSERT:
+            assert docs is not None, 'docs should be specified when using insert or update methods'
+            records += [dict(doc) for doc in (docs if isinstance(docs, list) else [docs])]
+        elif method == DBMethods.UPDATE:
+            assert docs is not None, 'docs should be specified when using insert or update methods'
+            assert query is not None, 'query should be specified when using insert or update methods'
+            matched = self._find(collection, query)
+            if matched:
+                _apply_update(matched[0], {'$set': docs})
+        elif method == DBMethods.UPSERT:
+            assert isinstance(docs, dict) and query is not None, 'query and docs should be specified for upsert method'
+            matched = self._find(collection, query)
+            if matched:
+                matched[0].clear()
+                matched[0].update(docs)
+            else:
+                records.append(dict(docs))
+        else:  # delete
+            assert query is not None, 'query should be specified when using insert or update methods'
+            self.collections[collection] = [doc for doc in records if not _matches(doc, query)]
+
+    def execute(self, collection, method, query=None, docs=None):
+        with self._lock:
+            self._execute(collection, method, query, docs)
+
+    def execute_many(self, queries, ordered=True):
+        with self._lock:
+            for query in queries:
+                self._execute(query['collection'], query['method'], query.get('query'), query.get('docs'))
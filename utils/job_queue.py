@@ -0,0 +1,154 @@
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+
+from models.job import JobModel
+from utils.constants import (
+    QUEUE_BACKOFF_BASE,
+    QUEUE_BACKOFF_MAX,
+    QUEUE_LEASE_SECONDS,
+    QUEUE_MAX_ATTEMPTS,
+    JobStatus,
+)
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def utc_now() -> datetime:
+    """Returns the current UTC time without a timezone, as MongoDB returns stored datetimes."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def get_backoff(attempts: int, base: float = QUEUE_BACKOFF_BASE, maximum: float = QUEUE_BACKOFF_MAX) -> float:
+    """Returns the seconds before a retry: exponential in the number of attempts, capped, with full jitter."""
+    return random.uniform(0, min(base * 2 ** (attempts - 1), maximum))
+
+
+class JobQueue:
+    """
+    Queue of encode and decode jobs stored in the jobs collection of a MongoDB or InMemoryDatabase.
+
+    A job is claimed atomically with `find_one_and_update`, which sets its status to running and gives the
+    claiming worker a lease. The worker renews the lease with heartbeats while it runs the job; a job whose lease
+    expired, because its worker died, can be claimed by another worker. Failed jobs are retried after an
+    exponential backoff until max_attempts claims were made. Every state change after the claim is conditioned on
+    the lease owner, so a worker that lost its lease cannot overwrite the result of the worker that took over.
+    """
+
+    def __init__(self, database, lease_seconds: float = QUEUE_LEASE_SECONDS):
+        self.database = database
+        self.lease_seconds = lease_seconds
+
+    def enqueue(self, kind: str, payload: dict, max_attempts: int = QUEUE_MAX_ATTEMPTS) -> JobModel:
+        """Add a job, available to workers immediately."""
+        job = JobModel(kind=kind, payload=payload, max_attempts=max_attempts, available_at=utc_now())
+        self.database.execute(**job.save())
+        return job
+
+    def enqueue_many(self, kind: str, payloads: list[dict], max_attempts: int = QUEUE_MAX_ATTEMPTS) -> list[JobModel]:
+        """Add many jobs with one bulk write."""
+        jobs = [JobModel(kind=kind, payload=p, max_attempts=max_attempts, available_at=utc_now()) for p in payloads]
+        if jobs:
+            self.database.execute_many([job.save() for job in jobs])
+        return jobs
+
+    def get(self, job_uuid: str) -> JobModel | None:
+        doc = self.database.fetch_one(**JobModel.get(job_uuid))
+        return JobModel(**doc) if doc else None
+
+    def claim(self, worker_id: str, kinds: list[str] | None = None) -> JobModel | None:
+        """Claim the job that became available first, or a running job whose lease expired. Returns None if idle."""
+        now = utc_now()
+        query = {
+            "$or": [
+                {"status": JobStatus.PENDING, "available_at": {"$lte": now}},
+                {"status": JobStatus.RUNNING, "lease_expires": {"$lt": now}},
+            ]
+        }
+        if kinds:
+            query["kind"] = {"$in": kinds}
+
+        while True:
+            doc = self.database.find_one_and_update(
+                JobModel.collection_name,
+                query,
+                {
+                    "$set": {
+                        "status": JobStatus.RUNNING,
+                        "lease_owner": worker_id,
+                        "lease_expires": now + timedelta(seconds=self.lease_seconds),
+                        "modified": now,
+                    },
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("available_at", 1)],
+            )
+            if doc is None:
+                return None
+            job = JobModel(**doc)
+            if job.attempts <= job.max_attempts:
+                return job
+            # The lease of the last attempt expired, the worker running it most likely crashed on it
+            self.fail(job, worker_id, job.error_message or "The lease of the last attempt expired")
+
+    def _update_owned(self, job: JobModel, worker_id: str, values: dict) -> bool:
+        doc = self.database.find_one_and_update(
+            JobModel.collection_name,
+            {"uuid": job.uuid, "status": JobStatus.RUNNING, "lease_owner": worker_id},
+            {"$set": {**values, "modified": utc_now()}},
+        )
+        return doc is not None
+
+    def heartbeat(self, job: JobModel, worker_id: str) -> bool:
+        """Renew the lease of a running job. Returns False if the worker does not own the job anymore."""
+        lease_expires = utc_now() + timedelta(seconds=self.lease_seconds)
+        return self._update_owned(job, worker_id, {"lease_expires": lease_expires})
+
+    def complete(self, job: JobModel, worker_id: str, report_uuid: str) -> bool:
+        """Mark a job done with the uuid of the report holding its result."""
+        return self._update_owned(job, worker_id, {
+            "status": JobStatus.DONE, "report_uuid": report_uuid, "lease_owner": None, "lease_expires": None
+        })
+
+    def fail(self, job: JobModel, worker_id: str, error_message: str) -> bool:
+        """Schedule a retry of a failed job after a backoff, or mark it failed once it used all attempts."""
+        values = {"error_message": error_message, "lease_owner": None, "lease_expires": None}
+        if job.attempts >= job.max_attempts:
+            values["status"] = JobStatus.FAILED
+        else:
+            values["status"] = JobStatus.PENDING
+            values["available_at"] = utc_now() + timedelta(seconds=get_backoff(job.attempts))
+        return self._update_owned(job, worker_id, values)
+
+    def count(self, status: str) -> int:
+        """Returns the number of jobs with a status, for progress reporting."""
+        return self.database.count(JobModel.collection_name, {"status": status})
+
+
+class Heartbeat:
+    """Renews the lease of a job from a background thread while the job runs."""
+
+    def __init__(self, queue: JobQueue, job: JobModel, worker_id: str, interval: float):
+        self.queue, self.job, self.worker_id, self.interval = queue, job, worker_id, interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{job.uuid}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.job, self.worker_id):
+                    logger.warning(f"Lost the lease of job {self.job.uuid}")
+                    self.lost = True
+                    return
+            except Exception as e:  # A failed renewal is retried until the lease expires
+                logger.warning(f"Heartbeat of job {self.job.uuid} failed: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,111 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+from uuid import uuid4
+
+from utils.constants import JOB_MAX_PENDING, JOB_TTL, JOB_WORKERS, JobStatus
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class Job:
+    """A function call running in the background, polled by its id."""
+
+    def __init__(self, kind: str):
+        self.id = str(uuid4())
+        self.kind = kind
+        self.status = JobStatus.PENDING
+        self.created = time.time()
+        self.started, self.finished = None, None
+        self.result, self.error = None, None
+        self.finished_event = threading.Event()
+        self.future = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the job was submitted, or its total time once it is done."""
+        return (self.finished or time.time()) - self.created
+
+
+class JobManager:
+    """
+    Runs jobs of every session on one bounded thread pool.
+
+    Jobs beyond max_pending waiting ones are rejected instead of queued without limit. Finished jobs are kept for
+    ttl seconds, so a session can still fetch the result after a few reruns, and then forgotten.
+    """
+
+    def __init__(self, max_workers: int = JOB_WORKERS, max_pending: int = JOB_MAX_PENDING, ttl: float = JOB_TTL):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="synsteg-job")
+
+    def _run(self, job: Job, function: Callable, args: tuple, kwargs: dict):
+        job.status, job.started = JobStatus.RUNNING, time.time()
+        try:
+            job.result = function(*args, **kwargs)
+            job.status = JobStatus.DONE
+        except Exception as e:
+            logger.exception(f"{job.kind} job {job.id} failed: {e}")
+            job.error, job.status = str(e), JobStatus.FAILED
+        finally:
+            job.finished = time.time()
+            job.finished_event.set()
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [i for i, job in self.jobs.items() if job.done and now - job.finished > self.ttl]:
+            del self.jobs[job_id]
+
+    def submit(self, kind: str, function: Callable, *args, **kwargs) -> Job:
+        """
+        Run function(*args, **kwargs) in the background.
+
+        Raises:
+            RuntimeError: If max_pending jobs are already waiting for a worker.
+        """
+        with self._lock:
+            self._prune()
+            if self.get_pending() >= self.max_pending:
+                raise RuntimeError(f"Too many pending jobs ({self.max_pending}), try again later")
+            job = Job(kind)
+            self.jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job, function, args, kwargs)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def get_pending(self) -> int:
+        return sum(job.status == JobStatus.PENDING for job in list(self.jobs.values()))
+
+    def get_position(self, job: Job) -> int:
+        """Returns the number of pending jobs submitted before a pending job, 0 once it runs."""
+        if job.status != JobStatus.PENDING:
+            return 0
+        return sum(
+            other.status == JobStatus.PENDING and other.created < job.created for other in list(self.jobs.values())
+        )
+
+    def wait(self, job_id: str, timeout: float | None = None) -> Any:
+        """Block until a job is done and return its result, raising RuntimeError if it failed or timed out."""
+        job = self.get(job_id)
+        assert job is not None, f"Unknown job {job_id}"
+        if not job.finished_event.wait(timeout):
+            raise RuntimeError(f"Job {job_id} did not finish in {timeout} seconds")
+        if job.status == JobStatus.FAILED:
+            raise RuntimeError(job.error)
+        return job.result
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
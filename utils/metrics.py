@@ -0,0 +1,250 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import constants
+from utils.logger import get_logger
+from utils.tracing import span
+
+logger = get_logger(__name__)
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds, as exported by Prometheus."""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "max")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is the +Inf bucket
+        self.sum, self.count, self.max = 0.0, 0, 0.0
+
+    def observe(self, value: float):
+        idx = 0
+        while idx < len(self.buckets) and value > self.buckets[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by linear interpolation inside the bucket containing it."""
+        if not self.count:
+            return 0.0
+        rank, cumulative = q * self.count, 0
+        for idx, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[idx - 1] if idx else 0.0
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "p99": round(self.quantile(0.99), 6),
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe registry of counters and histograms identified by a name and labels.
+
+    Counters and histograms live in the process that records them, so values recorded in multiprocessing
+    workers have to be returned to and recorded by the parent process.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = constants.METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counters, self.histograms = {}, {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increase a counter."""
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] | None = None, **labels):
+        """Add a value to a histogram, created with the given buckets or the latency buckets of the registry."""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets or self.buckets)
+            histogram.observe(value)
+
+    def get_counter(self, name: str, **labels) -> float:
+        """Returns the sum of counters with the name whose labels include the given ones."""
+        selected = {(k, str(v)) for k, v in labels.items()}
+        with self._lock:
+            return sum(v for (n, l), v in self.counters.items() if n == name and selected <= set(l))
+
+    def reset(self):
+        with self._lock:
+            self.counters, self.histograms = {}, {}
+
+    def snapshot(self) -> dict:
+        """Returns all metrics in a JSON serializable layout, with tail latencies and tokens per embedded bit."""
+        with self._lock:
+            counters = [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.counters.items())]
+            histograms = [
+                {"name": n, "labels": dict(l), **h.to_dict()} for (n, l), h in sorted(self.histograms.items())
+            ]
+
+        embedded_bits = self.get_counter("embedded_bits_total")
+        tokens = self.get_counter("llm_tokens_total")
+        return {
+            "created": time.time(),
+            "counters": counters,
+            "histograms": histograms,
+            "tokens_per_embedded_bit": round(tokens / embedded_bits, 4) if embedded_bits else None,
+        }
+
+    def to_prometheus(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        def format_labels(labels: tuple, extra: tuple = ()) -> str:
+            items = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return "{" + ",".join(items) + "}" if items else ""
+
+        lines, seen = [], set()
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                name = f"{constants.METRICS_PREFIX}_{name}"
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                name = f"{constants.METRICS_PREFIX}_{name}"
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip((*histogram.buckets, math.inf), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f"{name}_bucket{format_labels(labels, (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def get_registry() -> MetricsRegistry:
+    """Returns the metrics registry of this process."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+        return _registry
+
+
+@contextmanager
+def stage(name: str, time_report: dict | None = None, **labels):
+    """
+    Measure a pipeline stage with perf_counter.
+
+    The duration is added to the "stage_duration_seconds" histogram and, if time_report is given,
+    stored in it under the stage name in seconds. With tracing enabled the stage is also recorded as a span.
+    """
+    start = time.perf_counter()
+    try:
+        with span(name, **labels):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if constants.METRICS_ENABLED:
+            get_registry().observe("stage_duration_seconds", elapsed, stage=name, **labels)
+        if time_report is not None:
+            time_report[name] = round(elapsed, 4)
+
+
+def record_llm_usage(stage_name: str, model: str, usage: dict, latency: float | None = None):
+    """Record tokens, the request count and the latency of one LLM request."""
+    if not constants.METRICS_ENABLED:
+        return
+    registry = get_registry()
+    registry.inc("llm_requests_total", usage.get("requests", 1), stage=stage_name, model=model)
+    for kind in ("prompt", "completion"):
+        registry.inc("llm_tokens_total", usage.get(f"{kind}_tokens", 0), stage=stage_name, model=model, type=kind)
+    if latency is not None:
+        registry.observe("llm_request_duration_seconds", latency, stage=stage_name, model=model)
+
+
+def record_cache_hit(stage_name: str):
+    if constants.METRICS_ENABLED:
+        get_registry().inc("cache_hits_total", stage=stage_name)
+
+
+def record_coalesced(stage_name: str, requests: int = 1):
+    if constants.METRICS_ENABLED:
+        get_registry().inc("llm_coalesced_requests_total", requests, stage=stage_name)
+
+
+def record_embedding(message_bits: int, usage_report: dict, shares: int = 1):
+    """
+    Record the number of embedded bits and the tokens spent per embedded bit of one encoded message, whose
+    usage report is shared by `shares` messages encoded together.
+    """
+    if not constants.METRICS_ENABLED or not message_bits:
+        return
+    tokens = sum(u.get("total_tokens", 0) for u in usage_report.values() if isinstance(u, dict)) / shares
+    registry = get_registry()
+    registry.inc("embedded_bits_total", message_bits)
+    registry.inc("encoded_messages_total")
+    registry.observe("tokens_per_embedded_bit", tokens / message_bits, buckets=constants.METRICS_RATIO_BUCKETS)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the Prometheus text format on /metrics and the JSON snapshot on /metrics.json."""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = get_registry().to_prometheus(), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(get_registry().snapshot()), "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = constants.METRICS_PORT, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve metrics of this process from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
+
+
+def dump_metrics(path: str):
+    """Write the JSON snapshot of this process's metrics to a file."""
+    with open(path, "w") as f:
+        json.dump(get_registry().snapshot(), f, indent=2)
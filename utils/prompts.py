@@ -1,3 +1,5 @@
+PROMPT_VERSION = 1  # Bump on any prompt change to invalidate cached LLM responses
+
 CONTAINER_GENERATION_PROMPT = """
 Your task is to generate a plain text on a given topic in English with required number of words.
 You can generate longer text but not shorter as the number of words in text is important.
@@ -34,4 +36,8 @@ Always return your response in JSON format:
 
 CONTAINER_GENERATION_INPUT = "Topic: {topic}, Length: {words_number} words."
 
+CONTAINER_CONTINUATION_INPUT = """Topic: {topic}, Length: {words_number} words.
+Continue the text below from where it ends. Respond with the continuation only, do not repeat the text.
+Text: {context}"""
+
 ALL_SYNONYMS_GENERATION_INPUT = """Text: {context}"""
@@ -0,0 +1,239 @@
+import json
+import math
+import os
+import threading
+from datetime import datetime
+from glob import glob
+from uuid import uuid4
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from models.report import ReportModel
+from utils.constants import REPORT_STORE_FLUSH_SIZE
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+METRICS_DIR = "metrics"
+BLOBS_DIR = "blobs"
+AGGREGATION_STATE_NAME = "aggregation_state.json"
+BLOB_FIELDS = ["uuid", "message", "container", "encoded_message", "decoded_message", "secret_key", "error_message"]
+GROUP_FIELDS = ["run", "message_length", "bits_per_word", "additional_bits", "model"]
+
+
+def get_run_id() -> str:
+    """Returns a run id sorting in the order runs were started."""
+    return datetime.now().strftime("%Y%m%dT%H%M%S")
+
+
+def count_bit_errors(message: str, decoded_message: str) -> int:
+    """Returns the number of differing bits of two binary strings, counting missing or extra bits as errors."""
+    decoded_message = decoded_message or ""
+    return sum(a != b for a, b in zip(message, decoded_message)) + abs(len(message) - len(decoded_message))
+
+
+def get_metrics_row(report: ReportModel) -> dict:
+    """
+    Returns the scalar metrics of a report.
+
+    Stage timings are stored as time_<stage> in seconds and token usage as <stage>_<kind> for every numeric
+    value of the usage report, so new stages become new columns without changing the store.
+    """
+    message = report.message or ""
+    bit_errors = count_bit_errors(message, report.decoded_message)
+    row = {
+        "uuid": report.uuid,
+        "created": report.created,
+        "bits_per_word": report.bits_per_word,
+        "additional_bits": report.additional_bits,
+        "model": report.model,
+        "message_bits": len(message),
+        "container_words": len((report.container or "").split()),
+        "bit_errors": bit_errors,
+        "bit_error_rate": bit_errors / len(message) if message else None,
+        "success": report.decoded_message == message,
+        "decoding_time": report.decoding_time if isinstance(report.decoding_time, (int, float)) else None,
+        "failed": bool(report.error_message),
+    }
+
+    time_report = report.encoding_time_report or {}
+    for name, value in time_report.items():
+        if isinstance(value, (int, float)):
+            row[f"time_{name}"] = float(value)
+    row["encoding_time"] = sum(v for k, v in row.items() if k.startswith("time_"))
+
+    for name, usage in (report.encoding_usage_report or {}).items():
+        if isinstance(usage, dict):
+            for kind, value in usage.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    row[f"{name}_{kind}"] = value
+        elif isinstance(usage, (int, float)):
+            row[name] = usage
+    return row
+
+
+def get_blob_row(report: ReportModel) -> dict:
+    """Returns the large fields of a report, with the secret key in the compact binary format."""
+    data = report.to_dict(BLOB_FIELDS)
+    return {k: data[k] if data[k] != "" else None for k in BLOB_FIELDS}
+
+
+class ReportStore:
+    """
+    Append-only Parquet store of reports, partitioned by run and message length.
+
+    Scalar metrics and large blobs (messages, container and secret key) are written to separate datasets under
+    {path}/metrics and {path}/blobs with the same Hive-style layout, run=<run>/message_length=<bits>/part-<id>.parquet,
+    and can be joined on uuid. Reports are buffered and every flush adds new part files, existing files are
+    never rewritten.
+    """
+
+    def __init__(self, path: str, run: str | None = None, flush_size: int = REPORT_STORE_FLUSH_SIZE):
+        self.path = path
+        self.run = run or get_run_id()
+        self.flush_size = flush_size
+
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def get_partition(self, dataset: str, message_length: int) -> str:
+        return os.path.join(self.path, dataset, f"run={self.run}", f"message_length={message_length}")
+
+    def add(self, report: ReportModel) -> list[ReportModel]:
+        """
+        Buffer a report, flushing the buffers once flush_size reports are waiting.
+
+        Returns:
+            list[ReportModel]: Reports written by this call, empty if the report is still buffered.
+        """
+        with self._lock:
+            self._buffers.setdefault(len(report.message or ""), []).append(report)
+            if sum(len(buffer) for buffer in self._buffers.values()) < self.flush_size:
+                return []
+            return self._flush()
+
+    def flush(self) -> list[ReportModel]:
+        """Write all buffered reports and return them."""
+        with self._lock:
+            return self._flush()
+
+    def _flush(self) -> list[ReportModel]:
+        written = []
+        for message_length, reports in self._buffers.items():
+            part_name = f"part-{uuid4().hex}.parquet"
+            for dataset, get_row in ((METRICS_DIR, get_metrics_row), (BLOBS_DIR, get_blob_row)):
+                partition = self.get_partition(dataset, message_length)
+                os.makedirs(partition, exist_ok=True)
+                rows = [get_row(report) for report in reports]
+                # Schemas are inferred from the first row only, so rows are padded to the union of their columns
+                columns = list(dict.fromkeys(name for row in rows for name in row))
+                table = pa.Table.from_pylist([{name: row.get(name) for name in columns} for row in rows])
+                # Files are renamed in place once complete, so readers never see a partial part
+                tmp_path = os.path.join(partition, f".{part_name}.tmp")
+                pq.write_table(table, tmp_path)
+                os.replace(tmp_path, os.path.join(partition, part_name))
+            written += reports
+        self._buffers = {}
+        if written:
+            logger.debug(f"Wrote {len(written)} reports to {self.path}")
+        return written
+
+
+def parse_partition(path: str) -> dict[str, str]:
+    """Returns the partition values of a part file from its run=<run>/message_length=<bits> directories."""
+    return dict(item.split("=", 1) for item in path.split(os.sep) if "=" in item)
+
+
+def list_parts(path: str, dataset: str = METRICS_DIR) -> list[str]:
+    """Returns part files of a dataset relative to the store path."""
+    parts = glob(os.path.join(path, dataset, "run=*", "message_length=*", "part-*.parquet"))
+    return sorted(os.path.relpath(part, path) for part in parts)
+
+
+def read_metrics(path: str, run: str | None = None) -> pa.Table:
+    """Read the metrics of all runs, or of one run, into a single table with the partition columns."""
+    tables = []
+    for part in list_parts(path):
+        partition = parse_partition(part)
+        if run is not None and partition["run"] != run:
+            continue
+        table = pq.read_table(os.path.join(path, part))
+        table = table.append_column("run", pa.array([partition["run"]] * len(table), pa.string()))
+        table = table.append_column(
+            "message_length", pa.array([int(partition["message_length"])] * len(table), pa.int64())
+        )
+        tables.append(table)
+    return pa.concat_tables(tables, promote_options="default") if tables else pa.table({})
+
+
+class Aggregator:
+    """
+    Incremental summary statistics of a report store.
+
+    Per group of (run, message_length, bits_per_word, additional_bits, model) the count, sum, sum of squares,
+    minimum and maximum of every numeric metric are kept in {path}/aggregation_state.json together with the
+    part files already read. As parts are never rewritten, `update` reads only parts added since the last call.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state_path = os.path.join(path, AGGREGATION_STATE_NAME)
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+        else:
+            state = {"parts": [], "groups": {}}
+        self.parts, self.groups = set(state["parts"]), state["groups"]
+
+    def add_row(self, row: dict):
+        key = json.dumps([row.get(field) for field in GROUP_FIELDS])
+        group = self.groups.setdefault(key, {})
+        for name, value in row.items():
+            if name in GROUP_FIELDS or isinstance(value, str) or value is None:
+                continue
+            value = float(value)
+            if math.isnan(value):
+                continue
+            stats = group.setdefault(name, {"count": 0, "sum": 0.0, "sum_sq": 0.0, "min": value, "max": value})
+            stats["count"] += 1
+            stats["sum"] += value
+            stats["sum_sq"] += value * value
+            stats["min"], stats["max"] = min(stats["min"], value), max(stats["max"], value)
+
+    def update(self) -> int:
+        """Add the parts written since the last update and persist the state. Returns the number of new parts."""
+        new_parts = [part for part in list_parts(self.path) if part not in self.parts]
+        for part in new_parts:
+            partition = parse_partition(part)
+            for row in pq.read_table(os.path.join(self.path, part)).to_pylist():
+                row.pop("created", None)
+                self.add_row({**row, "run": partition["run"], "message_length": int(partition["message_length"])})
+            self.parts.add(part)
+
+        if new_parts:
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"parts": sorted(self.parts), "groups": self.groups}, f)
+            os.replace(tmp_path, self.state_path)
+        logger.info(f"Aggregated {len(new_parts)} new parts of {self.path}")
+        return len(new_parts)
+
+    def summary(self) -> list[dict]:
+        """Returns one record per group with the count, mean, standard deviation, minimum and maximum of metrics."""
+        records = []
+        for key, group in sorted(self.groups.items()):
+            record = dict(zip(GROUP_FIELDS, json.loads(key)))
+            record["n_reports"] = int(group["success"]["count"]) if "success" in group else 0
+            for name, stats in sorted(group.items()):
+                mean = stats["sum"] / stats["count"]
+                variance = max(stats["sum_sq"] / stats["count"] - mean * mean, 0.0)
+                record[name] = {
+                    "count": int(stats["count"]),
+                    "mean": round(mean, 6),
+                    "std": round(math.sqrt(variance), 6),
+                    "min": stats["min"],
+                    "max": stats["max"],
+                }
+            records.append(record)
+        return records
@@ -0,0 +1,190 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Awaitable, Callable
+from uuid import uuid4
+
+from utils import constants
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+_enabled = constants.TRACING_ENABLED
+_profiling = constants.PROFILING_ENABLED
+_output_path = constants.TRACING_OUTPUT_PATH
+_export_lock = threading.Lock()
+
+_current_span = ContextVar("current_span", default=None)
+_trace_id = ContextVar("trace_id", default=None)
+
+
+class Span:
+    """A timed operation of the pipeline, nested into the span that was current when it started."""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes", "start", "duration", "children", "_lock")
+
+    def __init__(self, name: str, trace_id: str, parent: "Span | None", attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+        self._lock = threading.Lock()
+
+    def add_child(self, span: "Span"):
+        with self._lock:  # Children may finish in the async engine thread
+            self.children.append(span)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "attributes": self.attributes,
+            "children": [child.to_dict() for child in sorted(self.children, key=lambda c: c.start)],
+        }
+
+    def format(self, depth: int = 0) -> str:
+        """Returns the span tree as indented lines of names and durations."""
+        attributes = " ".join(f"{k}={v}" for k, v in self.attributes.items())
+        lines = [f"{'  ' * depth}{self.name}: {self.duration * 1000:.2f}ms {attributes}".rstrip()]
+        lines += [child.format(depth + 1) for child in sorted(self.children, key=lambda c: c.start)]
+        return "\n".join(lines)
+
+
+def configure_tracing(enabled: bool = False, profile: bool = False, output_path: str | None = None):
+    """
+    Switch tracing and profiling on or off for this process.
+
+    Args:
+        enabled (bool, optional): If True, spans are recorded and finished traces are appended to
+            {output_path}/traces.jsonl. Defaults to False.
+        profile (bool, optional): If True, `profile` blocks are captured with cProfile into output_path.
+            Defaults to False.
+        output_path (str, optional): Directory for traces and profiles. Defaults to TRACING_OUTPUT_PATH.
+    """
+    global _enabled, _profiling, _output_path
+    _enabled, _profiling = enabled, profile
+    _output_path = output_path or constants.TRACING_OUTPUT_PATH
+    if enabled or profile:
+        os.makedirs(_output_path, exist_ok=True)
+        logger.info(f"Tracing: {enabled}, profiling: {profile}, artifacts in {_output_path}")
+
+
+def is_tracing_enabled() -> bool:
+    return _enabled
+
+
+def _export(span: Span):
+    with _export_lock:
+        with open(os.path.join(_output_path, "traces.jsonl"), "a") as f:
+            f.write(json.dumps(span.to_dict()) + "\n")
+    logger.debug(f"Trace {span.trace_id}:\n{span.format()}")
+
+
+@contextmanager
+def trace(trace_id: str | None = None):
+    """Correlate all spans started inside the block with a request uuid."""
+    if not _enabled:
+        yield
+        return
+
+    token = _trace_id.set(trace_id or str(uuid4()))
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Record a span around the block. Spans started without a current span are exported as a trace when they end.
+    When tracing is disabled, the block runs without recording anything.
+    """
+    if not _enabled:
+        yield None
+        return
+
+    parent = _current_span.get()
+    trace_id = parent.trace_id if parent is not None else _trace_id.get() or str(uuid4())
+    current = Span(name, trace_id, parent, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_span.reset(token)
+        if parent is not None:
+            parent.add_child(current)
+        else:
+            _export(current)
+
+
+def traced(name: str):
+    """Decorator recording every call of the function as a span."""
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def propagate(coroutine: Awaitable) -> Awaitable:
+    """
+    Make the current span the parent of spans started by a coroutine that runs in another thread, e.g. on the
+    AsyncEngine loop, which does not inherit the context of the submitting thread.
+    """
+    if not _enabled:
+        return coroutine
+    parent, trace_id = _current_span.get(), _trace_id.get()
+
+    async def run_with_parent():
+        _current_span.set(parent)
+        _trace_id.set(trace_id)
+        return await coroutine
+
+    return run_with_parent()
+
+
+@contextmanager
+def profile(name: str, request_uuid: str | None = None):
+    """
+    Capture a cProfile profile of the block into {output_path}/{request_uuid}_{name}.prof, with the
+    functions sorted by cumulative time in a .txt file next to it. Does nothing when profiling is disabled.
+    Only the calling thread is profiled.
+    """
+    if not _profiling:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = os.path.join(_output_path, f"{request_uuid or uuid4()}_{name}")
+        profiler.dump_stats(f"{path}.prof")
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(constants.PROFILE_TOP_FUNCTIONS)
+        with open(f"{path}.txt", "w") as f:
+            f.write(summary.getvalue())
+        logger.info(f"Saved {name} profile to {path}.prof")